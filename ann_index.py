@@ -0,0 +1,187 @@
+import os
+import json
+import hashlib
+import numpy as np
+from scipy import sparse
+from config import *
+from utils import normalize_rows
+
+# Version of the on-disk ANN layout, bumped whenever the files below change.
+ANN_FORMAT_VERSION = 1
+
+# File names inside the ANN directory.
+ANN_META_FILE = "meta.json"
+CENTROIDS_FILE = "centroids.npy"
+LIST_OFFSETS_FILE = "list_offsets.npy"
+LIST_ROWS_FILE = "list_rows.npy"
+
+# Rows scored against the centroids at once, which bounds the size of the score matrix.
+ASSIGN_BLOCK_SIZE = 8192
+
+
+def corpus_fingerprint(corpus):
+    '''
+    Returns a hash identifying the rows of a loaded corpus: its sources, row ranges, content
+    hashes and ingest parameters. An ANN index is only valid for the corpus it was built on.
+    '''
+    payload = {
+        "sources": list(corpus["sources"]),
+        "doc_ranges": np.asarray(corpus["doc_ranges"]).tolist(),
+        "content_hashes": list(corpus.get("content_hashes", [])),
+        "ingest_params": corpus.get("ingest_params", {}),
+        "num_chunks": len(corpus["chunks"])
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+def default_nlist(num_rows):
+    '''
+    Returns the default number of inverted lists: about the square root of the number of rows,
+    which balances centroid scoring against list scanning.
+    '''
+    return max(1, int(np.sqrt(num_rows)))
+
+def assign_to_centroids(vectors, centroids, block_size=ASSIGN_BLOCK_SIZE):
+    '''
+    Returns the index of the most similar centroid for every (normalized) row, scoring the
+    rows block by block so memory-mapped matrices are never loaded whole.
+    '''
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = normalize_rows(vectors[start:start + block_size])
+        labels[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+def train_centroids(embeddings, nlist, iterations=ANN_KMEANS_ITERATIONS, sample_size=ANN_TRAIN_SAMPLE, seed=0):
+    '''
+    Trains nlist centroids with spherical k-means (cosine similarity) on a random sample of rows.
+
+    Returns:
+    - A (nlist x dim) float32 matrix of L2-normalized centroids.
+    '''
+    rng = np.random.default_rng(seed)
+    num_rows = len(embeddings)
+    # Sorted sample rows keep reads from the memory map sequential.
+    sample = np.sort(rng.choice(num_rows, size=min(num_rows, sample_size), replace=False))
+    vectors = normalize_rows(embeddings[sample])
+    nlist = min(nlist, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), size=nlist, replace=False)]
+
+    labels = None
+    for _ in range(iterations):
+        new_labels = assign_to_centroids(vectors, centroids)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        # Sum the vectors of every cluster with one sparse product.
+        membership = sparse.csr_matrix(
+            (np.ones(len(labels), dtype=np.float32), (labels, np.arange(len(labels)))),
+            shape=(nlist, len(vectors))
+        )
+        sums = np.asarray(membership @ vectors)
+        # Empty clusters restart from random sample rows.
+        empty = np.flatnonzero(np.bincount(labels, minlength=nlist) == 0)
+        if len(empty):
+            sums[empty] = vectors[rng.choice(len(vectors), size=len(empty), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+def build_ivf_index(embeddings, nlist=ANN_NLIST, iterations=ANN_KMEANS_ITERATIONS, sample_size=ANN_TRAIN_SAMPLE):
+    '''
+    Builds an inverted file (IVF) index over a normalized embedding matrix.
+
+    Process:
+    - Trains centroids with spherical k-means on a sample of the rows.
+    - Assigns every row to its most similar centroid.
+    - Stores the rows of each centroid as one contiguous inverted list (CSR layout).
+
+    Returns:
+    - A dictionary with the centroids, the list offsets (nlist + 1) and the rows of all lists.
+    '''
+    num_rows = len(embeddings)
+    centroids = train_centroids(embeddings, nlist or default_nlist(num_rows), iterations, sample_size)
+    labels = assign_to_centroids(embeddings, centroids)
+    # A stable sort keeps rows in corpus order inside every list.
+    list_rows = np.argsort(labels, kind="stable").astype(np.int64)
+    counts = np.bincount(labels, minlength=len(centroids))
+    list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return {"centroids": centroids, "list_offsets": list_offsets, "list_rows": list_rows}
+
+def save_ann_index(ann, fingerprint, ann_dir=ANN_DIR):
+    '''
+    Saves an IVF index with the fingerprint of the corpus it was built on.
+    The metadata file is written last, so an interrupted save is never loaded.
+    '''
+    os.makedirs(ann_dir, exist_ok=True)
+    meta_path = os.path.join(ann_dir, ANN_META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    np.save(os.path.join(ann_dir, CENTROIDS_FILE), ann["centroids"])
+    np.save(os.path.join(ann_dir, LIST_OFFSETS_FILE), ann["list_offsets"])
+    np.save(os.path.join(ann_dir, LIST_ROWS_FILE), ann["list_rows"])
+    with open(meta_path, "w") as f:
+        json.dump({
+            "format_version": ANN_FORMAT_VERSION,
+            "fingerprint": fingerprint,
+            "nlist": len(ann["centroids"]),
+            "num_rows": len(ann["list_rows"])
+        }, f, indent=2)
+
+def load_ann_index(corpus, ann_dir=ANN_DIR):
+    '''
+    Loads the IVF index of a corpus. The inverted lists stay memory-mapped.
+
+    Returns:
+    - The index dictionary from build_ivf_index, or None if there is none or it was built
+      on a different corpus.
+    '''
+    meta_path = os.path.join(ann_dir, ANN_META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get("format_version") != ANN_FORMAT_VERSION or meta.get("fingerprint") != corpus_fingerprint(corpus):
+        return None
+    return {
+        "centroids": np.load(os.path.join(ann_dir, CENTROIDS_FILE)),
+        "list_offsets": np.load(os.path.join(ann_dir, LIST_OFFSETS_FILE)),
+        "list_rows": np.load(os.path.join(ann_dir, LIST_ROWS_FILE), mmap_mode="r")
+    }
+
+def search_ivf(ann, embeddings, queries, nprobe=ANN_NPROBE, candidates=ANN_CANDIDATES):
+    '''
+    Finds the rows most similar to every query by scanning only the inverted lists of the
+    nprobe closest centroids, so the cost grows with the list size, not the corpus size.
+
+    Parameters:
+    - ann: Index from build_ivf_index or load_ann_index.
+    - embeddings: The normalized (rows x dim) matrix the index was built on.
+    - queries: (queries x dim) query embeddings.
+    - nprobe: Inverted lists scanned per query; more lists give higher recall.
+    - candidates: Rows returned per query.
+
+    Returns:
+    - A tuple (rows, scores) of shape (queries x candidates), ordered by descending cosine
+      similarity. Queries with fewer reachable rows are padded with row -1 and score -inf.
+    '''
+    queries = normalize_rows(queries)
+    centroids = ann["centroids"]
+    offsets = ann["list_offsets"]
+    nprobe = min(nprobe, len(centroids))
+    # Rank the centroids of every query with one matrix product and keep the nprobe closest.
+    probes = np.argpartition(-(queries @ centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+    rows = np.full((len(queries), candidates), -1, dtype=np.int64)
+    scores = np.full((len(queries), candidates), -np.inf, dtype=np.float32)
+    for i, query in enumerate(queries):
+        lists = [ann["list_rows"][offsets[l]:offsets[l + 1]] for l in probes[i]]
+        # Sorted rows keep reads from the memory-mapped embeddings sequential.
+        found = np.sort(np.concatenate(lists)) if lists else np.zeros(0, dtype=np.int64)
+        if not len(found):
+            continue
+        found_scores = np.asarray(embeddings[found], dtype=np.float32) @ query
+        keep = min(candidates, len(found))
+        best = np.argpartition(-found_scores, keep - 1)[:keep]
+        best = best[np.argsort(-found_scores[best], kind="stable")]
+        rows[i, :keep] = found[best]
+        scores[i, :keep] = found_scores[best]
+    return rows, scores
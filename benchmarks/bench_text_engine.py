@@ -0,0 +1,120 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from collections import Counter
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from config import *
+from process_regulatory_file import extract_text_from_pdf
+from text_engine import analyze_document
+from run_benchmarks import RESULTS_DIR, git_revision, timed
+
+
+def nltk_prepare(text, stop_words, sent_tokenize, word_tokenize):
+    '''
+    Chunking and keyword extraction as done before the text engine: NLTK Punkt sentences,
+    then an NLTK word tokenization of the whole text and again of every chunk.
+    '''
+    def keywords(passage, top_n):
+        tokens = [t for t in word_tokenize(passage.lower()) if t.isalpha() and t not in stop_words]
+        return [word for word, count in Counter(tokens).most_common(top_n)]
+
+    sentences = sent_tokenize(text)
+    chunks = []
+    i = 0
+    while i < len(sentences):
+        chunks.append(" ".join(sentences[i:i + CHUNK_SIZE]))
+        i += CHUNK_SIZE - OVERLAP
+    return {"chunks": chunks, "keywords": keywords(text, 20), "chunk_keywords": [keywords(chunk, 10) for chunk in chunks]}
+
+def nltk_path(texts):
+    '''
+    Runs the NLTK path over all texts, including scikit-learn's own TF-IDF tokenization of the chunks.
+    '''
+    from nltk.corpus import stopwords
+    from nltk.tokenize import sent_tokenize, word_tokenize
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    # The old code rebuilt the stopword set on every call.
+    docs = [nltk_prepare(text, set(stopwords.words("english")), sent_tokenize, word_tokenize) for text in texts]
+    analyzer = TfidfVectorizer().build_analyzer()
+    for doc in docs:
+        for chunk in doc["chunks"]:
+            analyzer(chunk)
+    return docs
+
+def engine_path(texts):
+    '''
+    Runs the text engine over all texts; it counts the TF-IDF terms of the chunks as well.
+    '''
+    return [analyze_document(text, CHUNK_SIZE, OVERLAP, doc_top_n=20, chunk_top_n=10) for text in texts]
+
+def keyword_agreement(old_docs, new_docs):
+    '''
+    Returns the mean Jaccard overlap of the document keywords found by both paths.
+    '''
+    overlaps = []
+    for old, new in zip(old_docs, new_docs):
+        old_keywords, new_keywords = set(old["keywords"]), set(new["keywords"])
+        if old_keywords or new_keywords:
+            overlaps.append(len(old_keywords & new_keywords) / len(old_keywords | new_keywords))
+    return sum(overlaps) / len(overlaps) if overlaps else 1.0
+
+def run(pdf_dir, repeats):
+    '''
+    Extracts every PDF once, then times both paths on the extracted texts (best of repeats).
+    '''
+    pdf_files = sorted(glob.glob(os.path.join(pdf_dir, "*.pdf")))
+    if not pdf_files:
+        raise SystemExit(f"No PDF files found in {pdf_dir}")
+    texts = [extract_text_from_pdf(pdf_file) for pdf_file in pdf_files]
+    megabytes = sum(len(text.encode("utf-8")) for text in texts) / 1e6
+
+    try:
+        # The first run also loads the NLTK data, so it is not timed.
+        old_docs = nltk_path(texts)
+    except LookupError as e:
+        raise SystemExit(f"NLTK data for the baseline is missing: {e}")
+    old_seconds = min(timed(nltk_path, texts)[1] for _ in range(repeats))
+    new_docs = engine_path(texts)
+    new_seconds = min(timed(engine_path, texts)[1] for _ in range(repeats))
+
+    return {
+        "pdfs": len(pdf_files),
+        "megabytes": round(megabytes, 3),
+        "nltk": {
+            "seconds": old_seconds,
+            "megabytes_per_second": megabytes / old_seconds,
+            "chunks": sum(len(doc["chunks"]) for doc in old_docs)
+        },
+        "text_engine": {
+            "seconds": new_seconds,
+            "megabytes_per_second": megabytes / new_seconds,
+            "chunks": sum(len(doc["chunks"]) for doc in new_docs)
+        },
+        "speedup": old_seconds / new_seconds,
+        "document_keyword_agreement": keyword_agreement(old_docs, new_docs)
+    }
+
+if __name__ == "__main__":
+    # Compare the text engine with the NLTK tokenizers it replaced (needs nltk and its
+    # punkt, punkt_tab and stopwords data):
+    #     python benchmarks/bench_text_engine.py --pdf-dir ./data/regulations
+    parser = argparse.ArgumentParser(description="Benchmark the text engine against the NLTK path.")
+    parser.add_argument("--pdf-dir", default=os.path.join(REPO_DIR, "data", "regulations"))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default=None, help=f"Result JSON path (default: {RESULTS_DIR}/text_engine_<time>.json).")
+    args = parser.parse_args()
+
+    results = run(args.pdf_dir, args.repeats)
+    output = args.output or os.path.join(RESULTS_DIR, f"text_engine_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "git": git_revision(), "results": results}, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Benchmark results saved to {output}")
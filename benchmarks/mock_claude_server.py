@@ -0,0 +1,148 @@
+import time
+import random
+import asyncio
+import argparse
+import threading
+from collections import deque
+from aiohttp import web
+
+
+class MockClaudeServer:
+    '''
+    Local stand-in for the Claude messages endpoint, for offline throughput benchmarks.
+
+    - Every request waits latency seconds (plus up to jitter seconds) before it is answered.
+    - Requests beyond requests_per_minute or tokens_per_minute in the last minute get a 429
+      with a retry-after header, like the real rate limiter.
+    - A share throttle_rate of the remaining requests gets a random 429 as well.
+    - Replies report input tokens (about four characters per token) and output_tokens in their usage.
+    - A share discrepancy_rate of the replies reports a discrepancy; the rest say NO DISCREPANCY.
+
+    Use start() to serve in a background thread, or run this file to serve in the foreground.
+    '''
+
+    def __init__(self, port=8765, latency=0.2, jitter=0.05, throttle_rate=0.0, requests_per_minute=None,
+                 tokens_per_minute=None, output_tokens=50, discrepancy_rate=0.2, seed=0):
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.output_tokens = output_tokens
+        self.discrepancy_rate = discrepancy_rate
+        self.rng = random.Random(seed)
+        # (time, tokens) of every request admitted in the last minute.
+        self.window = deque()
+        self.stats = {"requests": 0, "ok": 0, "throttled_rate_limit": 0, "throttled_injected": 0, "tokens": 0}
+        self.thread = None
+        self.runner = None
+        self.loop = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/v1/messages"
+
+    def retry_after(self, now):
+        '''
+        Returns the seconds until the oldest request leaves the one-minute window.
+        '''
+        return max(0.1, 60.0 - (now - self.window[0][0])) if self.window else 1.0
+
+    def over_limit(self, now, tokens):
+        '''
+        Drops requests older than a minute from the window and checks the limits.
+        '''
+        while self.window and now - self.window[0][0] > 60.0:
+            self.window.popleft()
+        if self.requests_per_minute is not None and len(self.window) >= self.requests_per_minute:
+            return True
+        used = sum(window_tokens for _, window_tokens in self.window)
+        return self.tokens_per_minute is not None and used + tokens > self.tokens_per_minute
+
+    async def handle(self, request):
+        body = await request.json()
+        prompt = body["messages"][0]["content"]
+        input_tokens = len(prompt) // 4
+        self.stats["requests"] += 1
+
+        now = time.monotonic()
+        if self.over_limit(now, input_tokens + self.output_tokens):
+            self.stats["throttled_rate_limit"] += 1
+            return web.json_response({"type": "error", "error": {"type": "rate_limit_error"}}, status=429,
+                                     headers={"retry-after": f"{self.retry_after(now):.1f}"})
+        if self.rng.random() < self.throttle_rate:
+            self.stats["throttled_injected"] += 1
+            return web.json_response({"type": "error", "error": {"type": "rate_limit_error"}}, status=429,
+                                     headers={"retry-after": "1"})
+        self.window.append((now, input_tokens + self.output_tokens))
+
+        await asyncio.sleep(self.latency + self.rng.uniform(0, self.jitter))
+        if self.rng.random() < self.discrepancy_rate:
+            text = "Contradiction found: " + " ".join(["detail"] * max(1, self.output_tokens - 3))
+        else:
+            text = "NO DISCREPANCY"
+        self.stats["ok"] += 1
+        self.stats["tokens"] += input_tokens + self.output_tokens
+        return web.json_response({
+            "type": "message",
+            "content": [{"type": "text", "text": text}],
+            "usage": {"input_tokens": input_tokens, "output_tokens": self.output_tokens}
+        })
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/v1/messages", self.handle)
+        return app
+
+    def start(self):
+        '''
+        Starts serving in a daemon thread and returns once the port accepts connections.
+        '''
+        ready = threading.Event()
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.runner = web.AppRunner(self.app())
+            self.loop.run_until_complete(self.runner.setup())
+            self.loop.run_until_complete(web.TCPSite(self.runner, "127.0.0.1", self.port).start())
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        '''
+        Stops a server started with start().
+        '''
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop = None
+
+
+if __name__ == "__main__":
+    # Serve in the foreground, then point CLAUDE_API_URL at http://127.0.0.1:<port>/v1/messages:
+    #     python benchmarks/mock_claude_server.py --latency 0.5 --throttle-rate 0.05
+    parser = argparse.ArgumentParser(description="Local mock of the Claude messages API.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before every reply.")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Random extra latency, in seconds.")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of requests answered with a random 429.")
+    parser.add_argument("--requests-per-minute", type=int, default=None)
+    parser.add_argument("--tokens-per-minute", type=int, default=None)
+    parser.add_argument("--output-tokens", type=int, default=50)
+    args = parser.parse_args()
+    server = MockClaudeServer(
+        port=args.port, latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate,
+        requests_per_minute=args.requests_per_minute, tokens_per_minute=args.tokens_per_minute,
+        output_tokens=args.output_tokens
+    )
+    print(f"Mock Claude API listening on {server.url}")
+    web.run_app(server.app(), host="127.0.0.1", port=args.port, print=None)
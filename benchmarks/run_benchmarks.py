@@ -0,0 +1,374 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+import claude_client
+import call_claude_api
+from config import *
+from utils import load_processed_data, get_embedding_model, normalize_rows
+from process_regulatory_file import process_regulatory_files
+from report_generator import generate_tasks, load_retrieval_index, load_sop_statements, iter_tasks
+from retrieval_pool import RetrievalPool
+from retrieval import retrieve_top_chunks
+from ann_index import build_ivf_index, search_ivf
+from embedding_cache import EmbeddingCache
+from embedding_backend import encode_texts
+from parallel_api_query import call_claude_on_tasks
+from metrics import metrics
+from synthetic_data import generate_regulatory_pdfs, generate_sop_docx
+from mock_claude_server import MockClaudeServer
+
+# Where result files go unless --output is given.
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+
+
+def timed(function, *args, **kwargs):
+    '''
+    Calls function and returns a tuple (its result, elapsed seconds).
+    '''
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+def median_time(function, repeats):
+    '''
+    Returns the median seconds of repeats calls to function.
+    '''
+    return statistics.median(timed(function)[1] for _ in range(repeats))
+
+def git_revision():
+    '''
+    Returns the current commit of the repository and whether the tree has local changes.
+    '''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                                    capture_output=True, text=True).stdout.strip())
+        return {"commit": commit or None, "dirty": dirty}
+    except OSError:
+        return {"commit": None, "dirty": None}
+
+def topk_recall(exact_rows, approx_rows):
+    '''
+    Returns the mean share of every exact top-k row set that the approximate path also found.
+    '''
+    recalls = [len(set(exact) & set(approx)) / len(exact) for exact, approx in zip(exact_rows, approx_rows) if len(exact)]
+    return float(np.mean(recalls)) if recalls else 1.0
+
+def bench_ingest(args):
+    '''
+    Times process_regulatory_files on a fresh synthetic corpus: the first build, a rerun with
+    nothing changed, and a rerun after one PDF has changed.
+    '''
+    generate_regulatory_pdfs(REGULATORY_DOCS_DIR, args.pdfs, args.pages, args.sentences_per_page, seed=args.seed)
+    _, cold = timed(process_regulatory_files)
+    _, noop = timed(process_regulatory_files)
+    # Regenerating the first PDF with another seed changes its content only.
+    generate_regulatory_pdfs(REGULATORY_DOCS_DIR, 1, args.pages, args.sentences_per_page, seed=args.seed + 1)
+    _, incremental = timed(process_regulatory_files)
+    corpus = load_processed_data()
+    return {
+        "pdfs": args.pdfs,
+        "chunks": len(corpus["chunks"]),
+        "cold_seconds": cold,
+        "noop_seconds": noop,
+        "one_changed_pdf_seconds": incremental
+    }
+
+def bench_load(repeats):
+    '''
+    Times opening the processed corpus and building the retrieval index (medians of repeats).
+    '''
+    return {
+        "load_processed_data_seconds": median_time(load_processed_data, repeats),
+        "load_retrieval_index_seconds": median_time(load_retrieval_index, repeats)
+    }
+
+def bench_tasks(args):
+    '''
+    Times generate_tasks on a synthetic SOP: the first run (SOP parsing and statement
+    embeddings not cached yet) and a second run with warm caches.
+
+    Returns:
+    - A tuple (timings, tasks of the last run).
+    '''
+    generate_sop_docx(SOP_DOC_PATH, args.statements, seed=args.seed)
+    tasks, cold = timed(generate_tasks)
+    tasks, warm = timed(generate_tasks)
+    return {"statements": len(tasks), "cold_seconds": cold, "warm_seconds": warm}, tasks
+
+def bench_recall(args):
+    '''
+    Measures how many of the brute-force top-k chunks the IVF index finds, independent of
+    ANN_MIN_CHUNKS (the index is built in memory for the benchmark corpus).
+
+    Both comparisons are like with like, against brute force over every chunk:
+
+    - Semantic recall: search_ivf against the exact cosine top k, for every nprobe in args.nprobe.
+      With every list probed it must be 1.0 (semantic_full_probe_recall).
+    - Fused recall: retrieve_top_chunks with the ANN path at ANN_NPROBE against the same fused
+      score (with the document keyword bonus) computed for every chunk.
+    - Exact path agreement: share of the exact path's top k (which keeps only the statement's top
+      two documents) that the ANN path also returns; informational, the two rank differently.
+    - Empty contexts: statements for which the ANN path found no candidate at all.
+    '''
+    index = load_retrieval_index()
+    statements = load_sop_statements()
+    cache = EmbeddingCache()
+    embeddings = normalize_rows(cache.encode(statements, lambda texts: encode_texts(get_embedding_model(), texts)))
+    top_k = args.top_k
+
+    # Brute force: every statement against every chunk.
+    exact_index = dict(index, ann=None)
+    (exact_scores, exact_seconds) = timed(lambda: np.asarray(embeddings @ np.asarray(index["embeddings"]).T))
+    exact_semantic = np.argsort(-exact_scores, axis=1, kind="stable")[:, :top_k]
+    exact_path, exact_path_seconds = timed(lambda: [rows for _, rows, _ in retrieve_top_chunks(exact_index, statements, embeddings, top_k=top_k)])
+
+    ann, build_seconds = timed(build_ivf_index, index["embeddings"])
+    semantic = {}
+    for nprobe in args.nprobe:
+        (rows, _), seconds = timed(search_ivf, ann, index["embeddings"], embeddings, nprobe=nprobe, candidates=top_k)
+        semantic[str(nprobe)] = {"recall": topk_recall(exact_semantic, rows), "seconds": seconds}
+    full_rows, _ = search_ivf(ann, index["embeddings"], embeddings, nprobe=len(ann["centroids"]), candidates=top_k)
+    full_semantic_recall = topk_recall(exact_semantic, full_rows)
+    if full_semantic_recall < 1.0:
+        print("Warning: the IVF index with every list probed differs from brute-force semantic search.")
+
+    ann_index = dict(index, ann=ann)
+    ann_fused, ann_fused_seconds = timed(lambda: [rows for _, rows, _ in retrieve_top_chunks(ann_index, statements, embeddings, top_k=top_k)])
+    # Every list probed and every chunk a candidate: the ANN path's fused score over the whole corpus.
+    brute_fused = [rows for _, rows, _ in retrieve_top_chunks(ann_index, statements, embeddings, top_k=top_k,
+                                                               nprobe=len(ann["centroids"]), candidates=len(index["chunks"]))]
+    return {
+        "top_k": top_k,
+        "nlist": len(ann["centroids"]),
+        "build_seconds": build_seconds,
+        "exact_semantic_seconds": exact_seconds,
+        "semantic_by_nprobe": semantic,
+        "semantic_full_probe_recall": full_semantic_recall,
+        "fused": {
+            "nprobe": ANN_NPROBE,
+            "candidates": ANN_CANDIDATES,
+            "recall": topk_recall(brute_fused, ann_fused),
+            "exact_path_agreement": topk_recall(exact_path, ann_fused),
+            "empty_contexts": sum(1 for rows in ann_fused if not len(rows)),
+            "exact_path_seconds": exact_path_seconds,
+            "ann_seconds": ann_fused_seconds
+        }
+    }
+
+def bench_retrieval_workers(args):
+    '''
+    Measures the speedup curve of multi-process retrieval scoring: iter_tasks over the SOP
+    statements with a RetrievalPool of every worker count in args.workers, against a single
+    process, with statement embeddings cached.
+
+    - The SOP statements are repeated as numbered variants up to args.worker_statements (default:
+      two full RETRIEVAL_BATCH_SIZE blocks per worker at the largest worker count), so every
+      worker count scores several blocks per worker.
+    - cold_seconds includes starting the worker processes and attaching the shared index.
+    - seconds is a second run on the started pool; the speedup is computed from it.
+    Every run must start the pool and return exactly the tasks of the single-process run.
+    '''
+    index = load_retrieval_index()
+    base = load_sop_statements()
+    count = args.worker_statements or 2 * max(args.workers + [1]) * RETRIEVAL_BATCH_SIZE
+    statements = [f"{statement} (variant {copy})" for copy in range(-(-count // len(base))) for statement in base][:count]
+    # Warm the embedding cache, so only scoring is timed.
+    list(iter_tasks(index, statements))
+    reference, single_seconds = timed(lambda: list(iter_tasks(index, statements)))
+    curve = {"1": {"cold_seconds": single_seconds, "seconds": single_seconds, "speedup": 1.0, "identical": True}}
+    for workers in args.workers:
+        if workers <= 1:
+            continue
+        with RetrievalPool(index, workers) as pool:
+            cold_tasks, cold_seconds = timed(lambda: list(iter_tasks(index, statements, pool=pool)))
+            # Runs that fit one block are scored in-process; that would time a single process.
+            if pool.executor is None:
+                raise SystemExit(f"{len(statements)} statements did not start {workers} retrieval workers; raise --worker-statements.")
+            tasks, seconds = timed(lambda: list(iter_tasks(index, statements, pool=pool)))
+        identical = tasks == reference and cold_tasks == reference
+        curve[str(workers)] = {"cold_seconds": cold_seconds, "seconds": seconds,
+                               "speedup": single_seconds / seconds, "identical": identical}
+        if not identical:
+            print(f"Warning: retrieval with {workers} workers differs from single-process retrieval.")
+    return {"statements": len(statements), "ann": index.get("ann") is not None, "by_workers": curve}
+
+def bench_api(args, tasks):
+    '''
+    Measures end-to-end throughput of call_claude_on_tasks against the local mock server,
+    with the client rate limits set to the mock server's.
+    '''
+    server = MockClaudeServer(
+        port=args.port, latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate,
+        requests_per_minute=args.requests_per_minute, tokens_per_minute=args.tokens_per_minute,
+        output_tokens=args.output_tokens, seed=args.seed
+    ).start()
+    # Point the client at the mock server; replies must not come from the response cache.
+    claude_client.CLAUDE_API_URL = server.url
+    claude_client.API_REQUESTS_PER_MINUTE = args.requests_per_minute or API_REQUESTS_PER_MINUTE
+    claude_client.API_TOKENS_PER_MINUTE = args.tokens_per_minute or API_TOKENS_PER_MINUTE
+    call_claude_api.USE_RESPONSE_CACHE = False
+    tasks = tasks[:args.api_tasks] if args.api_tasks else tasks
+    before = metrics.snapshot()["counters"]
+    try:
+        results, seconds = timed(call_claude_on_tasks, tasks)
+    finally:
+        server.stop()
+    after = metrics.snapshot()["counters"]
+    latency = metrics.snapshot()["histograms"].get("api_request_latency_seconds", {})
+    return {
+        "tasks": len(tasks),
+        "seconds": seconds,
+        "tasks_per_second": len(tasks) / seconds if seconds else None,
+        "errors": sum(1 for result, _ in results if result["discrepancies_and_improvement"].startswith("Error: ")),
+        "client": {name: value - before.get(name, 0) for name, value in after.items() if name.startswith("api_")},
+        "mean_request_latency_seconds": latency.get("mean"),
+        "server": dict(server.stats),
+        "settings": {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "throttle_rate": args.throttle_rate,
+            "requests_per_minute": args.requests_per_minute,
+            "tokens_per_minute": args.tokens_per_minute,
+            "output_tokens": args.output_tokens
+        }
+    }
+
+def flatten(results, prefix=""):
+    '''
+    Flattens nested result dictionaries into {"a.b.c": number}.
+    '''
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare_results(old, new):
+    '''
+    Prints every timing, throughput and recall figure of two result files side by side.
+    '''
+    old_flat = flatten(old["results"])
+    new_flat = flatten(new["results"])
+    print(f"{'metric':60} {'old':>12} {'new':>12} {'new/old':>8}")
+    for name in sorted(set(old_flat) & set(new_flat)):
+        if not name.endswith(("seconds", "per_second", "recall")):
+            continue
+        ratio = new_flat[name] / old_flat[name] if old_flat[name] else float("nan")
+        print(f"{name:60} {old_flat[name]:12.4f} {new_flat[name]:12.4f} {ratio:8.2f}")
+
+def run_benchmarks(args):
+    '''
+    Runs the selected benchmarks in a scratch directory and returns the result document.
+    All paths in config.py are relative, so the benchmark corpus, caches and reports stay there.
+    '''
+    results = {}
+    os.makedirs(args.workdir, exist_ok=True)
+    previous_dir = os.getcwd()
+    os.chdir(args.workdir)
+    try:
+        results["ingest"] = bench_ingest(args)
+        results["load"] = bench_load(args.repeats)
+        results["tasks"], tasks = bench_tasks(args)
+        if not args.skip_recall:
+            results["recall"] = bench_recall(args)
+        if not args.skip_workers:
+            results["retrieval_workers"] = bench_retrieval_workers(args)
+        if not args.skip_api:
+            results["api"] = bench_api(args, tasks)
+    finally:
+        os.chdir(previous_dir)
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git": git_revision(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "embedding_model": EMBEDDING_MODEL_NAME,
+            "embedding_backend": EMBEDDING_BACKEND
+        },
+        "scale": {
+            "pdfs": args.pdfs,
+            "pages_per_pdf": args.pages,
+            "sentences_per_page": args.sentences_per_page,
+            "statements": args.statements,
+            "seed": args.seed
+        },
+        "results": results,
+        "stages": metrics.snapshot()["stages"]
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark ingest, retrieval and API throughput on synthetic data.")
+    parser.add_argument("--pdfs", type=int, default=20, help="Synthetic regulatory PDFs.")
+    parser.add_argument("--pages", type=int, default=10, help="Pages per PDF.")
+    parser.add_argument("--sentences-per-page", type=int, default=40)
+    parser.add_argument("--statements", type=int, default=200, help="SOP statements.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=5, help="Repeats of the load timings (median is reported).")
+    parser.add_argument("--top-k", type=int, default=CHUNK_TOP_K, help="k of the recall measurement.")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 32, 64], help="nprobe values for semantic recall.")
+    parser.add_argument("--api-tasks", type=int, default=None, help="Tasks sent to the mock API (default: all).")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the mock Claude server.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mock API latency in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--throttle-rate", type=float, default=0.02, help="Share of requests answered with a random 429.")
+    parser.add_argument("--requests-per-minute", type=int, default=1000, help="Mock server and client request limit.")
+    parser.add_argument("--tokens-per-minute", type=int, default=400000, help="Mock server and client token limit.")
+    parser.add_argument("--output-tokens", type=int, default=50)
+    parser.add_argument("--skip-recall", action="store_true")
+    parser.add_argument("--workers", type=int, nargs="+", default=None,
+                        help="Retrieval worker counts of the speedup curve (default: powers of two up to the CPU count).")
+    parser.add_argument("--worker-statements", type=int, default=None,
+                        help="SOP statements of the retrieval worker benchmark (default: two full blocks per worker).")
+    parser.add_argument("--skip-workers", action="store_true")
+    parser.add_argument("--skip-api", action="store_true")
+    parser.add_argument("--workdir", default=None, help="Scratch directory (default: a temporary one, removed afterwards).")
+    parser.add_argument("--output", default=None, help=f"Result JSON path (default: {RESULTS_DIR}/<time>_<commit>.json).")
+    parser.add_argument("--compare", metavar="RESULT_JSON", default=None, help="Earlier result file to compare with.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    # Example, a larger corpus without the API benchmark:
+    #     python benchmarks/run_benchmarks.py --pdfs 100 --pages 20 --skip-api
+    args = parse_args()
+    if args.workers is None:
+        args.workers = [2 ** power for power in range(1, (os.cpu_count() or 1).bit_length())]
+    keep_workdir = args.workdir is not None
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="rcc_bench_"))
+    try:
+        document = run_benchmarks(args)
+    finally:
+        if not keep_workdir:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    output = args.output
+    if output is None:
+        commit = (document["git"]["commit"] or "unknown")[:8]
+        output = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}_{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(document, f, indent=2)
+    print(json.dumps(document["results"], indent=2))
+    print(f"Benchmark results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), document)
@@ -0,0 +1,133 @@
+import os
+import random
+import docx
+
+# Building blocks of the synthetic regulatory sentences. Subjects, actions and objects are
+# combined at random, so chunks share vocabulary the way real guidance documents do.
+SUBJECTS = [
+    "The manufacturer", "The sponsor", "The quality unit", "The responsible person", "Each operator",
+    "The laboratory", "The contract facility", "The site manager", "The distributor", "The investigator"
+]
+ACTIONS = [
+    "shall document", "shall verify", "must validate", "shall review", "must record", "shall calibrate",
+    "must investigate", "shall approve", "shall retain", "must monitor", "shall qualify", "must report"
+]
+OBJECTS = [
+    "every batch record", "the cleaning procedure", "all temperature excursions", "the sterilization cycle",
+    "each deviation", "the stability data", "the equipment logbook", "all raw material certificates",
+    "the environmental monitoring results", "each change control", "the training records",
+    "the label reconciliation", "the water system", "the filling line", "the packaging components",
+    "the analytical method", "the supplier audit", "the complaint file", "the recall procedure",
+    "the valve maintenance schedule"
+]
+CONDITIONS = [
+    "before release of the product", "within thirty days", "at least once per year", "after every maintenance",
+    "in accordance with the approved protocol", "prior to first use", "whenever a limit is exceeded",
+    "under the supervision of qualified staff", "for the lifetime of the product", "at each shift change",
+    "using calibrated instruments", "before the next production run"
+]
+# Words that turn a regulatory sentence into an SOP-style instruction.
+SOP_PREFIXES = ["Operators", "Staff", "The team", "Technicians", "Supervisors", "Analysts"]
+SOP_VERBS = ["document", "check", "review", "record", "verify", "sign off", "inspect", "log"]
+
+
+def regulatory_sentence(rng):
+    '''
+    Returns one random regulatory requirement sentence.
+    '''
+    return f"{rng.choice(SUBJECTS)} {rng.choice(ACTIONS)} {rng.choice(OBJECTS)} {rng.choice(CONDITIONS)}."
+
+def sop_statement(rng):
+    '''
+    Returns one random SOP statement, phrased like an instruction to staff.
+    '''
+    return (
+        f"{rng.choice(SOP_PREFIXES)} {rng.choice(SOP_VERBS)} {rng.choice(OBJECTS)} "
+        f"{rng.choice(CONDITIONS)} and keep the evidence in {rng.choice(OBJECTS)}."
+    )
+
+def escape_pdf_text(text):
+    '''
+    Escapes a string for a PDF literal string.
+    '''
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_pdf(path, pages):
+    '''
+    Writes a minimal PDF with one line of Helvetica text per string of every page.
+
+    Parameters:
+    - path: Output file.
+    - pages: A list of pages, each a list of text lines.
+    '''
+    objects = []
+    page_ids = []
+    # Object 1 is the catalog, 2 the page tree, 3 the font; pages and their contents follow.
+    font_id = 3
+    next_id = 4
+    for lines in pages:
+        content = ["BT", "/F1 7 Tf", "9 TL", "36 760 Td"]
+        content.extend(f"({escape_pdf_text(line)}) Tj T*" for line in lines)
+        content.append("ET")
+        stream = "\n".join(content).encode("latin-1", "replace")
+        page_id, content_id = next_id, next_id + 1
+        next_id += 2
+        page_ids.append(page_id)
+        objects.append((page_id, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode("latin-1")))
+        objects.append((content_id, b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream"))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[:0] = [
+        (1, b"<< /Type /Catalog /Pages 2 0 R >>"),
+        (2, f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode("latin-1")),
+        (font_id, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    ]
+
+    # Write the objects, remembering their byte offsets for the cross-reference table.
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id, body in objects:
+        offsets[object_id] = len(data)
+        data += b"%d 0 obj\n" % object_id + body + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for object_id in range(1, len(objects) + 1):
+        data += b"%010d 00000 n \n" % offsets[object_id]
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def generate_regulatory_pdfs(out_dir, num_pdfs, pages_per_pdf, sentences_per_page, seed=0):
+    '''
+    Writes num_pdfs synthetic regulatory PDFs into out_dir.
+
+    Every PDF gets its own random stream, so regenerating one file with the same seed
+    reproduces it exactly and changing the seed of one file changes only that file.
+
+    Returns:
+    - The list of written PDF paths.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for i in range(num_pdfs):
+        rng = random.Random(f"{seed}-{i}")
+        pages = [[regulatory_sentence(rng) for _ in range(sentences_per_page)] for _ in range(pages_per_pdf)]
+        path = os.path.join(out_dir, f"regulation_{i:04d}.pdf")
+        write_pdf(path, pages)
+        paths.append(path)
+    return paths
+
+def generate_sop_docx(path, num_statements, seed=0):
+    '''
+    Writes a synthetic SOP DOCX with num_statements statements, a few per paragraph.
+    '''
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    rng = random.Random(f"sop-{seed}")
+    document = docx.Document()
+    statements = [sop_statement(rng) for _ in range(num_statements)]
+    for start in range(0, len(statements), 4):
+        document.add_paragraph(" ".join(statements[start:start + 4]))
+    document.save(path)
+    return path
@@ -1,43 +1,31 @@
-import requests
+import atexit
+import asyncio
 from config import *
+from response_cache import ResponseCache
+from metrics import metrics
 
+# Response cache shared by all comparisons in this process, opened on first use.
+response_cache = None
 
-def call_claude_api(prompt):
+
+def get_response_cache():
     '''
-    Sends a POST request to the Claude API with a given prompt and returns the API response text.
+    Returns the process-wide response cache, or None when USE_RESPONSE_CACHE is off.
     '''
-    # Define HTTP headers including the API key, version, and content type.
-    headers = {
-        "x-api-key": CLAUDE_API_KEY,
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json"
-    }
-
-    # Construct the data payload with model details, max token limit, and the message content.
-    data = {
-        "model": "claude-3-5-haiku-20241022",
-        "max_tokens": 500,
-        "messages": [{"role": "user", "content": prompt}]
-    }
+    global response_cache
+    if USE_RESPONSE_CACHE and response_cache is None:
+        response_cache = ResponseCache()
+        # Pending last-used times of cache hits are written when the process exits.
+        atexit.register(response_cache.close)
+    return response_cache
 
-    # Send a POST request to the Claude API endpoint.
-    response = requests.post(CLAUDE_API_URL, json=data, headers=headers)
-    if response.status_code == 200:
-        response_json = response.json()
-        if "content" in response_json and isinstance(response_json["content"], list):
-            assistant_reply = response_json["content"][0].get("text", "")
-            return assistant_reply.strip()
-    else:
-        print(f"Claude API error: {response.status_code} {response.text}")
-        return ""
 
 # DO NOT CHANGE THE FOLLOWING PROMPT
-def compare_with_claude(sop_statement, regulatory_context):
+def build_comparison_prompt(sop_statement, regulatory_context):
     '''
-    Compares an SOP statement with its regulatory context by sending both to the Claude API.
-    Returns a tuple containing the result dictionary and a flag indicating if a discrepancy was found.
+    Builds the prompt instructing the API to analyze discrepancies between an SOP statement
+    and its regulatory context and to suggest improvements.
     '''
-    # Construct a detailed prompt instructing the API to analyze discrepancies and suggest improvements.
     prompt = (
         "Analyze the following SOP statement and its related regulatory context. "
         "Identify any discrepancies between the SOP and regulatory requirements, and suggest improvements."
@@ -50,11 +38,19 @@ def compare_with_claude(sop_statement, regulatory_context):
         "If you found any contradiction, list them and suggest imporvement for them in detail"
         "If you have not found any contradiction, or statement and context is irrelevant, only respond 'NO DISCREPANCY', and nothing else other than these two words."
     )
+    return prompt
 
-    # Call the API with the constructed prompt.
-    result_text = call_claude_api(prompt)
+def has_discrepancy(result_text):
+    '''
+    Returns True if an API response reports a discrepancy, i.e. does not contain "no discrepancy" (ignoring case).
+    '''
+    return "no discrepancy" not in result_text.lower()
 
-    # Build the result dictionary containing the input texts and the API response.
+def build_comparison_result(sop_statement, regulatory_context, result_text):
+    '''
+    Builds the result dictionary containing the input texts and the API response.
+    Returns a tuple containing the result dictionary and a flag indicating if a discrepancy was found.
+    '''
     result = {
         "sop_statement": sop_statement,
         "regulatory_context": regulatory_context,
@@ -62,5 +58,25 @@ def compare_with_claude(sop_statement, regulatory_context):
     }
     
     # Set flag to True if the API response does not contain "no discrepancy" (ignoring case).
-    found_dis = not ("no discrepancy" in result_text.lower())
+    found_dis = has_discrepancy(result_text)
     return result, found_dis
+
+async def compare_with_claude_async(client, sop_statement, regulatory_context):
+    '''
+    Compares an SOP statement with its regulatory context by sending both to the Claude API
+    through a shared AsyncClaudeClient, which handles retries, rate limits and API metrics.
+    Replies are looked up in the response cache first and stored there after a successful call;
+    both SQLite calls run in a worker thread, so they never block the event loop.
+    Returns a tuple containing the result dictionary and a flag indicating if a discrepancy was found.
+    '''
+    prompt = build_comparison_prompt(sop_statement, regulatory_context)
+    cache = get_response_cache()
+    # Identical prompts give identical requests, so a cached reply is reused.
+    result_text = await asyncio.to_thread(cache.get, prompt) if cache else None
+    if cache:
+        metrics.count("response_cache_total", result="miss" if result_text is None else "hit")
+    if result_text is None:
+        result_text = await client.complete(prompt)
+        if cache:
+            await asyncio.to_thread(cache.put, prompt, result_text)
+    return build_comparison_result(sop_statement, regulatory_context, result_text)
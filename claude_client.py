@@ -0,0 +1,278 @@
+import time
+import random
+import asyncio
+import aiohttp
+from config import *
+from metrics import metrics
+
+# HTTP statuses worth retrying: rate limiting, overload and transient server errors.
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504, 529}
+
+
+class ClaudeAPIError(Exception):
+    '''
+    Raised when the Claude API does not return a usable reply, after all retries.
+    '''
+
+
+def build_headers():
+    '''
+    Returns the HTTP headers for the Claude API, including the API key and version.
+    '''
+    return {
+        "x-api-key": CLAUDE_API_KEY,
+        "anthropic-version": "2023-06-01",
+        "content-type": "application/json"
+    }
+
+def build_payload(prompt):
+    '''
+    Returns the request payload with model details, max token limit, and the message content.
+    '''
+    return {
+        "model": CLAUDE_MODEL,
+        "max_tokens": CLAUDE_MAX_TOKENS,
+        "messages": [{"role": "user", "content": prompt}]
+    }
+
+def parse_reply(response_json):
+    '''
+    Extracts the assistant reply text from a Claude API response.
+
+    Raises:
+    - ClaudeAPIError if the response has no text content.
+    '''
+    content = response_json.get("content")
+    if isinstance(content, list) and content and "text" in content[0]:
+        return content[0]["text"].strip()
+    raise ClaudeAPIError(f"Claude API response without text content: {response_json}")
+
+def estimate_tokens(prompt):
+    '''
+    Estimates the tokens a request will use: about four characters per input token,
+    plus the full output budget.
+    '''
+    return len(prompt) // 4 + CLAUDE_MAX_TOKENS
+
+def parse_retry_after(value):
+    '''
+    Parses a retry-after header given in seconds. Returns None if it is missing or not numeric.
+    '''
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+def retry_delay(attempt, retry_after=None):
+    '''
+    Returns the seconds to wait before retry number attempt (starting at 0).
+    A server-provided retry-after wins; otherwise exponential backoff with jitter.
+    '''
+    if retry_after is not None:
+        return retry_after
+    delay = min(API_BACKOFF_MAX, API_BACKOFF_BASE * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class TokenBucket:
+    '''
+    Asyncio token bucket refilled continuously at rate_per_minute, holding at most one minute of budget.
+    Waiters are served in arrival order.
+    '''
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        '''
+        Waits until amount tokens are available and takes them.
+        '''
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self.refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= amount
+
+    def adjust(self, amount):
+        '''
+        Returns (positive amount) or charges (negative amount) tokens after the real cost is known.
+        '''
+        self.refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdaptiveConcurrency:
+    '''
+    Concurrency limit that adapts to the API: it grows by one slot after a window of fast
+    successful requests and halves when the API answers 429, at most once per cooldown.
+    '''
+
+    def __init__(self, initial=API_INITIAL_CONCURRENCY, minimum=API_MIN_CONCURRENCY, maximum=API_MAX_CONCURRENCY):
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.successes = 0
+        self.best_latency = None
+        self.avg_latency = None
+        self.last_decrease = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def on_success(self, latency):
+        '''
+        Records a successful request. The limit grows while latency stays close to the best seen,
+        i.e. while more parallel requests are not just queueing at the server.
+        '''
+        self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+        self.avg_latency = latency if self.avg_latency is None else 0.8 * self.avg_latency + 0.2 * latency
+        self.successes += 1
+        if self.successes >= self.limit and self.avg_latency <= API_LATENCY_TOLERANCE * self.best_latency:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.successes = 0
+
+    async def on_throttle(self):
+        '''
+        Records a 429 response: halves the limit, once per cooldown so a burst of 429s from
+        requests already in flight counts as one signal.
+        '''
+        now = time.monotonic()
+        cooldown = self.avg_latency or API_BACKOFF_BASE
+        if now - self.last_decrease < cooldown:
+            return
+        self.last_decrease = now
+        self.successes = 0
+        async with self.condition:
+            self.limit = max(self.minimum, self.limit // 2)
+
+
+class AsyncClaudeClient:
+    '''
+    Asyncio Claude API client with a pooled keep-alive connection, request and token rate limits,
+    adaptive concurrency, and retries with backoff that honor retry-after.
+
+    Use as an async context manager:
+        async with AsyncClaudeClient() as client:
+            reply = await client.complete(prompt)
+    '''
+
+    def __init__(self, initial_concurrency=API_INITIAL_CONCURRENCY):
+        self.concurrency = AdaptiveConcurrency(initial=initial_concurrency)
+        self.request_bucket = TokenBucket(API_REQUESTS_PER_MINUTE)
+        self.token_bucket = TokenBucket(API_TOKENS_PER_MINUTE)
+        self.resume_at = 0.0
+        self.session = None
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "failures": 0}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=API_MAX_CONCURRENCY, keepalive_timeout=API_KEEPALIVE_TIMEOUT)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=build_headers(),
+            timeout=aiohttp.ClientTimeout(total=API_TIMEOUT)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+
+    async def wait_for_resume(self):
+        '''
+        Waits out a pause requested by the server through retry-after, shared by all requests.
+        '''
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def send(self, prompt):
+        '''
+        Sends one request once the rate limits and the concurrency limit allow it.
+
+        Returns:
+        - A tuple (status, response JSON or None, retry-after seconds or None).
+        '''
+        queued = time.monotonic()
+        await self.wait_for_resume()
+        await self.request_bucket.acquire(1)
+        estimate = estimate_tokens(prompt)
+        await self.token_bucket.acquire(estimate)
+        await self.concurrency.acquire()
+        started = time.monotonic()
+        metrics.observe("api_queue_wait_seconds", started - queued)
+        try:
+            self.stats["requests"] += 1
+            async with self.session.post(CLAUDE_API_URL, json=build_payload(prompt)) as response:
+                retry_after = parse_retry_after(response.headers.get("retry-after"))
+                body = await response.json(content_type=None) if response.status == 200 else None
+                if response.status != 200:
+                    print(f"Claude API error: {response.status} {await response.text()}")
+                status = response.status
+        finally:
+            await self.concurrency.release()
+        latency = time.monotonic() - started
+        metrics.observe("api_request_latency_seconds", latency)
+        metrics.count("api_requests_total", status=status)
+
+        if status == 200:
+            self.concurrency.on_success(latency)
+            # Settle the token budget with the usage the API reports.
+            usage = (body or {}).get("usage", {})
+            used = usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+            metrics.count("api_tokens_total", usage.get("input_tokens", 0), kind="input")
+            metrics.count("api_tokens_total", usage.get("output_tokens", 0), kind="output")
+            if used:
+                self.token_bucket.adjust(estimate - used)
+        elif status == 429:
+            self.stats["throttled"] += 1
+            await self.concurrency.on_throttle()
+            if retry_after is not None:
+                self.resume_at = max(self.resume_at, time.monotonic() + retry_after)
+        return status, body, retry_after
+
+    async def complete(self, prompt):
+        '''
+        Sends a prompt to the Claude API and returns the reply text, retrying transient failures.
+
+        Raises:
+        - ClaudeAPIError once API_MAX_RETRIES retries are exhausted or on a non-retryable error.
+        '''
+        last_error = None
+        for attempt in range(API_MAX_RETRIES + 1):
+            retry_after = None
+            try:
+                status, body, retry_after = await self.send(prompt)
+                if status == 200:
+                    return parse_reply(body)
+                last_error = f"HTTP {status}"
+                if status not in RETRYABLE_STATUSES:
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = f"{type(e).__name__}: {e}"
+                metrics.count("api_requests_total", status=type(e).__name__)
+            if attempt < API_MAX_RETRIES:
+                self.stats["retries"] += 1
+                metrics.count("api_retries_total")
+                await asyncio.sleep(retry_delay(attempt, retry_after))
+        self.stats["failures"] += 1
+        metrics.count("api_failures_total")
+        raise ClaudeAPIError(f"Claude API request failed after {attempt + 1} attempts: {last_error}")
@@ -6,22 +6,95 @@ import os
 REGULATORY_DOCS_DIR = "./data/regulations"  # folder containing regulatory PDFs
 SOP_DOC_PATH = "./data/sop/original.docx"                # path to SOP document (DOCX)
 PROCESSED_DIR = "processed_docs"              # folder to store processed PDFs
+CORPUS_DIR = os.path.join(PROCESSED_DIR, "corpus")  # memory-mapped store of chunk texts, embeddings and keywords
+TFIDF_DIR = os.path.join(PROCESSED_DIR, "tfidf")  # corpus TF-IDF model fitted over all regulatory chunks
+EMBEDDING_CACHE_DIR = os.path.join(PROCESSED_DIR, "embedding_cache")  # text-hash -> embedding cache, per model
+ANN_DIR = os.path.join(PROCESSED_DIR, "ann")  # approximate nearest-neighbour (IVF) index over the chunk embeddings
+EMBEDDING_CACHE_MAX_ENTRIES = 1000000  # oldest cached embeddings are dropped beyond this size
+EMBEDDING_CACHE_TRIM_RATIO = 0.9  # share of EMBEDDING_CACHE_MAX_ENTRIES kept when a full cache is trimmed, so later saves append again
 EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_DTYPE = "float32"  # storage type of chunk embeddings ("float32" or "float16" to halve disk and page cache; float16 is upcast in chunks on every exact scoring block, which costs extra CPU)
 CHUNK_SIZE = 7      # number of sentences per chunk
 OVERLAP = 1         # overlapping sentences per chunk
 REPROCESS_DOCS = True
+INGEST_WORKERS = None  # processes for PDF extraction and chunking (None = all CPU cores, 1 = no pool)
+INGEST_PAGES_PER_TASK = 25  # pages extracted per worker task, so large PDFs are split across workers
+EMBEDDING_BATCH_SIZE = 128  # maximum texts per embedding batch
+EMBEDDING_BATCH_TOKENS = 16384  # maximum padded tokens per embedding batch; texts of similar token length are batched together
+EMBEDDING_BACKEND = "torch"  # "torch" (fp32), "torch-int8" (dynamic int8 quantization on CPU) or "onnx-int8" (needs optimum[onnxruntime])
+EMBEDDING_ONNX_DIR = os.path.join(PROCESSED_DIR, "onnx_models")  # int8 ONNX exports of the embedding model
+EMBEDDING_ONNX_CONFIG = "avx2"  # CPU target of the int8 ONNX export: "arm64", "avx2", "avx512" or "avx512_vnni"
+EMBEDDING_PARITY_MIN_COSINE = 0.98  # minimum cosine to the fp32 embedding for a backend to pass the parity check
 
 RESULT_DIR = "result"  # Define the directory where reports should be saved
 REPORT_OUTPUT_PATH = os.path.join(RESULT_DIR, "report.json")
 ERROR_OUTPUT_PATH = os.path.join(RESULT_DIR, "error.json")
+METRICS_ENABLED = True  # collect per-stage timings, counters and API latency histograms
+METRICS_JSON_PATH = os.path.join(RESULT_DIR, "metrics.json")
+METRICS_PROMETHEUS_PATH = os.path.join(RESULT_DIR, "metrics.prom")  # Prometheus text format, e.g. for the node_exporter textfile collector
+PROFILE_STAGES = []  # stages to run under cProfile, e.g. ["retrieval.score", "ingest.encode"]
+PROFILE_DIR = os.path.join(RESULT_DIR, "profiles")  # <stage>.prof files, readable with pstats or snakeviz
+BATCH_RESULT_DIR = os.path.join(RESULT_DIR, "batch")  # per-SOP report folders and summary.json of batch runs (main.py --batch)
+STREAMING_MODE = True  # stream tasks to the API as they are retrieved and append results as they complete
+REPORT_JSONL_PATH = os.path.join(RESULT_DIR, "report.jsonl")  # results appended one per line in streaming mode
+CHECKPOINT_PATH = os.path.join(RESULT_DIR, "checkpoint.json")  # lets an interrupted streaming run resume
+STREAM_BATCH_SIZE = 32  # SOP statements retrieved per block in streaming mode, so the first API calls start early
+STREAM_MAX_PENDING = 64  # tasks queued or in flight at once in streaming mode
+MIN_RELEVANCE_SCORE = 0.0  # tasks whose best fused retrieval score is below this are skipped without an API call (0 keeps all)
+DEDUP_TASKS = True  # send identical (statement, context) tasks once and copy the reply to every duplicate
 CHUNK_TOP_K = 3  # Number of top regulatory chunks to retrieve per SOP statement
+RETRIEVAL_BATCH_SIZE = 256  # SOP statements scored together in one matrix product
+SCORE_ROW_TILE = 32  # statement rows per matrix product tile; blocks are zero-padded to it so scores do not depend on block size
+RETRIEVAL_MIN_BLOCK_SIZE = 32  # smallest block of SOP statements sent to a retrieval worker
+RETRIEVAL_WORKERS = 1  # processes scoring blocks of SOP statements against a shared-memory index (None = all CPU cores, 1 = no pool)
+USE_ANN_INDEX = True  # fetch global semantic candidates from the IVF index, then re-rank them with TF-IDF and keywords
+ANN_MIN_CHUNKS = 20000  # corpora with fewer chunks are scored exactly against every chunk
+ANN_NLIST = None  # number of IVF lists (k-means centroids); None uses about sqrt(number of chunks)
+ANN_NPROBE = 32  # lists scanned per statement: higher is slower with better recall
+ANN_CANDIDATES = 200  # semantic candidates per statement passed on to re-ranking
+ANN_KMEANS_ITERATIONS = 20  # k-means iterations when building the index
+ANN_TRAIN_SAMPLE = 100000  # chunks sampled to train the centroids
 CLAUDE_API_KEY = "Your Claude API Key"
 CLAUDE_API_URL = "https://api.anthropic.com/v1/messages"
+CLAUDE_MODEL = "claude-3-5-haiku-20241022"
+CLAUDE_MAX_TOKENS = 500
+
+# Claude API client: rate limits of your API tier, retries and concurrency bounds.
+API_REQUESTS_PER_MINUTE = 50
+API_TOKENS_PER_MINUTE = 50000  # input + output tokens
+API_MAX_RETRIES = 6
+API_TIMEOUT = 120  # seconds per request
+API_BACKOFF_BASE = 1.0  # seconds; doubled on every retry unless the API sends retry-after
+API_BACKOFF_MAX = 60.0
+API_INITIAL_CONCURRENCY = 5
+API_MIN_CONCURRENCY = 1
+API_MAX_CONCURRENCY = 32
+API_LATENCY_TOLERANCE = 1.5  # concurrency only grows while average latency stays within this factor of the best
+API_KEEPALIVE_TIMEOUT = 60  # seconds an idle pooled connection is kept open
+
+# Local service mode (main.py --serve): the model and regulatory index stay loaded between checks.
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8080
+SERVER_UNIX_SOCKET = None  # path of a Unix socket to listen on instead of SERVER_HOST:SERVER_PORT
+SERVER_EMBEDDING_WORKERS = 1  # threads embedding and retrieving statements, shared by all requests
+SERVER_RELOAD_INTERVAL = 5  # seconds between checks of processed_docs; a changed corpus is reloaded
+SERVER_MAX_UPLOAD_MB = 20  # largest accepted request body (SOP text or DOCX)
+
+# Local cache of Claude replies keyed by model + max_tokens + prompt, so reruns skip unchanged statements.
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_PATH = os.path.join("cache", "responses.sqlite3")
+RESPONSE_CACHE_MAX_ENTRIES = 100000  # least recently used replies are evicted beyond this
+RESPONSE_CACHE_MAX_AGE_DAYS = 30  # replies older than this are refetched
+RESPONSE_CACHE_TOUCH_BATCH = 256  # cache hits whose last-used times are written to the database in one transaction
+RESPONSE_CACHE_EVICT_INTERVAL = 1000  # stored replies between evictions, so long-running processes stay within the limits
 
 # Weights for multiple similarity metrics (should sum to 1)
 ALPHA = 0.4  # weight for semantic similarity
 BETA = 0.4   # weight for TF-IDF similarity
 GAMMA = 0.2 # weight for keyword overlap
+# The ANN path adds keyword overlap with each candidate's document as a re-ranking bonus, where
+# exact scoring keeps only the chunks of the statement's top two documents.
+DELTA = 0.2  # weight for document keyword overlap (ANN path only)
 
 # Global parameter for minimum words in an SOP statement.
 MIN_SOP_WORDS = 15
@@ -0,0 +1,247 @@
+import os
+import json
+import shutil
+import numpy as np
+from config import *
+from utils import normalize_rows
+
+# Version of the on-disk corpus layout, bumped whenever the files below change.
+CORPUS_FORMAT_VERSION = 2
+
+# File names inside the corpus directory.
+MANIFEST_FILE = "manifest.json"
+EMBEDDINGS_FILE = "embeddings.bin"
+TEXTS_FILE = "texts.bin"
+TEXT_OFFSETS_FILE = "text_offsets.npy"
+KEYWORD_IDS_FILE = "chunk_keyword_ids.npy"
+KEYWORD_OFFSETS_FILE = "chunk_keyword_offsets.npy"
+KEYWORD_VOCAB_FILE = "keyword_vocab.json"
+TERM_IDS_FILE = "chunk_term_ids.npy"
+TERM_COUNTS_FILE = "chunk_term_counts.npy"
+TERM_OFFSETS_FILE = "chunk_term_offsets.npy"
+TERM_VOCAB_FILE = "term_vocab.json"
+
+
+class ChunkTexts:
+    '''
+    Read-only sequence of chunk texts backed by one memory-mapped UTF-8 blob and an offsets array.
+    Texts are decoded only when accessed.
+    '''
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chunk index out of range")
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return bytes(self.blob[start:end]).decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def write_corpus(docs, corpus_dir=CORPUS_DIR, dtype=EMBEDDING_DTYPE, ingest_params=None):
+    '''
+    Writes processed regulatory documents into the columnar corpus store.
+
+    Parameters:
+    - docs: Iterable of document dictionaries with source, chunks, embeddings, keywords,
+      chunk_keywords and chunk_terms. Documents are consumed one at a time, so the iterable can stream them.
+    - corpus_dir: Target directory. It is replaced atomically once every file is written.
+    - dtype: Storage type of the embedding matrix ("float32" or "float16").
+    - ingest_params: Parameters the documents were built with, recorded in the manifest.
+
+    Layout:
+    - embeddings.bin: contiguous (chunks x dim) matrix of L2-normalized embeddings.
+    - texts.bin / text_offsets.npy: all chunk texts as one UTF-8 blob and their byte offsets.
+    - chunk_keyword_ids.npy / chunk_keyword_offsets.npy / keyword_vocab.json: chunk keywords in CSR form.
+    - chunk_term_ids.npy / chunk_term_counts.npy / chunk_term_offsets.npy / term_vocab.json:
+      TF-IDF term counts of every chunk in CSR form, so the TF-IDF model is refitted without tokenizing.
+    - manifest.json: embedding shape and type, ingest parameters, and the row range,
+      keywords and content hash of every source.
+
+    Returns:
+    - The manifest dictionary.
+    '''
+    tmp_dir = corpus_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    documents = []
+    text_offsets = [0]
+    keyword_offsets = [0]
+    keyword_ids = []
+    vocabulary = {}
+    term_offsets = [0]
+    term_ids = []
+    term_counts = []
+    terms = {}
+    dim = None
+    num_chunks = 0
+    # Append every document to the flat files as it arrives.
+    with open(os.path.join(tmp_dir, EMBEDDINGS_FILE), "wb") as emb_file, \
+            open(os.path.join(tmp_dir, TEXTS_FILE), "wb") as text_file:
+        for doc in docs:
+            chunks = list(doc["chunks"])
+            if chunks:
+                embeddings = normalize_rows(doc["embeddings"])
+                if dim is None:
+                    dim = embeddings.shape[1]
+                elif embeddings.shape[1] != dim:
+                    raise ValueError(f"Embedding size mismatch for {doc['source']}: {embeddings.shape[1]} != {dim}")
+                emb_file.write(embeddings.astype(dtype).tobytes())
+                for chunk, chunk_keywords, chunk_terms in zip(chunks, doc["chunk_keywords"], doc["chunk_terms"]):
+                    encoded = chunk.encode("utf-8")
+                    text_file.write(encoded)
+                    text_offsets.append(text_offsets[-1] + len(encoded))
+                    keyword_ids.extend(vocabulary.setdefault(keyword, len(vocabulary)) for keyword in chunk_keywords)
+                    keyword_offsets.append(len(keyword_ids))
+                    term_ids.extend(terms.setdefault(term, len(terms)) for term in chunk_terms)
+                    term_counts.extend(chunk_terms.values())
+                    term_offsets.append(len(term_ids))
+            documents.append({
+                "source": doc["source"],
+                "start": num_chunks,
+                "end": num_chunks + len(chunks),
+                "keywords": list(doc["keywords"]),
+                "content_hash": doc.get("content_hash")
+            })
+            num_chunks += len(chunks)
+
+    np.save(os.path.join(tmp_dir, TEXT_OFFSETS_FILE), np.array(text_offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, KEYWORD_IDS_FILE), np.array(keyword_ids, dtype=np.int32))
+    np.save(os.path.join(tmp_dir, KEYWORD_OFFSETS_FILE), np.array(keyword_offsets, dtype=np.int64))
+    with open(os.path.join(tmp_dir, KEYWORD_VOCAB_FILE), "w") as f:
+        json.dump(sorted(vocabulary, key=vocabulary.get), f)
+    np.save(os.path.join(tmp_dir, TERM_IDS_FILE), np.array(term_ids, dtype=np.int32))
+    np.save(os.path.join(tmp_dir, TERM_COUNTS_FILE), np.array(term_counts, dtype=np.int32))
+    np.save(os.path.join(tmp_dir, TERM_OFFSETS_FILE), np.array(term_offsets, dtype=np.int64))
+    with open(os.path.join(tmp_dir, TERM_VOCAB_FILE), "w") as f:
+        json.dump(sorted(terms, key=terms.get), f)
+
+    manifest = {
+        "format_version": CORPUS_FORMAT_VERSION,
+        "num_chunks": num_chunks,
+        "dim": dim or 0,
+        "dtype": np.dtype(dtype).name,
+        "ingest_params": ingest_params or {},
+        "documents": documents
+    }
+    # The manifest is written last: a directory without it is incomplete.
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    # Swap the new corpus in. Readers holding memory maps of the old files keep working.
+    old_dir = corpus_dir + ".old"
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    if os.path.exists(corpus_dir):
+        os.replace(corpus_dir, old_dir)
+    os.replace(tmp_dir, corpus_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    return manifest
+
+def read_manifest(corpus_dir=CORPUS_DIR):
+    '''
+    Reads the corpus manifest.
+
+    Returns:
+    - The manifest dictionary, or None if no complete corpus exists.
+    '''
+    manifest_path = os.path.join(corpus_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != CORPUS_FORMAT_VERSION:
+        return None
+    return manifest
+
+def open_memmap(path, dtype, shape):
+    '''
+    Opens a read-only memory map, returning an empty array for empty files (which cannot be mapped).
+    '''
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+def load_corpus(corpus_dir=CORPUS_DIR):
+    '''
+    Opens the columnar corpus store without copying it into memory.
+
+    Returns:
+    - A dictionary with the sources, document row ranges, keywords and content hashes, the
+      ingest parameters, the memory-mapped
+      embedding matrix, the chunk texts, the chunk keywords in CSR form (keyword ids, offsets,
+      vocabulary) and the chunk TF-IDF term counts in CSR form (term ids, counts, offsets,
+      vocabulary). Returns None if no corpus has been written.
+    '''
+    manifest = read_manifest(corpus_dir)
+    if manifest is None:
+        return None
+    num_chunks = manifest["num_chunks"]
+    documents = manifest["documents"]
+
+    embeddings = open_memmap(os.path.join(corpus_dir, EMBEDDINGS_FILE), manifest["dtype"], (num_chunks, manifest["dim"]))
+    text_offsets = np.load(os.path.join(corpus_dir, TEXT_OFFSETS_FILE), mmap_mode="r")
+    blob = open_memmap(os.path.join(corpus_dir, TEXTS_FILE), np.uint8, (int(text_offsets[-1]),))
+    with open(os.path.join(corpus_dir, KEYWORD_VOCAB_FILE)) as f:
+        keyword_vocab = json.load(f)
+    with open(os.path.join(corpus_dir, TERM_VOCAB_FILE)) as f:
+        term_vocab = json.load(f)
+
+    return {
+        "sources": [doc["source"] for doc in documents],
+        "doc_ranges": np.array([(doc["start"], doc["end"]) for doc in documents], dtype=np.int64).reshape(-1, 2),
+        "doc_keywords": [doc["keywords"] for doc in documents],
+        "content_hashes": [doc.get("content_hash") for doc in documents],
+        "ingest_params": manifest.get("ingest_params", {}),
+        "embeddings": embeddings,
+        "chunks": ChunkTexts(blob, text_offsets),
+        "chunk_keyword_ids": np.load(os.path.join(corpus_dir, KEYWORD_IDS_FILE), mmap_mode="r"),
+        "chunk_keyword_offsets": np.load(os.path.join(corpus_dir, KEYWORD_OFFSETS_FILE), mmap_mode="r"),
+        "keyword_vocab": keyword_vocab,
+        "chunk_term_ids": np.load(os.path.join(corpus_dir, TERM_IDS_FILE), mmap_mode="r"),
+        "chunk_term_counts": np.load(os.path.join(corpus_dir, TERM_COUNTS_FILE), mmap_mode="r"),
+        "chunk_term_offsets": np.load(os.path.join(corpus_dir, TERM_OFFSETS_FILE), mmap_mode="r"),
+        "term_vocab": term_vocab
+    }
+
+def read_corpus_document(corpus, doc_id):
+    '''
+    Returns one document of a loaded corpus in the document dictionary format used by write_corpus.
+    Embeddings are a memory-mapped slice, so documents can be copied into a new corpus without
+    loading the whole matrix.
+    '''
+    start, end = corpus["doc_ranges"][doc_id]
+    vocab = corpus["keyword_vocab"]
+    ids = corpus["chunk_keyword_ids"]
+    offsets = corpus["chunk_keyword_offsets"]
+    term_vocab = corpus["term_vocab"]
+    term_ids = corpus["chunk_term_ids"]
+    term_counts = corpus["chunk_term_counts"]
+    term_offsets = corpus["chunk_term_offsets"]
+    return {
+        "source": corpus["sources"][doc_id],
+        "chunks": corpus["chunks"][start:end],
+        "embeddings": corpus["embeddings"][start:end],
+        "keywords": corpus["doc_keywords"][doc_id],
+        "chunk_keywords": [[vocab[k] for k in ids[offsets[row]:offsets[row + 1]]] for row in range(start, end)],
+        "chunk_terms": [
+            dict(zip((term_vocab[t] for t in term_ids[term_offsets[row]:term_offsets[row + 1]]),
+                     term_counts[term_offsets[row]:term_offsets[row + 1]].tolist()))
+            for row in range(start, end)
+        ]
+    }
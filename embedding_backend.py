@@ -0,0 +1,165 @@
+import os
+import argparse
+import numpy as np
+from tqdm import tqdm
+from config import *
+from utils import normalize_rows
+
+# Supported embedding backends:
+# - "torch": the SentenceTransformer model in fp32.
+# - "torch-int8": the same model with its linear layers dynamically quantized to int8 (CPU).
+# - "onnx-int8": a dynamically quantized ONNX export run by ONNX Runtime (needs optimum[onnxruntime]).
+EMBEDDING_BACKENDS = ("torch", "torch-int8", "onnx-int8")
+
+
+def embedding_model_id(model_name=EMBEDDING_MODEL_NAME, backend=EMBEDDING_BACKEND):
+    '''
+    Returns the identifier of the vectors a model and backend produce, used to key embedding
+    caches and corpora: the plain model name for the fp32 backend, the model name with an
+    "@backend" suffix otherwise.
+    '''
+    return model_name if backend == "torch" else f"{model_name}@{backend}"
+
+def load_embedding_model(model_name=EMBEDDING_MODEL_NAME, backend=EMBEDDING_BACKEND):
+    '''
+    Loads a SentenceTransformer model with the given backend.
+
+    Raises:
+    - ValueError for an unknown backend.
+    - ImportError if the onnx-int8 backend is selected without optimum[onnxruntime] installed.
+    '''
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown EMBEDDING_BACKEND {backend!r}, expected one of {', '.join(EMBEDDING_BACKENDS)}")
+    from sentence_transformers import SentenceTransformer
+    if backend == "onnx-int8":
+        return load_onnx_int8_model(model_name)
+
+    if backend == "torch-int8":
+        import torch
+        # Dynamic quantization stores linear weights as int8 and quantizes activations on the fly.
+        model = SentenceTransformer(model_name, device="cpu")
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return SentenceTransformer(model_name)
+
+def load_onnx_int8_model(model_name, onnx_dir=EMBEDDING_ONNX_DIR, config_name=EMBEDDING_ONNX_CONFIG):
+    '''
+    Loads the int8 ONNX export of a model, exporting and quantizing it into onnx_dir on first use.
+    '''
+    try:
+        from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+        import optimum.onnxruntime
+    except ImportError as e:
+        raise ImportError("The onnx-int8 embedding backend needs optimum[onnxruntime]: pip install optimum[onnxruntime]") from e
+
+    model_dir = os.path.join(onnx_dir, model_name.replace("/", "__"))
+    file_name = f"onnx/model_qint8_{config_name}.onnx"
+    if not os.path.exists(os.path.join(model_dir, file_name)):
+        print(f"Exporting {model_name} to int8 ONNX in {model_dir}")
+        model = SentenceTransformer(model_name, backend="onnx")
+        model.save(model_dir)
+        export_dynamic_quantized_onnx_model(model, config_name, model_dir)
+    return SentenceTransformer(model_dir, backend="onnx", model_kwargs={"file_name": file_name})
+
+def token_lengths(model, texts):
+    '''
+    Returns the number of tokens the model will see for every text (after truncation).
+    Falls back to a word-count estimate if the model exposes no tokenizer.
+    '''
+    tokenizer = getattr(model, "tokenizer", None)
+    if tokenizer is None:
+        return np.array([int(len(text.split()) * 1.3) + 2 for text in texts])
+    max_length = getattr(model, "max_seq_length", None)
+    encoded = tokenizer(list(texts), add_special_tokens=True, truncation=max_length is not None, max_length=max_length)
+    return np.array([len(ids) for ids in encoded["input_ids"]])
+
+def bucket_batches(lengths, max_tokens=EMBEDDING_BATCH_TOKENS, max_size=EMBEDDING_BATCH_SIZE):
+    '''
+    Groups texts into batches of similar token length.
+
+    Texts are sorted by length and a batch is closed once its padded size (batch size times
+    its longest text) would exceed max_tokens, so short texts share large batches and long
+    texts small ones, with little padding in either.
+
+    Returns:
+    - A list of batches, each a list of text indices.
+    '''
+    batches = []
+    batch = []
+    for i in np.argsort(lengths, kind="stable"):
+        # Lengths are ascending, so the new text is the longest of the batch.
+        if batch and ((len(batch) + 1) * lengths[i] > max_tokens or len(batch) >= max_size):
+            batches.append(batch)
+            batch = []
+        batch.append(int(i))
+    if batch:
+        batches.append(batch)
+    return batches
+
+def encode_texts(model, texts, show_progress_bar=False):
+    '''
+    Encodes texts in length-bucketed batches.
+
+    Returns:
+    - A float32 array of shape (len(texts), dim), in the order of texts.
+    '''
+    texts = list(texts)
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    batches = bucket_batches(token_lengths(model, texts))
+    embeddings = None
+    for batch in tqdm(batches, desc="Embedding", disable=not show_progress_bar):
+        vectors = np.asarray(model.encode([texts[i] for i in batch], batch_size=len(batch)), dtype=np.float32)
+        if embeddings is None:
+            embeddings = np.zeros((len(texts), vectors.shape[1]), dtype=np.float32)
+        embeddings[batch] = vectors
+    return embeddings
+
+def check_embedding_parity(texts, backend=EMBEDDING_BACKEND, model_name=EMBEDDING_MODEL_NAME, top_n=10):
+    '''
+    Compares a backend against the fp32 baseline on the same texts.
+
+    Returns:
+    - A dictionary with the minimum and mean cosine similarity between the two embeddings of
+      every text, the share of each text's top_n nearest neighbours (among the texts) that both
+      backends agree on, and whether the minimum cosine reaches EMBEDDING_PARITY_MIN_COSINE.
+    '''
+    baseline = normalize_rows(encode_texts(load_embedding_model(model_name, "torch"), texts))
+    candidate = normalize_rows(encode_texts(load_embedding_model(model_name, backend), texts))
+    cosines = np.sum(baseline * candidate, axis=1)
+
+    # Neighbour agreement shows whether retrieval rankings survive quantization.
+    top_n = min(top_n, len(texts) - 1)
+    agreement = 1.0
+    if top_n > 0:
+        baseline_sim = baseline @ baseline.T
+        candidate_sim = candidate @ candidate.T
+        np.fill_diagonal(baseline_sim, -np.inf)
+        np.fill_diagonal(candidate_sim, -np.inf)
+        baseline_top = np.argpartition(-baseline_sim, top_n - 1, axis=1)[:, :top_n]
+        candidate_top = np.argpartition(-candidate_sim, top_n - 1, axis=1)[:, :top_n]
+        agreement = float(np.mean([len(set(a) & set(b)) / top_n for a, b in zip(baseline_top, candidate_top)]))
+
+    return {
+        "backend": backend,
+        "texts": len(texts),
+        "min_cosine": float(cosines.min()),
+        "mean_cosine": float(cosines.mean()),
+        f"top{top_n}_agreement": agreement,
+        "passed": bool(cosines.min() >= EMBEDDING_PARITY_MIN_COSINE)
+    }
+
+if __name__ == "__main__":
+    # Parity check of the configured backend on a sample of regulatory chunks:
+    #     python embedding_backend.py --backend torch-int8 --samples 500
+    from utils import load_processed_data
+    parser = argparse.ArgumentParser(description="Compare an embedding backend with the fp32 baseline.")
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND, choices=EMBEDDING_BACKENDS)
+    parser.add_argument("--samples", type=int, default=500, help="Regulatory chunks to compare.")
+    args = parser.parse_args()
+
+    corpus = load_processed_data()
+    if corpus is None or not len(corpus["chunks"]):
+        raise SystemExit(f"No processed regulatory documents found in {CORPUS_DIR}.")
+    rng = np.random.default_rng(0)
+    rows = np.sort(rng.choice(len(corpus["chunks"]), size=min(args.samples, len(corpus["chunks"])), replace=False))
+    print(check_embedding_parity([corpus["chunks"][row] for row in rows], backend=args.backend))
@@ -0,0 +1,199 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from config import *
+from utils import normalize_rows
+
+META_FILE = "meta.json"
+KEYS_FILE = "keys.txt"
+VECTORS_FILE = "vectors.bin"
+
+# Every key is a 40-character SHA-1 hex digest on its own line.
+KEY_LINE_SIZE = 41
+
+
+def text_hash(text):
+    '''
+    Returns the SHA-1 hex digest of a text, used as its embedding cache key.
+    '''
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    '''
+    Persistent text-hash -> embedding cache for one embedding model and backend.
+
+    Vectors are stored L2-normalized in a per-model directory, so a model change never
+    reuses stale vectors. Keys (keys.txt) and float32 vectors (vectors.bin) are append-only
+    files, so saving a few new vectors does not rewrite the cache. Once max_entries is
+    exceeded, the oldest entries are dropped down to a low-water mark (EMBEDDING_CACHE_TRIM_RATIO),
+    so a full cache is rewritten once rather than on every save. encode() and save() may be called from several threads.
+    '''
+
+    def __init__(self, cache_dir=EMBEDDING_CACHE_DIR, model_name=None, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        if model_name is None:
+            from embedding_backend import embedding_model_id
+            model_name = embedding_model_id()
+        self.directory = os.path.join(cache_dir, model_name.replace("/", "__"))
+        self.max_entries = max_entries
+        self.keys = {}
+        self.vectors = None
+        self.new_vectors = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        '''
+        Loads the saved cache; the vectors stay memory-mapped.
+        '''
+        meta_path = os.path.join(self.directory, META_FILE)
+        if not os.path.exists(meta_path):
+            return
+        keys_path = os.path.join(self.directory, KEYS_FILE)
+        vectors_path = os.path.join(self.directory, VECTORS_FILE)
+        if not (os.path.exists(keys_path) and os.path.exists(vectors_path)):
+            return
+        with open(meta_path) as f:
+            dim = json.load(f)["dim"]
+        # An interrupted append leaves one file longer than the other; only complete pairs count.
+        count = min(os.path.getsize(keys_path) // KEY_LINE_SIZE, os.path.getsize(vectors_path) // (4 * dim))
+        if count == 0:
+            return
+        with open(keys_path) as f:
+            keys = [f.readline().rstrip("\n") for _ in range(count)]
+        self.vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(count, dim))
+        self.keys = {key: row for row, key in enumerate(keys)}
+
+    def __len__(self):
+        '''
+        Returns the number of cached texts, including entries not saved yet.
+        '''
+        return len(self.keys) + len(self.new_vectors)
+
+    def get(self, text):
+        '''
+        Returns the cached vector for a text, or None.
+        '''
+        key = text_hash(text)
+        if key in self.new_vectors:
+            return self.new_vectors[key]
+        row = self.keys.get(key)
+        if row is None:
+            return None
+        return np.asarray(self.vectors[row])
+
+    def add(self, texts, vectors):
+        '''
+        Adds (text, vector) pairs to the cache. Vectors are normalized before storing.
+        '''
+        for text, vector in zip(texts, normalize_rows(vectors)):
+            key = text_hash(text)
+            if key not in self.keys:
+                self.new_vectors[key] = vector
+
+    def missing(self, texts):
+        '''
+        Returns the distinct texts that have no cached vector, in first-seen order.
+        '''
+        seen = set()
+        missing = []
+        for text in texts:
+            key = text_hash(text)
+            if key in seen or key in self.keys or key in self.new_vectors:
+                continue
+            seen.add(key)
+            missing.append(text)
+        return missing
+
+    def encode(self, texts, encode_fn):
+        '''
+        Returns normalized embeddings for texts, computing only the cache misses.
+
+        Parameters:
+        - texts: List of texts.
+        - encode_fn: Function mapping a list of texts to an array of embeddings.
+
+        Returns:
+        - A float32 array of shape (len(texts), dim).
+        '''
+        with self.lock:
+            missing = self.missing(texts)
+        # The model runs outside the lock, so other threads can read cached vectors meanwhile.
+        vectors = encode_fn(missing) if missing else None
+        with self.lock:
+            if missing:
+                self.add(missing, vectors)
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+            return np.array([self.get(text) for text in texts], dtype=np.float32)
+
+    def save(self):
+        '''
+        Writes new entries to disk. They are appended to the cache files, unless the cache
+        exceeds max_entries; the oldest entries are then dropped and the cache is rewritten (see write_all).
+        '''
+        with self.lock:
+            if not self.new_vectors:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            new_keys = list(self.new_vectors)
+            new_vectors = np.array(list(self.new_vectors.values()), dtype=np.float32)
+            if self.max_entries and len(self.keys) + len(new_keys) > self.max_entries:
+                self.write_all(new_keys, new_vectors)
+            else:
+                self.append(new_keys, new_vectors)
+            self.new_vectors = {}
+            self.load()
+
+    def append(self, new_keys, new_vectors):
+        '''
+        Appends entries to the cache files, after cutting off any partial append.
+        '''
+        dim = new_vectors.shape[1]
+        with open(os.path.join(self.directory, META_FILE), "w") as f:
+            json.dump({"dim": dim}, f)
+        count = len(self.keys)
+        with open(os.path.join(self.directory, VECTORS_FILE), "ab") as f:
+            f.truncate(count * 4 * dim)
+            f.write(new_vectors.tobytes())
+        # Keys are written last: a key only counts once its vector is on disk.
+        with open(os.path.join(self.directory, KEYS_FILE), "a") as f:
+            f.truncate(count * KEY_LINE_SIZE)
+            f.write("".join(key + "\n" for key in new_keys))
+
+    def write_all(self, new_keys, new_vectors):
+        '''
+        Rewrites the whole cache. A cache over max_entries keeps only the
+        newest EMBEDDING_CACHE_TRIM_RATIO share of max_entries.
+        '''
+        keys = sorted(self.keys, key=self.keys.get) + new_keys
+        # Beyond the size limit, drop the oldest entries down to the low-water mark, so the
+        # next saves append again instead of rewriting a full cache every time.
+        drop = 0
+        if self.max_entries and len(keys) > self.max_entries:
+            drop = len(keys) - max(1, int(self.max_entries * EMBEDDING_CACHE_TRIM_RATIO))
+        keys = keys[drop:]
+        parts = []
+        if self.vectors is not None and drop < len(self.vectors):
+            parts.append(np.asarray(self.vectors[drop:], dtype=np.float32))
+        if len(new_vectors):
+            parts.append(new_vectors[max(0, drop - len(self.keys)):])
+        vectors = np.vstack(parts) if len(parts) > 1 else parts[0]
+
+        # Write to temporary files first, then swap them in; the key count bounds what is read.
+        tmp_keys = os.path.join(self.directory, KEYS_FILE + ".tmp")
+        tmp_vectors = os.path.join(self.directory, VECTORS_FILE + ".tmp")
+        with open(tmp_vectors, "wb") as f:
+            f.write(vectors.tobytes())
+        with open(tmp_keys, "w") as f:
+            f.write("".join(key + "\n" for key in keys))
+        # Drop the mapping of the old vectors before replacing the file.
+        self.vectors = None
+        with open(os.path.join(self.directory, META_FILE), "w") as f:
+            json.dump({"dim": vectors.shape[1]}, f)
+        os.replace(tmp_keys, os.path.join(self.directory, KEYS_FILE))
+        os.replace(tmp_vectors, os.path.join(self.directory, VECTORS_FILE))
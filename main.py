@@ -1,26 +1,223 @@
-from process_regulatory_file import process_regulatory_files
-from report_generator import generate_tasks
-from parallel_api_query import call_claude_on_tasks, save_reports
-from config import REPROCESS_DOCS
+import time
+# Taken before the other imports so the startup breakdown includes them.
+started = time.perf_counter()
 
-def main():
+import os
+import asyncio
+import hashlib
+import argparse
+from collections import Counter
+from utils import startup_timings, startup_step, print_startup_timings, file_content_hash
+from metrics import metrics
+from config import *
+
+startup_timings["imports"] = time.perf_counter() - started
+
+# The pipeline modules (aiohttp, scipy, PyPDF2) are imported by the modes that use them,
+# inside startup_step("imports"), so a run only pays for what it does.
+
+def stream_statements(sop_sentences, writer, statuses=None):
     '''
-    Main entry point for the application.
-    It optionally reprocesses regulatory files, generates analysis tasks,
-    calls the Claude API in parallel for each task, and saves the reports.
+    Checks the statements not yet in the writer's report through the streaming pipeline,
+    then writes the JSON reports.
+
+    Parameters:
+    - sop_sentences: List of SOP statements.
+    - writer: StreamingReportWriter of the run; statements in writer.completed are skipped.
+    - statuses: Revision status of every statement in a diff run, added to its result.
     '''
-    # Reprocess regulatory documents if the configuration flag is set.
-    if REPROCESS_DOCS:
-        process_regulatory_files()
-    
+    remaining = len(sop_sentences) - len(writer.completed)
+    # A finished run only needs its reports rewritten: no index, model or API client.
+    if not remaining:
+        with metrics.stage("report.write"):
+            writer.finalize()
+        return
+
+    with startup_step("imports"):
+        from tqdm import tqdm
+        from report_generator import load_retrieval_index, iter_tasks
+        from retrieval_pool import open_retrieval_pool
+        from parallel_api_query import stream_claude_on_tasks
+        from call_claude_api import get_response_cache
+        from claude_client import AsyncClaudeClient
+    index = load_retrieval_index()
+    pool = open_retrieval_pool(index)
+    progress = tqdm(total=remaining, desc="SOP statements checked")
+
+    def on_result(task, result, found_dis):
+        if statuses is not None:
+            result = dict(result, revision=statuses[task[0]])
+        writer.write(task[0], result, found_dis)
+        progress.update(1)
+
+    async def run():
+        async with AsyncClaudeClient() as client:
+            tasks = iter_tasks(index, sop_sentences, skip=writer.completed, batch_size=STREAM_BATCH_SIZE, pool=pool)
+            await stream_claude_on_tasks(tasks, client, on_result)
+            print(f"API stats: {client.stats}, final concurrency {client.concurrency.limit}")
+            if get_response_cache():
+                print(f"Response cache: {get_response_cache().stats()}")
+
+    try:
+        with metrics.stage("pipeline.stream"):
+            asyncio.run(run())
+    finally:
+        progress.close()
+        writer.close()
+        if pool is not None:
+            pool.close()
+    with metrics.stage("report.write"):
+        writer.finalize()
+
+def run_streaming():
+    '''
+    Runs task generation, API calls and report writing as one streaming pipeline.
+    Tasks are sent to the API as soon as their regulatory context is retrieved, and each
+    result is appended to the JSONL report when it completes. An interrupted run with the
+    same SOP and corpus resumes where it stopped.
+    '''
+    with startup_step("imports"):
+        from report_generator import load_sop_statements, run_fingerprint
+        from parallel_api_query import StreamingReportWriter
+    sop_sentences = load_sop_statements()
+    writer = StreamingReportWriter(run_fingerprint(sop_sentences), len(sop_sentences))
+    stream_statements(sop_sentences, writer)
+
+def run_diff(previous_path):
+    '''
+    Checks a revised SOP against the report of its previous run, re-checking only what changed.
+    The old and new statements are aligned by content hash; unchanged statements keep their
+    previous result, and only new and changed statements are embedded, retrieved and sent to
+    the API. Every report entry gets a "revision" field: new, changed, carried_over or
+    rechecked (unchanged, but its previous check failed).
+    Carried-over results reflect the corpus and settings of the previous run.
+    '''
+    if os.path.abspath(previous_path) == os.path.abspath(REPORT_JSONL_PATH):
+        print(f"{REPORT_JSONL_PATH} is rewritten by the run; pass {REPORT_OUTPUT_PATH} or a copy of the JSONL report.")
+        return
+    with startup_step("imports"):
+        from report_generator import load_sop_statements, run_fingerprint
+        from parallel_api_query import StreamingReportWriter
+        from sop_diff import load_previous_report, plan_revision
+    sop_sentences = load_sop_statements()
+    with metrics.stage("diff.align"):
+        previous = load_previous_report(previous_path)
+        plan = plan_revision(previous, sop_sentences)
+    counts = Counter(plan["statuses"])
+    print(f"Revision diff against {previous_path}: {dict(counts)}, {plan['removed']} removed")
+    for status, count in counts.items():
+        metrics.count("revision_statements_total", count, status=status)
+
+    # A diff run only resumes against the same previous report, and the previous report is
+    # only overwritten when the run finishes.
+    fingerprint = f"{run_fingerprint(sop_sentences)}\n{file_content_hash(previous_path)}"
+    writer = StreamingReportWriter(hashlib.sha256(fingerprint.encode("utf-8")).hexdigest(), len(sop_sentences))
+    # Carried-over results need no retrieval or API call; they go to the report first.
+    for idx, (result, found_dis) in sorted(plan["carried"].items()):
+        if idx not in writer.completed:
+            writer.write(idx, result, found_dis)
+    stream_statements(sop_sentences, writer, statuses=plan["statuses"])
+
+def run_batch(pattern):
+    '''
+    Checks every SOP document in a directory or matching a glob pattern in one run.
+    The embedding model, retrieval index and API client are shared by all documents, the
+    statements of all documents are embedded together, and identical tasks across documents
+    are sent once.
+    '''
+    with startup_step("imports"):
+        from report_generator import find_sop_documents, generate_batch_tasks
+        from parallel_api_query import call_claude_on_tasks, save_batch_reports
+    sop_paths = find_sop_documents(pattern)
+    if not sop_paths:
+        print(f"No SOP documents found for {pattern}")
+        return
+    print(f"Checking {len(sop_paths)} SOP documents.")
+
+    # Generate the tasks of all documents with one model and one retrieval index.
+    with metrics.stage("tasks"):
+        tasks, spans = generate_batch_tasks(sop_paths)
+
+    # Execute the API calls of all documents through one client.
+    with metrics.stage("api.calls"):
+        results = call_claude_on_tasks(tasks)
+
+    # Save one report folder per document and the summary index.
+    with metrics.stage("report.write"):
+        save_batch_reports(sop_paths, spans, results)
+
+def run_stages():
+    '''
+    Runs task generation, API calls and report saving one after another.
+    '''
+    with startup_step("imports"):
+        from report_generator import generate_tasks
+        from parallel_api_query import call_claude_on_tasks, save_reports
+
     # Generate tasks by processing the SOP and regulatory documents.
-    tasks = generate_tasks()
+    with metrics.stage("tasks"):
+        tasks = generate_tasks()
 
     # Execute API calls concurrently for each task.
-    results = call_claude_on_tasks(tasks)
+    with metrics.stage("api.calls"):
+        results = call_claude_on_tasks(tasks)
     
     # Save the results to JSON reports.
-    save_reports(results)
-    
+    with metrics.stage("report.write"):
+        save_reports(results)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check SOP documents against regulatory documents.")
+    parser.add_argument("--batch", metavar="PATTERN",
+                        help="Directory or glob pattern of SOP DOCX files to check in one run, instead of SOP_DOC_PATH.")
+    parser.add_argument("--diff", metavar="PREVIOUS_REPORT", nargs="?", const=REPORT_OUTPUT_PATH,
+                        help="Re-check only the statements of SOP_DOC_PATH that changed since the previous report "
+                             f"(default: {REPORT_OUTPUT_PATH}) and carry over the other results.")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run as a local service that keeps the model and index loaded and checks SOPs sent over HTTP.")
+    return parser.parse_args()
+
+def main():
+    '''
+    Main entry point for the application.
+    It optionally reprocesses regulatory files, generates analysis tasks,
+    calls the Claude API in parallel for each task, and saves the reports.
+    With STREAMING_MODE, the stages overlap and results are saved as they complete.
+    With --batch, many SOP documents are checked in one run.
+    With --diff, only the statements changed since the previous report are checked again.
+    With --serve, SOPs are checked on request by a long-running local service.
+    '''
+    args = parse_args()
+
+    try:
+        # Reprocess regulatory documents if the configuration flag is set.
+        if REPROCESS_DOCS:
+            with startup_step("imports"):
+                from process_regulatory_file import process_regulatory_files
+            with metrics.stage("ingest"):
+                process_regulatory_files()
+
+        if args.serve:
+            # Imported here so other modes do not load aiohttp.web.
+            from server import run_server
+            run_server()
+        elif args.batch:
+            run_batch(args.batch)
+        elif args.diff:
+            run_diff(args.diff)
+        elif STREAMING_MODE:
+            run_streaming()
+        else:
+            run_stages()
+    finally:
+        # Metrics are also written for a failed run, to show where it stopped.
+        for step, seconds in startup_timings.items():
+            metrics.gauge("startup_seconds", round(seconds, 6), step=step)
+        metrics.gauge("total_seconds", round(time.perf_counter() - started, 6))
+        metrics.write()
+    print_startup_timings()
+    print(f"Total time: {time.perf_counter() - started:.2f}s")
+
+
 if __name__ == "__main__":
     main()
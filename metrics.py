@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+from config import *
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is then not reported.
+    resource = None
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def peak_rss_bytes():
+    '''
+    Returns the peak resident set size of this process in bytes, or None if unknown.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def cpu_seconds():
+    '''
+    Returns the CPU time used by this process and its finished child processes (e.g. ingest workers).
+    '''
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def label_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+def format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in key) + "}"
+
+
+class Histogram:
+    '''
+    Cumulative histogram with fixed bucket bounds, as exported by Prometheus.
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "buckets": {str(bound): count for bound, count in zip(self.buckets, self.counts)}
+        }
+
+
+class Metrics:
+    '''
+    Process-wide registry of pipeline metrics.
+
+    - Stages: wall time, CPU time, call count and peak RSS after each named stage (stage()).
+      CPU time is process-wide (see cpu_seconds), so stages that overlap, e.g. in the server
+      or the retrieval pool, each count the CPU time of the others.
+    - Counters: monotonically increasing totals, optionally labelled (count()).
+    - Gauges: last observed values (gauge()).
+    - Histograms: latency distributions (observe()).
+    Stages listed in PROFILE_STAGES are also profiled with cProfile. Safe to use from several threads.
+    '''
+
+    def __init__(self, enabled=METRICS_ENABLED, profile_stages=PROFILE_STAGES):
+        self.enabled = enabled
+        self.profile_stages = set(profile_stages or ())
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.profiles = {}
+        self.profiling = False
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Times the block as one run of stage name (wall and CPU time), optionally under cProfile.
+        CPU time is that of the whole process and its finished children during the block, not of
+        the calling thread, so worker processes count but so do stages running at the same time.
+        '''
+        if not self.enabled:
+            yield
+            return
+        profile = self.start_profile(name)
+        wall_start = time.perf_counter()
+        cpu_start = cpu_seconds()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = cpu_seconds() - cpu_start
+            if profile is not None:
+                profile.disable()
+                self.profiling = False
+            with self.lock:
+                stage = self.stages.setdefault(name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+                stage["calls"] += 1
+                stage["wall_seconds"] += wall
+                stage["cpu_seconds"] += cpu
+                stage["peak_rss_bytes"] = peak_rss_bytes()
+
+    def start_profile(self, name):
+        '''
+        Enables the cProfile profiler of a stage listed in PROFILE_STAGES. Only one stage is
+        profiled at a time, since Python allows a single active profiler.
+        '''
+        if name not in self.profile_stages:
+            return None
+        with self.lock:
+            if self.profiling:
+                return None
+            self.profiling = True
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+        profile.enable()
+        return profile
+
+    def count(self, name, amount=1, **labels):
+        '''
+        Adds amount to a counter.
+        '''
+        if not self.enabled:
+            return
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, value, **labels):
+        '''
+        Sets a gauge to value.
+        '''
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        '''
+        Records one observation (e.g. a latency in seconds) in a histogram.
+        '''
+        if not self.enabled:
+            return
+        key = (name, label_key(labels))
+        with self.lock:
+            self.histograms.setdefault(key, Histogram()).observe(value)
+
+    def snapshot(self):
+        '''
+        Returns all metrics as a JSON-serializable dictionary.
+        '''
+        def keyed(name, key):
+            return name + format_labels(key)
+
+        with self.lock:
+            return {
+                "started": self.started,
+                "elapsed_seconds": round(time.time() - self.started, 3),
+                "peak_rss_bytes": peak_rss_bytes(),
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "counters": {keyed(name, key): value for (name, key), value in sorted(self.counters.items())},
+                "gauges": {keyed(name, key): value for (name, key), value in sorted(self.gauges.items())},
+                "histograms": {keyed(name, key): histogram.to_dict() for (name, key), histogram in sorted(self.histograms.items())}
+            }
+
+    def prometheus_text(self):
+        '''
+        Returns all metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self.lock:
+            lines.append("# TYPE rcc_stage_wall_seconds counter")
+            lines.extend(f'rcc_stage_wall_seconds{{stage="{name}"}} {stage["wall_seconds"]:.6f}' for name, stage in self.stages.items())
+            lines.append("# HELP rcc_stage_cpu_seconds Process-wide CPU time during the stage; overlapping stages count each other's CPU time.")
+            lines.append("# TYPE rcc_stage_cpu_seconds counter")
+            lines.extend(f'rcc_stage_cpu_seconds{{stage="{name}"}} {stage["cpu_seconds"]:.6f}' for name, stage in self.stages.items())
+            lines.append("# TYPE rcc_stage_calls_total counter")
+            lines.extend(f'rcc_stage_calls_total{{stage="{name}"}} {stage["calls"]}' for name, stage in self.stages.items())
+            peak = peak_rss_bytes()
+            if peak is not None:
+                lines.append("# TYPE rcc_peak_rss_bytes gauge")
+                lines.append(f"rcc_peak_rss_bytes {peak}")
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE rcc_{name} {kind}")
+                    lines.extend(f"rcc_{name}{format_labels(key)} {value}" for (metric, key), value in sorted(values.items()) if metric == name)
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE rcc_{name} histogram")
+                for (metric, key), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"rcc_{name}_bucket{format_labels(key + (('le', str(bound)),))} {count}")
+                    lines.append(f"rcc_{name}_bucket{format_labels(key + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"rcc_{name}_sum{format_labels(key)} {histogram.sum:.6f}")
+                    lines.append(f"rcc_{name}_count{format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=METRICS_JSON_PATH, prometheus_path=METRICS_PROMETHEUS_PATH, profile_dir=PROFILE_DIR):
+        '''
+        Writes the metrics as JSON and in the Prometheus text format, and the cProfile
+        statistics of every profiled stage as <profile_dir>/<stage>.prof (readable with pstats).
+        '''
+        if not self.enabled:
+            return
+        for path in (json_path, prometheus_path):
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(json_path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        with open(prometheus_path, "w") as f:
+            f.write(self.prometheus_text())
+        for name, profile in self.profiles.items():
+            os.makedirs(profile_dir, exist_ok=True)
+            profile.dump_stats(os.path.join(profile_dir, f"{name}.prof"))
+        print(f"Metrics saved to {json_path} and {prometheus_path}")
+
+
+# Metrics of this process, shared by all modules.
+metrics = Metrics()
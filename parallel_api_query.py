@@ -1,56 +1,388 @@
-from call_claude_api import compare_with_claude
+from call_claude_api import compare_with_claude_async, get_response_cache
+from metrics import metrics
 from config import *
 import json
+import asyncio
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 
-def call_claude_on_tasks(tasks, max_workers=5):
+def error_result(task, error):
     '''
-    Sends API calls to the Claude API concurrently for each task using ThreadPoolExecutor.
+    Builds the result recorded for a task whose API call failed. Errors are flagged for review.
+    '''
+    return ({
+        "sop_statement": task[1],
+        "regulatory_context": task[2],
+        "discrepancies_and_improvement": f"Error: {str(error)}"
+    }, True)
+
+
+class TaskPruner:
+    '''
+    Pre-dispatch stage that avoids API calls which cannot change the report.
+
+    - Tasks whose best fused retrieval score is below min_score, and tasks without any retrieved
+      regulatory context, are not sent; they are recorded as skipped, with the reason, and not flagged.
+    - Tasks with the same SOP statement and regulatory context share one API call; the reply is
+      copied to every duplicate.
+    Counters of the run are kept in self.counters.
+    '''
+
+    def __init__(self, min_score=MIN_RELEVANCE_SCORE, dedup=DEDUP_TASKS):
+        self.min_score = min_score
+        self.dedup = dedup
+        self.waiting = {}
+        self.answers = {}
+        self.counters = {"tasks": 0, "dispatched": 0, "duplicates": 0, "skipped_low_score": 0, "skipped_no_context": 0}
+
+    def skipped_result(self, task, reason):
+        '''
+        Builds the result recorded for a task skipped without an API call.
+        '''
+        result = {
+            "sop_statement": task[1],
+            "regulatory_context": task[2],
+            "discrepancies_and_improvement": f"SKIPPED: {reason}",
+            "skipped": True
+        }
+        if len(task) > 3:
+            result["relevance_score"] = task[3]
+        return (result, False)
+
+    def admit(self, task):
+        '''
+        Decides whether a task needs an API call.
+
+        Returns:
+        - A tuple (dispatch, ready): dispatch is True if the task must be sent; ready lists
+          (task, result, found_dis) tuples that are final right away (skipped tasks and
+          duplicates of tasks already answered).
+        '''
+        self.counters["tasks"] += 1
+        # A statement without any retrieved chunk has nothing to be compared with.
+        if not task[2].strip():
+            self.counters["skipped_no_context"] += 1
+            return False, [(task,) + self.skipped_result(task, "no regulatory context was retrieved")]
+        # Tasks without a score (3-tuples) are always kept.
+        if self.min_score and len(task) > 3 and task[3] < self.min_score:
+            self.counters["skipped_low_score"] += 1
+            reason = f"best relevance score {task[3]:.4f} is below {self.min_score}"
+            return False, [(task,) + self.skipped_result(task, reason)]
+        if not self.dedup:
+            self.counters["dispatched"] += 1
+            return True, []
+
+        key = (task[1], task[2])
+        if key in self.answers:
+            self.counters["duplicates"] += 1
+            result, found_dis = self.answers[key]
+            return False, [(task, dict(result), found_dis)]
+        if key in self.waiting:
+            # The first copy is in flight; this one gets its reply in resolve().
+            self.counters["duplicates"] += 1
+            self.waiting[key].append(task)
+            return False, []
+        self.waiting[key] = []
+        self.counters["dispatched"] += 1
+        return True, []
+
+    def resolve(self, task, result, found_dis):
+        '''
+        Records the reply of a dispatched task.
+
+        Returns:
+        - (task, result, found_dis) tuples for the task and every duplicate waiting on it.
+        '''
+        if not self.dedup:
+            return [(task, result, found_dis)]
+        key = (task[1], task[2])
+        self.answers[key] = (result, found_dis)
+        duplicates = self.waiting.pop(key, [])
+        return [(task, result, found_dis)] + [(duplicate, dict(result), found_dis) for duplicate in duplicates]
+
+    def report(self):
+        '''
+        Prints the counters of the run and the number of API calls avoided.
+        '''
+        avoided = self.counters["duplicates"] + self.counters["skipped_low_score"] + self.counters["skipped_no_context"]
+        print(f"Task pruning: {self.counters}, {avoided} API calls avoided")
+        for name, value in self.counters.items():
+            metrics.count("pruned_tasks_total", value, outcome=name)
+
+async def call_claude_on_tasks_async(tasks, client, pruner=None):
+    '''
+    Sends API calls for every task through a shared AsyncClaudeClient, which paces them with
+    its rate limits and adaptive concurrency. Low-relevance and duplicate tasks are resolved
+    by the TaskPruner without a call.
     Returns a list of tuples with the result dictionary and a discrepancy flag for each task.
     '''
+    pruner = pruner or TaskPruner()
     # Initialize a list to hold results for each task.
     results = [None] * len(tasks)
 
-    # Create a thread pool with a maximum number of workers.
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Map each task submission (API call) to its task index.
-        future_to_idx = {executor.submit(compare_with_claude, task[1], task[2]): task[0] for task in tasks}
-        
-        # Process each completed future.
-        for future in tqdm(as_completed(future_to_idx), total=len(future_to_idx), desc="API Calls"):
-            idx = future_to_idx[future]
-            try:
-                # Retrieve the result from the future.
-                result, found_dis = future.result()
-                results[idx] = (result, found_dis)
-            except Exception as e:
-                results[idx] = ({
-                    "sop_statement": tasks[idx][1],
-                    "regulatory_context": tasks[idx][2],
-                    "discrepancies_and_improvement": f"Error: {str(e)}"
-                }, True)
+    async def run_task(task):
+        try:
+            result, found_dis = await compare_with_claude_async(client, task[1], task[2])
+        except Exception as e:
+            result, found_dis = error_result(task, e)
+        for finished, result, found_dis in pruner.resolve(task, result, found_dis):
+            results[finished[0]] = (result, found_dis)
+
+    # Positions stand in for the task indices, so results line up with the task list.
+    pending = []
+    for position, task in enumerate(tasks):
+        dispatch, ready = pruner.admit((position,) + tuple(task[1:]))
+        for finished, result, found_dis in ready:
+            results[finished[0]] = (result, found_dis)
+        if dispatch:
+            pending.append(asyncio.ensure_future(run_task((position,) + tuple(task[1:]))))
+
+    # Every dispatched task is scheduled at once; the client decides how many requests are in flight.
+    for future in tqdm(asyncio.as_completed(pending), total=len(pending), desc="API Calls"):
+        await future
+    pruner.report()
     return results
 
-def save_reports(results):
+def call_claude_on_tasks(tasks, max_workers=API_INITIAL_CONCURRENCY):
+    '''
+    Sends API calls to the Claude API concurrently for each task using an asyncio client with
+    connection pooling, rate limiting, retries and adaptive concurrency.
+    max_workers is the initial concurrency; it grows or shrinks with the observed 429 rate and latency.
+    Returns a list of tuples with the result dictionary and a discrepancy flag for each task.
+    '''
+    # aiohttp is only loaded by modes that call the API, not by report writing alone.
+    from claude_client import AsyncClaudeClient
+
+    async def run():
+        async with AsyncClaudeClient(initial_concurrency=max_workers) as client:
+            results = await call_claude_on_tasks_async(tasks, client)
+            print(f"API stats: {client.stats}, final concurrency {client.concurrency.limit}")
+            if get_response_cache():
+                print(f"Response cache: {get_response_cache().stats()}")
+            return results
+    return asyncio.run(run())
+
+async def stream_claude_on_tasks(task_iter, client, on_result, max_pending=STREAM_MAX_PENDING, pruner=None, executor=None):
+    '''
+    Streams tasks from a (blocking) task generator straight to the API.
+
+    The next task is pulled from the generator in a worker thread while earlier tasks wait on
+    the API, so retrieval for later statements overlaps with API calls for earlier ones.
+    At most max_pending tasks are in flight at any time, which keeps memory flat regardless of SOP size.
+
+    Parameters:
+    - task_iter: Iterable of task tuples (index, SOP statement, regulatory context).
+    - client: Shared AsyncClaudeClient.
+    - on_result: Called as on_result(task, result, found_dis) when each task finishes.
+    - pruner: TaskPruner resolving low-relevance and duplicate tasks without a call.
+    - executor: Executor that runs the task generator (e.g. one worker shared by many streams);
+      the default executor of the event loop if omitted.
+    '''
+    pruner = pruner or TaskPruner()
+    loop = asyncio.get_running_loop()
+    iterator = iter(task_iter)
+    slots = asyncio.Semaphore(max_pending)
+    done = object()
+
+    async def run_task(task):
+        try:
+            result, found_dis = await compare_with_claude_async(client, task[1], task[2])
+        except Exception as e:
+            result, found_dis = error_result(task, e)
+        try:
+            for finished, result, found_dis in pruner.resolve(task, result, found_dis):
+                on_result(finished, result, found_dis)
+        finally:
+            slots.release()
+
+    in_flight = set()
+    try:
+        while True:
+            await slots.acquire()
+            # The generator blocks on embedding and scoring; run it off the event loop.
+            task = await loop.run_in_executor(executor, next, iterator, done)
+            if task is done:
+                slots.release()
+                break
+            dispatch, ready = pruner.admit(task)
+            for finished, result, found_dis in ready:
+                on_result(finished, result, found_dis)
+            if not dispatch:
+                slots.release()
+                continue
+            future = asyncio.ensure_future(run_task(task))
+            in_flight.add(future)
+            future.add_done_callback(in_flight.discard)
+    finally:
+        # Record every started task, also when the task generator fails.
+        await asyncio.gather(*in_flight, return_exceptions=True)
+    pruner.report()
+
+
+class StreamingReportWriter:
+    '''
+    Appends results to a JSONL report as they complete, with a checkpoint that lets an
+    interrupted run resume.
+
+    Every line holds one result: {"index": ..., "found_discrepancy": ..., plus the result fields}.
+    The checkpoint file records the fingerprint of the run; a run with the same fingerprint
+    resumes, skipping indices already in the report, while any other run starts over.
+    '''
+
+    def __init__(self, fingerprint, total, jsonl_path=REPORT_JSONL_PATH, checkpoint_path=CHECKPOINT_PATH):
+        self.jsonl_path = jsonl_path
+        self.checkpoint_path = checkpoint_path
+        self.total = total
+        self.completed = set()
+        os.makedirs(os.path.dirname(jsonl_path) or ".", exist_ok=True)
+
+        checkpoint = None
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+        if checkpoint and checkpoint.get("fingerprint") == fingerprint and os.path.exists(jsonl_path):
+            self.recover()
+        else:
+            open(jsonl_path, "w").close()
+            with open(checkpoint_path, "w") as f:
+                json.dump({"fingerprint": fingerprint, "total": total}, f)
+        self.file = open(jsonl_path, "a")
+
+    def recover(self):
+        '''
+        Collects the indices already in the report and cuts off a partially written last line.
+        '''
+        valid_size = 0
+        with open(self.jsonl_path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                self.completed.add(record["index"])
+                valid_size += len(line)
+        with open(self.jsonl_path, "r+b") as f:
+            f.truncate(valid_size)
+        if self.completed:
+            print(f"Resuming: {len(self.completed)} of {self.total} statements already checked.")
+
+    def write(self, index, result, found_dis):
+        '''
+        Appends one result and flushes it to disk.
+        '''
+        record = {"index": index, "found_discrepancy": found_dis}
+        record.update(result)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.completed.add(index)
+
+    def close(self):
+        self.file.close()
+
+    def finalize(self, report_path=REPORT_OUTPUT_PATH, error_path=ERROR_OUTPUT_PATH):
+        '''
+        Writes the JSON compliance and error reports from the JSONL report, in statement order.
+        Records are copied one at a time, so memory does not grow with the report size.
+        '''
+        self.close()
+        # Remember where each record starts, then copy records in index order.
+        offsets = []
+        with open(self.jsonl_path, "rb") as f:
+            position = 0
+            for line in f:
+                offsets.append((json.loads(line)["index"], position))
+                position += len(line)
+        offsets.sort()
+
+        with open(self.jsonl_path, "rb") as source, open(report_path, "w") as report, open(error_path, "w") as errors:
+            report.write("[")
+            errors.write("[")
+            first_report = first_error = True
+            for _, position in offsets:
+                source.seek(position)
+                record = json.loads(source.readline())
+                record.pop("index")
+                found_dis = record.pop("found_discrepancy")
+                # Match the layout of json.dump(..., indent=2) for a list of results.
+                entry = "\n".join("  " + line for line in json.dumps(record, indent=2).split("\n"))
+                report.write(("\n" if first_report else ",\n") + entry)
+                first_report = False
+                if found_dis:
+                    errors.write(("\n" if first_error else ",\n") + entry)
+                    first_error = False
+            report.write("\n]" if not first_report else "]")
+            errors.write("\n]" if not first_error else "]")
+        print(f"Compliance report saved to {report_path}")
+        print(f"Error report saved to {error_path}")
+
+def save_reports(results, report_path=REPORT_OUTPUT_PATH, error_path=ERROR_OUTPUT_PATH):
     '''
     Saves the results of the API calls to JSON files.
     Generates both a full compliance report and a separate error report.
     '''
     # Ensure that the result directory exists.
-    os.makedirs(RESULT_DIR, exist_ok=True)
+    os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+    os.makedirs(os.path.dirname(error_path) or ".", exist_ok=True)
     
     # Extract all logs and those flagged with discrepancies or errors.
     all_logs = [result for result, flag in results]
     error_logs = [result for result, flag in results if flag]
     
     # Save the full compliance report to the designated output path.
-    with open(REPORT_OUTPUT_PATH, "w") as f:
+    with open(report_path, "w") as f:
         json.dump(all_logs, f, indent=2)
-    print(f"Compliance report saved to {REPORT_OUTPUT_PATH}")
+    print(f"Compliance report saved to {report_path}")
     
     # Save the error report for tasks with discrepancies or errors.
-    with open(ERROR_OUTPUT_PATH, "w") as f:
+    with open(error_path, "w") as f:
         json.dump(error_logs, f, indent=2)
-    print(f"Error report saved to {ERROR_OUTPUT_PATH}")
\ No newline at end of file
+    print(f"Error report saved to {error_path}")
+
+def save_batch_reports(sop_paths, spans, results, batch_dir=BATCH_RESULT_DIR):
+    '''
+    Saves the reports of a batch run: one folder per SOP document with its compliance and error
+    reports, and a summary.json indexing every document.
+
+    Parameters:
+    - sop_paths: SOP document paths, in task order.
+    - spans: For every document, the (start, end) range of its results, or None if it could not be read.
+    - results: Result tuples of all documents, in task order.
+    '''
+    os.makedirs(batch_dir, exist_ok=True)
+    summary = []
+    used_names = set()
+    for sop_path, span in zip(sop_paths, spans):
+        # Folder named after the document, made unique if two documents share a name.
+        name = os.path.splitext(os.path.basename(sop_path))[0]
+        folder = name
+        suffix = 2
+        while folder in used_names:
+            folder = f"{name}_{suffix}"
+            suffix += 1
+        used_names.add(folder)
+
+        entry = {"sop": sop_path}
+        if span is None:
+            entry["status"] = "unreadable"
+            summary.append(entry)
+            continue
+        sop_results = results[span[0]:span[1]]
+        report_path = os.path.join(batch_dir, folder, "report.json")
+        error_path = os.path.join(batch_dir, folder, "error.json")
+        save_reports(sop_results, report_path, error_path)
+        entry.update({
+            "status": "checked",
+            "statements": len(sop_results),
+            "flagged": sum(1 for result, flag in sop_results if flag),
+            "skipped": sum(1 for result, flag in sop_results if result.get("skipped")),
+            "report": report_path,
+            "error_report": error_path
+        })
+        summary.append(entry)
+
+    summary_path = os.path.join(batch_dir, "summary.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    print(f"Batch summary saved to {summary_path}")
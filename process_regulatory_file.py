@@ -1,139 +1,307 @@
 import os
 import glob
-import pickle
-from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from PyPDF2 import PdfReader
-from sentence_transformers import SentenceTransformer
-import nltk
-from nltk.tokenize import sent_tokenize, word_tokenize
-from nltk.corpus import stopwords
 from config import *
+from utils import load_processed_data, load_legacy_pickles, fit_tfidf_model, save_tfidf_model, has_tfidf_model
+from utils import get_embedding_model, file_content_hash
+from text_engine import analyze_document
+from corpus_store import write_corpus, read_corpus_document, read_manifest
+from embedding_cache import EmbeddingCache
+from embedding_backend import encode_texts, embedding_model_id
+from ann_index import build_ivf_index, save_ann_index, load_ann_index, corpus_fingerprint
+from metrics import metrics
 
-# Ensure required NLTK data is downloaded for tokenization and stopword filtering.
-nltk.download('punkt')
-nltk.download('stopwords')
-nltk.download('punkt_tab')
+# Version of the chunking and keyword extraction code, recorded with every corpus.
+# Bump it when their output changes so existing corpora are re-chunked.
+INGEST_PIPELINE_VERSION = 2
 
-def extract_text_from_pdf(pdf_path):
+def extract_text_from_pdf(pdf_path, start_page=0, end_page=None):
     '''
-    Extracts and returns text content from a PDF file.
+    Extracts and returns text content from a PDF file, optionally limited to the
+    pages in [start_page, end_page).
     '''
-    text = ""
+    pages = []
     try:
         reader = PdfReader(pdf_path)
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
+        for page in reader.pages[start_page:end_page]:
+            pages.append(page.extract_text() + "\n")
     except Exception as e:
         print(f"Error reading {pdf_path}: {e}")
-    return text
+    return "".join(pages)
 
-def group_sentences_into_chunks(sentences, chunk_size=CHUNK_SIZE, overlap=OVERLAP):
+def count_pdf_pages(pdf_path):
     '''
-    Groups a list of sentences into overlapping chunks.
-    
-    Parameters:
-    - sentences: List of sentences.
-    - chunk_size: Number of sentences per chunk.
-    - overlap: Number of sentences to overlap between chunks.
+    Returns the number of pages in a PDF file, or 0 if it cannot be read.
+    '''
+    try:
+        return len(PdfReader(pdf_path).pages)
+    except Exception as e:
+        print(f"Error reading {pdf_path}: {e}")
+        return 0
+
+def plan_extraction_tasks(pdf_files, pages_per_task=INGEST_PAGES_PER_TASK):
+    '''
+    Splits PDF files into page ranges so large documents are extracted by several workers.
     
     Returns:
-    - List of text chunks.
+    - A list of (pdf_path, start_page, end_page) tuples, in file and page order.
     '''
-    chunks = []
-    i = 0
-    # Slide through the sentence list using the specified chunk size and overlap.
-    while i < len(sentences):
-        chunk = " ".join(sentences[i: i+chunk_size])
-        chunks.append(chunk)
-        i += (chunk_size - overlap)
-    return chunks
+    tasks = []
+    for pdf_file in pdf_files:
+        num_pages = count_pdf_pages(pdf_file)
+        # Files that cannot be read still get one task, which reports the error and returns no text.
+        for start in range(0, max(num_pages, 1), pages_per_task):
+            tasks.append((pdf_file, start, start + pages_per_task))
+    return tasks
 
-def extract_keywords_from_text(text, top_n=20):
+def extract_page_range(task):
     '''
-    Extracts the top_n most frequent keywords from the provided text.
-    
-    Process:
-    - Tokenizes text.
-    - Filters out stopwords and non-alphabetic tokens.
-    - Uses frequency analysis to determine the most common words.
+    Process pool worker: extracts the text of one (pdf_path, start_page, end_page) range.
+    '''
+    pdf_path, start_page, end_page = task
+    return extract_text_from_pdf(pdf_path, start_page, end_page)
+
+def prepare_document(pdf_path, text):
+    '''
+    Turns the extracted text of one PDF into everything but its embeddings:
+    - Splits the text into sentences and groups them into overlapping chunks of CHUNK_SIZE sentences.
+    - Extracts keywords from the text and from every chunk.
     
     Returns:
-    - A list of keywords.
-    '''
-    # Tokenize the lowercased text.
-    tokens = word_tokenize(text.lower())
-    stop_words = set(stopwords.words('english'))
-
-    # Filter tokens: keep only alphabetic words not in the stopwords list.
-    tokens = [t for t in tokens if t.isalpha() and t not in stop_words]
-    freq = Counter(tokens)
-    most_common = freq.most_common(top_n)
-    keywords = [word for word, count in most_common]
-    return keywords
-
-def process_pdf(pdf_path, model):
-    '''
-    Processes a PDF file by:
-    - Extracting text.
-    - Splitting text into sentences and grouping them into chunks.
-    - Computing embeddings for each chunk using the provided model.
-    - Extracting keywords from the text.
+    - A dictionary containing the source filename, text chunks, document keywords,
+      and per-chunk keyword lists.
+    '''
+    # Split the text into sentences and chunks, tokenizing every sentence once for all keywords.
+    # Chunk keywords are stored, so retrieval does not re-tokenize chunks per SOP statement.
+    analysis = analyze_document(text, CHUNK_SIZE, OVERLAP, doc_top_n=20, chunk_top_n=10)
+    return dict(analysis, source=os.path.basename(pdf_path))
+
+def prepare_document_task(task):
+    '''
+    Process pool worker: runs prepare_document on a (pdf_path, text) pair.
+    '''
+    return prepare_document(*task)
+
+def encode_documents(docs, model, cache=None):
+    '''
+    Computes the chunk embeddings of many documents in one pass, so batches are filled across
+    document boundaries. Chunks are batched by token length to reduce padding.
+    With an embedding cache, only chunk texts without a cached vector are encoded.
+    Adds an "embeddings" entry to every document.
+    '''
+    all_chunks = [chunk for doc in docs for chunk in doc["chunks"]]
+    if not all_chunks:
+        for doc in docs:
+            doc["embeddings"] = []
+        return docs
+
+    def encode(texts):
+        return encode_texts(model, texts, show_progress_bar=True)
+
+    if cache is not None:
+        embeddings = cache.encode(all_chunks, encode)
+    else:
+        embeddings = encode(all_chunks)
+
+    start = 0
+    # Hand every document its slice of the embeddings.
+    for doc in docs:
+        end = start + len(doc["chunks"])
+        doc["embeddings"] = embeddings[start:end]
+        start = end
+    return docs
+
+def extract_documents(pdf_files, workers=INGEST_WORKERS):
+    '''
+    Extracts and prepares many PDF files in parallel:
+    - Extracts text of page ranges in a process pool, so large PDFs use several workers.
+    - Splits sentences, chunks and extracts keywords per document in the same pool.
     
     Returns:
-    - A dictionary containing the source filename, text chunks, embeddings, and keywords.
+    - A list of document dictionaries from prepare_document, in file order.
     '''
-    print(f"Processing: {pdf_path}")
-    # Extract text from the PDF.
-    text = extract_text_from_pdf(pdf_path)
-
-    # Split text into individual sentences.
-    sentences = sent_tokenize(text)
+    if not pdf_files:
+        return []
+    workers = workers or os.cpu_count() or 1
+    extraction_tasks = plan_extraction_tasks(pdf_files)
+    for pdf_file in pdf_files:
+        print(f"Processing: {pdf_file}")
 
-    # Group sentences into chunks using a sliding window approach.
-    chunks = group_sentences_into_chunks(sentences)
+    # With a single worker everything runs in this process.
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    pool_map = executor.map if executor else map
+    try:
+        page_texts = list(pool_map(extract_page_range, extraction_tasks))
 
-    # Compute embeddings for each text chunk.
-    embeddings = model.encode(chunks)
+        # Reassemble each document's text from its page ranges, in page order.
+        texts = {pdf_file: [] for pdf_file in pdf_files}
+        for (pdf_file, _, _), page_text in zip(extraction_tasks, page_texts):
+            texts[pdf_file].append(page_text)
+        document_tasks = [(pdf_file, "".join(texts[pdf_file])) for pdf_file in pdf_files]
 
-    # Extract keywords from the complete text.
-    keywords = extract_keywords_from_text(text, top_n=20)
+        return list(pool_map(prepare_document_task, document_tasks))
+    finally:
+        if executor:
+            executor.shutdown()
 
-    # Package all processed data into a dictionary.
-    data = {
-        "source": os.path.basename(pdf_path),
-        "chunks": chunks,
-        "embeddings": [emb.tolist() for emb in embeddings],
-        "keywords": keywords
+def current_ingest_params():
+    '''
+    Returns the parameters that determine the chunks of a document. A corpus built with
+    different parameters has to be re-chunked.
+    '''
+    return {
+        "pipeline_version": INGEST_PIPELINE_VERSION,
+        "chunk_size": CHUNK_SIZE,
+        "overlap": OVERLAP,
+        "embedding_model": embedding_model_id()
     }
-    return data
+
+def seed_embedding_cache(cache, corpus, manifest, sources):
+    '''
+    Adds the chunk embeddings already on disk for the given (new or changed) documents to the
+    embedding cache, so their unchanged chunk texts are never re-encoded: the stored rows of
+    those documents (if the corpus was built with the same model and backend) and per-PDF
+    pickles written by older versions (fp32 only). Unchanged documents are copied as they are
+    and need no lookups.
+    '''
+    if corpus is not None and manifest.get("ingest_params", {}).get("embedding_model") == embedding_model_id():
+        chunks = corpus["chunks"]
+        rows = [row for source, (start, end) in zip(corpus["sources"], corpus["doc_ranges"]) if source in sources
+                for row in range(start, end)]
+        missing_rows = [row for row in rows if cache.get(chunks[row]) is None]
+        if missing_rows:
+            cache.add([chunks[row] for row in missing_rows], corpus["embeddings"][missing_rows])
+    # Pickles of older versions always hold fp32 embeddings of EMBEDDING_MODEL_NAME.
+    if embedding_model_id() != EMBEDDING_MODEL_NAME:
+        return
+    for doc in load_legacy_pickles():
+        if doc["chunks"] and doc["source"] in sources:
+            cache.add(doc["chunks"], doc["embeddings"])
 
 def process_regulatory_files():
     '''
-    Processes all regulatory PDF files in the specified directory.
-    For each file:
-    - Processes the file using process_pdf.
-    - Saves the processed data as a pickle file.
-    Skips files that have already been processed.
+    Incrementally processes the regulatory PDF files in the specified directory.
+    
+    Process:
+    - Hashes every PDF and compares it with the content hash and ingest parameters recorded
+      in the corpus manifest.
+    - Reuses stored documents that are unchanged; extracts new or changed files in parallel
+      and encodes them in one shared queue; drops documents whose PDF has been deleted.
+    - Reuses the embedding of every chunk text that has been embedded before (embedding cache),
+      so changed parameters or revised PDFs only encode chunks with new text.
+    - Writes the memory-mapped corpus store (CORPUS_DIR), refits the corpus TF-IDF model and
+      rebuilds the ANN index (ANN_DIR).
+    Nothing is rewritten when no file and no parameter has changed.
     '''
     # Create the processed files directory if it doesn't exist.
     if not os.path.exists(PROCESSED_DIR):
         os.makedirs(PROCESSED_DIR)
-    
-    # Initialize the SentenceTransformer model.
-    model = SentenceTransformer(EMBEDDING_MODEL_NAME)
 
-    # Retrieve all PDF files from the regulatory documents directory.
-    pdf_files = glob.glob(os.path.join(REGULATORY_DOCS_DIR, "*.pdf"))
-    for pdf_file in pdf_files:
-        output_file = os.path.join(PROCESSED_DIR, os.path.basename(pdf_file) + ".pkl")
-        if os.path.exists(output_file):
-            print(f"Already processed {pdf_file}, skipping.")
-            continue
-        data = process_pdf(pdf_file, model)
-        # Save the processed data to a pickle file.
-        with open(output_file, "wb") as f:
-            pickle.dump(data, f)
-        print(f"Saved processed data for {pdf_file} to {output_file}")
+    # Retrieve all PDF files from the regulatory documents directory and hash their content.
+    pdf_files = sorted(glob.glob(os.path.join(REGULATORY_DOCS_DIR, "*.pdf")))
+    content_hashes = {os.path.basename(pdf_file): file_content_hash(pdf_file) for pdf_file in pdf_files}
+    params = current_ingest_params()
+
+    # Documents in the store can only be reused if they were built with the same parameters.
+    manifest = read_manifest(CORPUS_DIR)
+    corpus = load_processed_data()
+    reusable = {}
+    if manifest is not None and manifest.get("ingest_params") == params:
+        for doc_id, doc in enumerate(manifest["documents"]):
+            if content_hashes.get(doc["source"]) == doc.get("content_hash"):
+                reusable[doc["source"]] = doc_id
+    changed_files = [pdf_file for pdf_file in pdf_files if os.path.basename(pdf_file) not in reusable]
+    deleted = [] if manifest is None else [doc["source"] for doc in manifest["documents"] if doc["source"] not in content_hashes]
+    legacy_files = glob.glob(os.path.join(PROCESSED_DIR, "*.pkl"))
+
+    if (manifest is not None and not changed_files and not deleted and not legacy_files
+            and manifest["dtype"] == EMBEDDING_DTYPE):
+        print("All regulatory documents are up to date, skipping.")
+        # A model fitted on an earlier version of the corpus (e.g. an interrupted ingest) is refitted.
+        if not has_tfidf_model(fingerprint=corpus_fingerprint(corpus)):
+            fit_corpus_tfidf()
+        if load_ann_index(corpus) is None:
+            build_corpus_ann()
+        return
+    for source in deleted:
+        print(f"Dropping {source}: PDF no longer exists.")
+
+    # Extract and chunk every new or changed file in parallel.
+    with metrics.stage("ingest.extract"):
+        new_docs = extract_documents(changed_files)
+    metrics.count("ingest_documents_total", len(changed_files))
+
+    # Encode only chunk texts that were never embedded with this model.
+    with metrics.stage("ingest.encode"):
+        cache = EmbeddingCache()
+        seed_embedding_cache(cache, corpus, manifest, {os.path.basename(pdf_file) for pdf_file in changed_files})
+        all_chunks = [chunk for doc in new_docs for chunk in doc["chunks"]]
+        model = get_embedding_model() if cache.missing(all_chunks) else None
+        encode_documents(new_docs, model, cache=cache)
+    print(f"Embedding cache: {cache.hits} chunks reused, {cache.misses} encoded.")
+    metrics.count("ingest_chunks_total", cache.hits, result="reused")
+    metrics.count("ingest_chunks_total", cache.misses, result="encoded")
+    new_docs = {doc["source"]: doc for doc in new_docs}
+
+    def iter_documents():
+        # Stream documents into the store one at a time: reused ones straight from the memory map.
+        for pdf_file in pdf_files:
+            source = os.path.basename(pdf_file)
+            if source in reusable:
+                print(f"Unchanged {pdf_file}, skipping.")
+                doc = read_corpus_document(corpus, reusable[source])
+            else:
+                doc = new_docs.pop(source)
+            doc["content_hash"] = content_hashes[source]
+            yield doc
+
+    with metrics.stage("ingest.write"):
+        manifest = write_corpus(iter_documents(), ingest_params=params)
+        cache.save()
+    print(f"Saved {manifest['num_chunks']} chunks from {len(manifest['documents'])} documents to {CORPUS_DIR}")
+    metrics.gauge("corpus_chunks", manifest["num_chunks"])
+
+    # Embeddings from legacy pickles now live in the embedding cache.
+    for legacy_file in legacy_files:
+        os.remove(legacy_file)
+        print(f"Removed legacy file {legacy_file}")
+
+    # Refit the corpus TF-IDF model so its vocabulary and IDF cover every processed document.
+    fit_corpus_tfidf()
+
+    # Rebuild the ANN index over the new embedding matrix.
+    build_corpus_ann()
+
+def fit_corpus_tfidf():
+    '''
+    Fits one TF-IDF model over the chunks of all processed regulatory documents and saves it
+    next to the processed data with the corpus fingerprint, so query time only has to transform
+    the SOP statements.
+    '''
+    corpus = load_processed_data()
+    if corpus is None or not len(corpus["chunks"]):
+        print("No regulatory chunks found, skipping TF-IDF model.")
+        return
+    with metrics.stage("ingest.tfidf"):
+        vectorizer, matrix = fit_tfidf_model(corpus)
+        save_tfidf_model(vectorizer, matrix, corpus["sources"], corpus["doc_ranges"], corpus_fingerprint(corpus))
+    print(f"Saved corpus TF-IDF model ({matrix.shape[0]} chunks, {matrix.shape[1]} terms) to {TFIDF_DIR}")
+
+def build_corpus_ann():
+    '''
+    Builds the IVF index over the chunk embeddings of all processed regulatory documents and
+    saves it with the fingerprint of the corpus, so retrieval can fetch semantic candidates
+    without scoring every chunk.
+    '''
+    corpus = load_processed_data()
+    if corpus is None or not len(corpus["chunks"]):
+        print("No regulatory chunks found, skipping ANN index.")
+        return
+    with metrics.stage("ingest.ann"):
+        ann = build_ivf_index(corpus["embeddings"])
+        save_ann_index(ann, corpus_fingerprint(corpus))
+    print(f"Saved ANN index ({len(ann['centroids'])} lists over {len(ann['list_rows'])} chunks) to {ANN_DIR}")
 
 # if __name__ == "__main__":
 #     process_regulatory_files()
@@ -1,97 +1,218 @@
+import os
+import glob
+import json
+import hashlib
+from collections import deque
 from tqdm import tqdm
-from sklearn.metrics.pairwise import cosine_similarity
-from nltk.tokenize import sent_tokenize
-import numpy as np
-from sentence_transformers import SentenceTransformer
 from config import *
 from utils import *
+from retrieval import *
+from corpus_store import read_manifest
+from embedding_cache import EmbeddingCache
+from embedding_backend import encode_texts
+from metrics import metrics
+from retrieval_pool import open_retrieval_pool
+from text_engine import split_sentences
 
 
+def load_retrieval_index():
+    '''
+    Opens the processed regulatory corpus (memory-mapped, no copy) and builds the retrieval
+    index over every regulatory chunk with the corpus TF-IDF model.
+    '''
+    corpus = load_processed_data()
+    if corpus is None:
+        raise FileNotFoundError(f"No processed regulatory documents found in {CORPUS_DIR}. Set REPROCESS_DOCS = True to build them.")
+    with metrics.stage("retrieval.load_index"):
+        tfidf_model = load_tfidf_model()
+        with startup_step("retrieval index"):
+            index = build_retrieval_index(corpus, tfidf_model)
+    metrics.gauge("corpus_chunks", len(corpus["chunks"]))
+    return index
+
+def split_sop_text(sop_text):
+    '''
+    Tokenizes SOP text into sentences and combines short sentences into statements.
+    '''
+    raw_sentences = split_sentences(sop_text)
+    return combine_short_sentences(raw_sentences, min_words=MIN_SOP_WORDS)
+
+def load_sop_statements(sop_path=SOP_DOC_PATH):
+    '''
+    Processes the SOP document: extracts text, tokenizes it into sentences, and combines short sentences.
+
+    Returns:
+    - The list of SOP statements.
+    '''
+    return split_sop_text(extract_text_from_docx(sop_path))
+
+def run_fingerprint(sop_sentences):
+    '''
+    Returns a hash of everything that determines the tasks of a run and their replies:
+    the SOP statements, the regulatory corpus, the retrieval settings and the API model.
+    An interrupted run can only be resumed by a run with the same fingerprint.
+    '''
+    manifest = read_manifest(CORPUS_DIR) or {}
+    payload = {
+        "statements": sop_sentences,
+        "documents": [(doc["source"], doc.get("content_hash")) for doc in manifest.get("documents", [])],
+        "ingest_params": manifest.get("ingest_params"),
+        "retrieval": [CHUNK_TOP_K, ALPHA, BETA, GAMMA, MIN_RELEVANCE_SCORE],
+        "ann": [USE_ANN_INDEX, ANN_MIN_CHUNKS, ANN_NLIST, ANN_NPROBE, ANN_CANDIDATES],
+        "api": [CLAUDE_MODEL, CLAUDE_MAX_TOKENS]
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+def iter_tasks(index, sop_sentences, skip=(), batch_size=RETRIEVAL_BATCH_SIZE, model=None, cache=None, pool=None):
+    '''
+    Yields analysis tasks block by block, as soon as each block of SOP statements has been
+    embedded and matched with regulatory chunks.
+
+    Parameters:
+    - index: Retrieval index from load_retrieval_index.
+    - sop_sentences: List of SOP statements.
+    - skip: Statement indices that need no task (e.g. already done in an interrupted run).
+    - batch_size: Statements embedded and scored together.
+    - model: Embedding model for the SOP statements; the process-wide model is loaded
+      on the first cache miss if omitted, so a run with nothing new to embed never loads it.
+    - cache: EmbeddingCache to use (e.g. one shared by many runs); the saved cache is opened if omitted.
+    - pool: RetrievalPool from open_retrieval_pool. Blocks are then scored in its worker
+      processes while later blocks are embedded, with the same tasks in the same order as
+      without a pool. Blocks are sized so every worker gets two (at most batch_size and at
+      least RETRIEVAL_MIN_BLOCK_SIZE statements); runs that fit one block are scored in this process.
+
+    Statement embeddings go through the embedding cache shared with ingest, so statements
+    embedded in an earlier run are not encoded again.
+
+    Yields:
+    - Task tuples (index, SOP statement, regulatory context, best fused retrieval score).
+    '''
+    pending = [idx for idx in range(len(sop_sentences)) if idx not in skip]
+    if not pending:
+        return
+    cache = cache if cache is not None else EmbeddingCache()
+    if pool is not None:
+        # Two blocks per worker keep every worker busy while the next block is embedded.
+        per_worker = -(-len(pending) // (2 * pool.workers))
+        batch_size = min(batch_size, max(RETRIEVAL_MIN_BLOCK_SIZE, per_worker))
+        if len(pending) <= batch_size:
+            pool = None
+
+    def encode(texts):
+        return encode_texts(model if model is not None else get_embedding_model(), texts)
+
+    def block_tasks(block, statements, contexts):
+        metrics.count("retrieval_statements_total", len(block))
+        return [(idx, statement, regulatory_context, best_score)
+                for idx, statement, (regulatory_context, best_score) in zip(block, statements, contexts)]
+
+    # Blocks scored in the pool, oldest first; a few per worker keep every worker busy.
+    in_flight = deque()
+    try:
+        for start in range(0, len(pending), batch_size):
+            block = pending[start:start + batch_size]
+            statements = [sop_sentences[idx] for idx in block]
+            # Compute embeddings for the block of SOP statements in one batch, reusing cached ones.
+            with metrics.stage("retrieval.embed"):
+                sop_embeddings = cache.encode(statements, encode)
+            if pool is not None:
+                in_flight.append((block, statements, pool.submit(statements, sop_embeddings)))
+                while len(in_flight) > 2 * pool.workers:
+                    block, statements, future = in_flight.popleft()
+                    with metrics.stage("retrieval.score"):
+                        contexts = future.result()
+                    yield from block_tasks(block, statements, contexts)
+                continue
+            # Score the block against all regulatory chunks and keep the top K chunks per statement.
+            # The block is materialized inside the stage, so consumer time is not counted as scoring.
+            with metrics.stage("retrieval.score"):
+                contexts = retrieve_contexts(index, statements, sop_embeddings)
+            yield from block_tasks(block, statements, contexts)
+        while in_flight:
+            block, statements, future = in_flight.popleft()
+            with metrics.stage("retrieval.score"):
+                contexts = future.result()
+            yield from block_tasks(block, statements, contexts)
+    finally:
+        for _, _, future in in_flight:
+            future.cancel()
+        cache.save()
+        metrics.count("statement_embeddings_total", cache.hits, result="cached")
+        metrics.count("statement_embeddings_total", cache.misses, result="encoded")
+
 def generate_tasks():
     '''
     Generates analysis tasks by matching each SOP statement with relevant regulatory document chunks.
-    
+
     Process:
-    - Loads the embedding model and processed regulatory documents.
-    - Constructs a regulatory documents dictionary with keywords, chunks, and embeddings.
+    - Loads the embedding model and opens the memory-mapped regulatory corpus.
+    - Builds a retrieval index over the normalized chunk embedding matrix.
     - Processes the SOP document (extracts text, tokenizes sentences, combines short sentences).
-    - Precomputes embeddings for all SOP statements.
-    - For each SOP statement:
-      * Extracts keywords and computes similarity scores (Jaccard, semantic, TF-IDF) with regulatory chunks.
-      * Selects top candidate chunks and combines them into a regulatory context.
-      * Creates a task tuple (index, SOP statement, regulatory context).
-    
+    - Embeds blocks of SOP statements and scores each block against all chunks with one matrix
+      product, fusing semantic, TF-IDF and keyword similarities, and keeps the top K chunks
+      with a partial sort. With RETRIEVAL_WORKERS, blocks are scored in worker processes.
+    - For each SOP statement, combines the selected chunks into a regulatory context and
+      creates a task tuple (index, SOP statement, regulatory context, best fused score).
+
     Returns:
     - A list of tasks for further processing.
     '''
-    # Load the embedding model
-    model = SentenceTransformer(EMBEDDING_MODEL_NAME)
-    # Load all processed regulatory documents.
-    processed_docs = load_processed_data()
-    
-    # Build a dictionary of regulatory documents keyed by source filename.
-    reg_docs = {}
-    for doc in processed_docs:
-        reg_docs[doc["source"]] = {
-            "keywords": set(doc["keywords"]),
-            "chunks": doc["chunks"],
-            "embeddings": np.array(doc["embeddings"])
-        }
-    
-    # Process the SOP document: extract text, tokenize into sentences, and combine short sentences.
-    sop_text = extract_text_from_docx(SOP_DOC_PATH)
-    raw_sentences = sent_tokenize(sop_text)
-    sop_sentences = combine_short_sentences(raw_sentences, min_words=MIN_SOP_WORDS)
-    
-    # Compute embeddings for all SOP statements in one batch.
-    sop_embeddings = model.encode(sop_sentences)
-    
-    tasks = []
-    # Iterate over each SOP statement to create an analysis task.
-    for idx, sop_statement in enumerate(tqdm(sop_sentences, desc="Processing SOP")):
-        # Extract keywords from the SOP statement.
-        sop_keywords = extract_keywords_from_text(sop_statement, top_n=20)
-        sop_emb = sop_embeddings[idx]
-        
-        # Compute Jaccard similarity between SOP keywords and each regulatory document's keywords.
-        doc_scores = {}
-        for source, doc_data in reg_docs.items():
-            doc_scores[source] = compute_jaccard(sop_keywords, doc_data["keywords"])
-        # Select the top 2 regulatory documents based on similarity score.
-        selected_docs = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)[:2]
-        selected_sources = [source for source, score in selected_docs if score > 0]
-        # If no document scores above zero, consider all regulatory documents.
-        if not selected_sources:
-            selected_sources = list(reg_docs.keys())
-        
-        # Evaluate candidate regulatory chunks using multiple similarity metrics.
-        candidate_chunks = []
-        for source in selected_sources:
-            doc_data = reg_docs[source]
-            chunks = doc_data["chunks"]
-            embeddings = doc_data["embeddings"]
-            # Compute semantic similarity using cosine similarity.
-            semantic_sim_vector = cosine_similarity([sop_emb], embeddings)[0]
-            # Compute TF-IDF similarity between the SOP statement and each regulatory chunk.
-            tfidf_sim_vector = compute_tfidf_similarity_batch(sop_statement, chunks)
-            
-            for j, chunk_text in enumerate(chunks):
-                # Extract keywords from the regulatory chunk.
-                chunk_keywords = extract_keywords_from_text(chunk_text, top_n=10)
-                # Compute keyword similarity using Jaccard similarity.
-                keyword_sim = compute_jaccard(sop_keywords, chunk_keywords)
-                # Combine the similarity metrics using weighted factors
-                final_score = ALPHA * semantic_sim_vector[j] + BETA * tfidf_sim_vector[j] + GAMMA * keyword_sim
-                candidate_chunks.append((final_score, source, chunk_text))
-        
-        # Sort candidate chunks by the final weighted score in descending order.
-        candidate_chunks = sorted(candidate_chunks, key=lambda x: x[0], reverse=True)
-        # Select the top K chunks.
-        selected_chunks = [chunk for score, source, chunk in candidate_chunks[:CHUNK_TOP_K]]
-        # Combine the selected chunks into a single regulatory context.
-        regulatory_context = "\n\n".join(selected_chunks)
-        
-        # Append the task as a tuple: (task index, SOP statement, regulatory context).
-        tasks.append((idx, sop_statement, regulatory_context))
-    
+    index = load_retrieval_index()
+    sop_sentences = load_sop_statements()
+
+    # The embedding model is loaded once per process, on the first block of statements.
+    # With RETRIEVAL_WORKERS, blocks are scored in worker processes sharing the index.
+    pool = open_retrieval_pool(index)
+    try:
+        tasks = list(tqdm(iter_tasks(index, sop_sentences, pool=pool), total=len(sop_sentences), desc="Processing SOP"))
+    finally:
+        if pool is not None:
+            pool.close()
     return tasks
+
+def find_sop_documents(pattern):
+    '''
+    Returns the sorted SOP DOCX paths in a directory, or matching a glob pattern.
+    Temporary Word lock files (~$...) are ignored.
+    '''
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.docx")
+    paths = glob.glob(pattern, recursive=True)
+    return sorted(path for path in paths if path.lower().endswith(".docx") and not os.path.basename(path).startswith("~$"))
+
+def generate_batch_tasks(sop_paths):
+    '''
+    Generates analysis tasks for many SOP documents in one pass.
+
+    Process:
+    - Loads the embedding model and the retrieval index once.
+    - Processes every SOP document into statements. Documents that cannot be read are reported
+      and get no tasks.
+    - Embeds and scores the statements of all documents together, in blocks of RETRIEVAL_BATCH_SIZE
+      (in RETRIEVAL_WORKERS processes).
+
+    Returns:
+    - A tuple (tasks, spans): the tasks of all documents in order, indexed across documents,
+      and for every document the (start, end) range of its tasks, or None if it could not be read.
+    '''
+    index = load_retrieval_index()
+
+    all_sentences = []
+    spans = []
+    for sop_path in sop_paths:
+        try:
+            sop_sentences = load_sop_statements(sop_path)
+        except Exception as e:
+            print(f"Error reading SOP document {sop_path}: {e}")
+            spans.append(None)
+            continue
+        spans.append((len(all_sentences), len(all_sentences) + len(sop_sentences)))
+        all_sentences.extend(sop_sentences)
+
+    pool = open_retrieval_pool(index)
+    try:
+        tasks = list(tqdm(iter_tasks(index, all_sentences, pool=pool), total=len(all_sentences), desc="Processing SOPs"))
+    finally:
+        if pool is not None:
+            pool.close()
+    return tasks, spans
@@ -0,0 +1,149 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from config import *
+
+
+def response_cache_key(prompt, model=CLAUDE_MODEL, max_tokens=CLAUDE_MAX_TOKENS):
+    '''
+    Returns the cache key of a request: a SHA-256 over model, max_tokens and prompt,
+    which fully determine the request sent to the Claude API.
+    '''
+    digest = hashlib.sha256()
+    digest.update(f"{model}\n{max_tokens}\n".encode("utf-8"))
+    digest.update(prompt.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    '''
+    Persistent SQLite cache of Claude API replies, keyed by response_cache_key.
+
+    - Entries older than max_age_days are never returned and are evicted.
+    - Beyond max_entries, the least recently used entries are evicted.
+    - Eviction runs on open and every RESPONSE_CACHE_EVICT_INTERVAL stores, so a long-running
+      process (--serve) stays within both limits.
+    - Empty replies are never stored; failed calls raise before anything is stored.
+    - Hits only read the database; their last-used times are written in one transaction per
+      RESPONSE_CACHE_TOUCH_BATCH hits, with the next store, eviction, or on close().
+    Safe to share between threads.
+    '''
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES, max_age_days=RESPONSE_CACHE_MAX_AGE_DAYS):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        # Last-used times of hits not written yet, by key.
+        self.touched = {}
+        self.evict()
+
+    def get(self, prompt):
+        '''
+        Returns the cached reply for a prompt, or None on a miss.
+        '''
+        key = response_cache_key(prompt)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.max_age and now - row[1] > self.max_age):
+                self.misses += 1
+                return None
+            self.touched[key] = now
+            if len(self.touched) >= RESPONSE_CACHE_TOUCH_BATCH:
+                self.write_touched()
+                self.connection.commit()
+            self.hits += 1
+        return row[0]
+
+    def write_touched(self):
+        '''
+        Writes the pending last-used times of hits; the caller holds the lock and commits.
+        '''
+        if self.touched:
+            self.connection.executemany("UPDATE responses SET last_used = ? WHERE key = ?",
+                                        [(last_used, key) for key, last_used in self.touched.items()])
+            self.touched = {}
+
+    def put(self, prompt, response):
+        '''
+        Stores a reply for a prompt, evicting every RESPONSE_CACHE_EVICT_INTERVAL stores.
+        Empty replies are ignored.
+        '''
+        if not response or not response.strip():
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (response_cache_key(prompt), CLAUDE_MODEL, response, now, now)
+            )
+            self.write_touched()
+            self.connection.commit()
+            self.stores += 1
+            evict_due = RESPONSE_CACHE_EVICT_INTERVAL and self.stores % RESPONSE_CACHE_EVICT_INTERVAL == 0
+        if evict_due:
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes expired entries and the least recently used entries beyond max_entries.
+
+        Returns:
+        - The number of removed entries.
+        '''
+        with self.lock:
+            # Recent hits count as used before the least recently used entries are chosen.
+            self.write_touched()
+            removed = 0
+            if self.max_age:
+                removed += self.connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,)).rowcount
+            if self.max_entries:
+                removed += self.connection.execute(
+                    "DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)",
+                    (self.max_entries,)
+                ).rowcount
+            self.connection.commit()
+        return removed
+
+    def stats(self):
+        '''
+        Returns hit/miss/store counters for this run and the number of cached entries.
+        '''
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": entries
+        }
+
+    def close(self):
+        '''
+        Writes the pending last-used times and closes the database. Closing twice does nothing.
+        '''
+        with self.lock:
+            if self.connection is None:
+                return
+            self.write_touched()
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,350 @@
+import numpy as np
+from scipy import sparse
+from config import *
+from utils import *
+from ann_index import load_ann_index, search_ivf, corpus_fingerprint
+from text_engine import analyze_statements
+
+# Chunk embeddings stored as float16 are converted to float32 this many rows at a time while scoring.
+UPCAST_BLOCK_ROWS = 16384
+
+
+def build_keyword_postings(keyword_sets, vocabulary):
+    '''
+    Collects the postings of an inverted keyword index: one (keyword, item) pair for every
+    keyword of every item (chunk or document). New keywords are added to the shared vocabulary.
+
+    Returns:
+    - A tuple (keyword ids, item ids, array with the keyword set size of every item).
+    '''
+    keyword_ids = []
+    item_ids = []
+    for item, keywords in enumerate(keyword_sets):
+        for keyword in keywords:
+            keyword_ids.append(vocabulary.setdefault(keyword, len(vocabulary)))
+            item_ids.append(item)
+    return keyword_ids, item_ids, np.array([len(keywords) for keywords in keyword_sets], dtype=np.float32)
+
+def postings_matrix(keyword_ids, item_ids, num_keywords, num_items):
+    '''
+    Assembles postings (keyword id, item id) pairs into a sparse binary (keywords x items) matrix.
+    '''
+    data = np.ones(len(keyword_ids), dtype=np.float32)
+    return sparse.csr_matrix((data, (keyword_ids, item_ids)), shape=(num_keywords, num_items))
+
+def keyword_query_matrix(index, keyword_sets):
+    '''
+    Encodes keyword sets as a sparse binary (queries x keywords) matrix over the index vocabulary.
+    Keywords missing from the vocabulary cannot match anything and are left out.
+    '''
+    vocabulary = index["keyword_vocab"]
+    rows = []
+    cols = []
+    for i, keywords in enumerate(keyword_sets):
+        for keyword in keywords:
+            keyword_id = vocabulary.get(keyword)
+            if keyword_id is not None:
+                rows.append(i)
+                cols.append(keyword_id)
+    data = np.ones(len(rows), dtype=np.float32)
+    return sparse.csr_matrix((data, (rows, cols)), shape=(len(keyword_sets), len(vocabulary)))
+
+def keyword_jaccard(query, query_sizes, postings, item_sizes):
+    '''
+    Computes the Jaccard similarity between every query keyword set and every indexed item
+    by counting shared postings in the inverted index.
+
+    Returns:
+    - A dense (queries x items) float32 matrix of Jaccard similarities.
+    '''
+    # Each shared keyword contributes one posting hit to the intersection count.
+    intersection = np.asarray((query @ postings).todense(), dtype=np.float32)
+    union = query_sizes[:, None] + item_sizes[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+def align_tfidf_model(tfidf_model, sources, doc_ranges, chunks, fingerprint=None):
+    '''
+    Reorders the rows of a saved corpus TF-IDF matrix to follow the document order of the retrieval index.
+
+    Returns:
+    - The aligned sparse chunk matrix, or None when the model was fitted on a different corpus:
+      its corpus fingerprint differs from fingerprint (documents with changed content keep their
+      source and row count), or its documents and row counts differ.
+    '''
+    if tfidf_model is None:
+        return None
+    if fingerprint is not None and tfidf_model.get("fingerprint") != fingerprint:
+        return None
+    saved_ranges = dict(zip(tfidf_model["sources"], tfidf_model["doc_ranges"]))
+    blocks = []
+    for source, (start, end) in zip(sources, doc_ranges):
+        saved = saved_ranges.get(source)
+        if saved is None or saved[1] - saved[0] != end - start:
+            return None
+        blocks.append(tfidf_model["matrix"][saved[0]:saved[1]])
+    if len(saved_ranges) != len(sources):
+        return None
+    return sparse.vstack(blocks, format="csr") if blocks else tfidf_model["matrix"][:0]
+
+def build_retrieval_index(corpus, tfidf_model=None):
+    '''
+    Builds a retrieval index over the processed regulatory corpus.
+
+    Process:
+    - Uses the memory-mapped, L2-normalized chunk embedding matrix of the corpus store directly.
+    - Maps every chunk row back to the document it belongs to.
+    - Builds inverted keyword indexes (keyword -> chunks, keyword -> documents) from the
+      keyword sets saved at ingest time.
+    - Attaches the corpus TF-IDF model fitted at ingest time. If it is missing or was fitted
+      on a different corpus (by fingerprint), a corpus model is fitted here instead.
+    - Attaches the ANN index built at ingest time when USE_ANN_INDEX is set and the corpus has
+      at least ANN_MIN_CHUNKS chunks; smaller corpora are scored exactly.
+
+    Returns:
+    - A dictionary with the sources, document row ranges, chunk-to-document mapping,
+      chunk texts, the normalized embedding matrix, the keyword postings, the TF-IDF model,
+      and the ANN index (or None).
+    '''
+    sources = corpus["sources"]
+    doc_ranges = corpus["doc_ranges"]
+    chunks = corpus["chunks"]
+    # Map every chunk row back to the document it belongs to.
+    chunk_doc = np.repeat(np.arange(len(sources)), doc_ranges[:, 1] - doc_ranges[:, 0])
+
+    # The chunk keywords are stored as a (chunks x keywords) CSR matrix; its transpose is the postings list.
+    vocabulary = {keyword: i for i, keyword in enumerate(corpus["keyword_vocab"])}
+    chunk_keyword_ids = np.asarray(corpus["chunk_keyword_ids"])
+    chunk_keyword_offsets = np.asarray(corpus["chunk_keyword_offsets"])
+    chunk_keywords = sparse.csr_matrix(
+        (np.ones(len(chunk_keyword_ids), dtype=np.float32), chunk_keyword_ids, chunk_keyword_offsets),
+        shape=(len(chunks), len(vocabulary))
+    )
+    chunk_keyword_counts = np.diff(chunk_keyword_offsets).astype(np.float32)
+    # Document keywords may add terms that no chunk has, so the postings share one extended vocabulary.
+    doc_rows, doc_cols, doc_keyword_counts = build_keyword_postings(corpus["doc_keywords"], vocabulary)
+    chunk_keywords.resize((len(chunks), len(vocabulary)))
+    chunk_postings = chunk_keywords.T.tocsr()
+    doc_postings = postings_matrix(doc_rows, doc_cols, len(vocabulary), len(sources))
+
+    # Reuse the corpus TF-IDF model from ingest when it covers exactly these documents.
+    tfidf_matrix = align_tfidf_model(tfidf_model, sources, doc_ranges, chunks, corpus_fingerprint(corpus))
+    if tfidf_matrix is not None:
+        tfidf_vectorizer = tfidf_model["vectorizer"]
+    elif len(chunks):
+        tfidf_vectorizer, tfidf_matrix = fit_tfidf_model(corpus)
+    else:
+        tfidf_vectorizer = None
+
+    ann = None
+    if USE_ANN_INDEX and len(chunks) >= max(ANN_MIN_CHUNKS, 1):
+        ann = load_ann_index(corpus)
+        if ann is None:
+            print("No ANN index matches the corpus; scoring every chunk. Run with REPROCESS_DOCS = True to build it.")
+
+    return {
+        "sources": sources,
+        "doc_ranges": doc_ranges,
+        "chunk_doc": chunk_doc,
+        "chunks": chunks,
+        "embeddings": corpus["embeddings"],
+        "keyword_vocab": vocabulary,
+        "chunk_postings": chunk_postings,
+        "chunk_keywords": chunk_keywords,
+        "chunk_keyword_counts": chunk_keyword_counts,
+        "doc_postings": doc_postings,
+        "doc_keyword_counts": doc_keyword_counts,
+        "tfidf_vectorizer": tfidf_vectorizer,
+        "tfidf_matrix": tfidf_matrix,
+        "ann": ann
+    }
+
+def select_candidate_chunks(index, doc_scores, top_docs=2):
+    '''
+    Selects, for every SOP statement, the chunks of the regulatory documents whose keywords
+    overlap the most with the statement keywords.
+
+    Parameters:
+    - index: Retrieval index from build_retrieval_index.
+    - doc_scores: (statements x documents) keyword Jaccard scores.
+    - top_docs: Number of documents kept per statement.
+
+    Returns:
+    - A boolean (statements x chunks) mask. Statements without any keyword overlap keep every chunk.
+    '''
+    # Stable sort keeps the original document order among ties.
+    ranked = np.argsort(-doc_scores, axis=1, kind="stable")[:, :top_docs]
+    doc_mask = np.zeros(doc_scores.shape, dtype=bool)
+    np.put_along_axis(doc_mask, ranked, np.take_along_axis(doc_scores, ranked, axis=1) > 0, axis=1)
+    # If no document scores above zero, consider all regulatory documents.
+    doc_mask[~doc_mask.any(axis=1)] = True
+    return doc_mask[:, index["chunk_doc"]]
+
+def top_k_per_row(scores, k):
+    '''
+    Selects the k highest entries of every row using a partial sort.
+
+    Returns:
+    - A tuple (indices, values) of shape (rows, k), each row ordered by descending score.
+    '''
+    k = min(k, scores.shape[1])
+    if k == 0:
+        empty = np.zeros((scores.shape[0], 0))
+        return empty.astype(np.int64), empty
+    # argpartition places the k largest entries first without sorting the whole row.
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    # Only the k selected entries are fully sorted.
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    indices = np.take_along_axis(part, order, axis=1)
+    values = np.take_along_axis(part_scores, order, axis=1)
+    return indices, values
+
+def semantic_scores(sop_matrix, embeddings):
+    '''
+    Computes the cosine similarity of every normalized statement embedding with every chunk embedding.
+
+    BLAS kernels compute the rows left over after their last full tile differently, so a statement's
+    scores would depend on how many statements share its block. The statements are padded with zero
+    rows to a multiple of SCORE_ROW_TILE, which makes the scores identical for any block size
+    (single process, streaming batches or retrieval workers).
+
+    Returns:
+    - A dense (statements x chunks) float32 matrix.
+    '''
+    rows = len(sop_matrix)
+    padded = np.zeros((-(-rows // SCORE_ROW_TILE) * SCORE_ROW_TILE, sop_matrix.shape[1]), dtype=np.float32)
+    padded[:rows] = sop_matrix
+    if embeddings.dtype == np.float32:
+        return (padded @ embeddings.T)[:rows]
+    # float16 stores are upcast UPCAST_BLOCK_ROWS chunks at a time, so no float32 copy of the
+    # whole matrix is made; every chunk's scores are the same as with a full upcast.
+    scores = np.empty((rows, len(embeddings)), dtype=np.float32)
+    for start in range(0, len(embeddings), UPCAST_BLOCK_ROWS):
+        block = np.asarray(embeddings[start:start + UPCAST_BLOCK_ROWS], dtype=np.float32)
+        scores[:, start:start + len(block)] = (padded @ block.T)[:rows]
+    return scores
+
+def score_statement_block(index, sop_statements, sop_embeddings):
+    '''
+    Computes fused relevance scores between a block of SOP statements and every regulatory chunk.
+
+    Process:
+    - Scores all statements against all chunks with one matrix product (semantic similarity).
+    - Computes keyword overlap with every chunk and document from the inverted keyword index.
+    - Scores all statements against all chunks with one sparse product of corpus TF-IDF vectors.
+    - Restricts each statement to the chunks of its candidate documents.
+    - Combines the metrics as ALPHA * semantic + BETA * TF-IDF + GAMMA * keyword overlap.
+
+    Returns:
+    - A (statements x chunks) float32 matrix; chunks outside the candidate documents score -inf.
+    '''
+    if not len(index["chunks"]):
+        return np.full((len(sop_statements), 0), -np.inf, dtype=np.float32)
+    sop_matrix = normalize_rows(sop_embeddings)
+    # Cosine similarity for every (statement, chunk) pair at once; stored embeddings are already normalized.
+    semantic = semantic_scores(sop_matrix, index["embeddings"])
+
+    # TF-IDF cosine similarity with the corpus model: rows are L2-normalized, so one sparse product suffices.
+    # Every statement is tokenized once, for TF-IDF and keywords.
+    sop_tokens, sop_keywords = analyze_statements(sop_statements, top_n=20)
+    sop_tfidf = index["tfidf_vectorizer"].transform(tfidf_input(sop_statements, sop_tokens))
+    tfidf_sim = (sop_tfidf @ index["tfidf_matrix"].T).toarray()
+
+    # Keyword overlap of every statement with every chunk and document, from shared postings.
+    query = keyword_query_matrix(index, sop_keywords)
+    query_sizes = np.array([len(keywords) for keywords in sop_keywords], dtype=np.float32)
+    keyword_sim = keyword_jaccard(query, query_sizes, index["chunk_postings"], index["chunk_keyword_counts"])
+    doc_sim = keyword_jaccard(query, query_sizes, index["doc_postings"], index["doc_keyword_counts"])
+
+    # Combine the similarity metrics using weighted factors, restricted to the candidate documents.
+    fused = (ALPHA * semantic + BETA * tfidf_sim + GAMMA * keyword_sim).astype(np.float32)
+    fused[~select_candidate_chunks(index, doc_sim)] = -np.inf
+    return fused
+
+def score_ann_candidates(index, sop_statements, sop_embeddings, nprobe=ANN_NPROBE, candidates=ANN_CANDIDATES):
+    '''
+    Computes fused relevance scores between a block of SOP statements and their ANN candidates.
+
+    Process:
+    - Fetches the candidates chunks most similar to every statement from the IVF index
+      (semantic similarity), scanning nprobe inverted lists over the whole corpus.
+    - Scores the statements against the union of all candidates of the block with one sparse
+      product each for TF-IDF and keyword overlap, and looks up the keyword overlap of every
+      candidate's document.
+    - Combines the metrics as ALPHA * semantic + BETA * TF-IDF + GAMMA * keyword overlap
+      + DELTA * document keyword overlap. Unlike exact scoring, documents are never filtered
+      out: the right chunk is often outside the statement's top documents by keywords.
+
+    Returns:
+    - A tuple (rows, fused) of (statements x candidates) matrices: candidate chunk rows and their
+      fused scores. Padding entries have row -1 and score -inf.
+    '''
+    rows, semantic = search_ivf(index["ann"], index["embeddings"], sop_embeddings, nprobe=nprobe, candidates=candidates)
+    valid = rows >= 0
+    # Score every statement against the union of the block's candidates, then pick each row's own.
+    union, positions = np.unique(np.where(valid, rows, 0), return_inverse=True)
+    positions = positions.reshape(rows.shape)
+
+    sop_tokens, sop_keywords = analyze_statements(sop_statements, top_n=20)
+    sop_tfidf = index["tfidf_vectorizer"].transform(tfidf_input(sop_statements, sop_tokens))
+    tfidf_sim = np.take_along_axis((sop_tfidf @ index["tfidf_matrix"][union].T).toarray(), positions, axis=1)
+
+    query = keyword_query_matrix(index, sop_keywords)
+    query_sizes = np.array([len(keywords) for keywords in sop_keywords], dtype=np.float32)
+    union_postings = index["chunk_keywords"][union].T.tocsr()
+    keyword_sim = keyword_jaccard(query, query_sizes, union_postings, index["chunk_keyword_counts"][union])
+    keyword_sim = np.take_along_axis(keyword_sim, positions, axis=1)
+    # Document keyword overlap only re-ranks the candidates.
+    doc_sim = keyword_jaccard(query, query_sizes, index["doc_postings"], index["doc_keyword_counts"])
+    doc_sim = np.take_along_axis(doc_sim, index["chunk_doc"][np.where(valid, rows, 0)], axis=1)
+
+    fused = (ALPHA * semantic + BETA * tfidf_sim + GAMMA * keyword_sim + DELTA * doc_sim).astype(np.float32)
+    fused[~valid] = -np.inf
+    return rows, fused
+
+def retrieve_top_chunks(index, sop_statements, sop_embeddings, top_k=CHUNK_TOP_K, batch_size=RETRIEVAL_BATCH_SIZE,
+                        nprobe=ANN_NPROBE, candidates=ANN_CANDIDATES):
+    '''
+    Retrieves the top_k regulatory chunks for every SOP statement.
+
+    Statements are scored in blocks of batch_size so the score matrix stays bounded
+    while still using one matrix product per block. With an ANN index, only the candidates
+    it returns (nprobe lists, candidates chunks per statement) are re-ranked; otherwise every
+    chunk of the candidate documents is scored. Statements without any candidate get no rows.
+
+    Yields:
+    - Tuples (statement index, chunk rows, fused scores), rows ordered by descending score.
+    '''
+    for start in range(0, len(sop_statements), batch_size):
+        end = min(start + batch_size, len(sop_statements))
+        if index.get("ann") is not None:
+            candidate_rows, fused = score_ann_candidates(index, sop_statements[start:end], sop_embeddings[start:end],
+                                                         nprobe=nprobe, candidates=candidates)
+            top_positions, top_scores = top_k_per_row(fused, top_k)
+            top_rows = np.take_along_axis(candidate_rows, top_positions, axis=1)
+        else:
+            fused = score_statement_block(index, sop_statements[start:end], sop_embeddings[start:end])
+            top_rows, top_scores = top_k_per_row(fused, top_k)
+        for offset in range(end - start):
+            # Drop entries outside the candidate documents, or padding of short candidate lists.
+            valid = np.isfinite(top_scores[offset])
+            yield start + offset, top_rows[offset][valid], top_scores[offset][valid]
+
+def build_regulatory_context(index, rows):
+    '''
+    Combines the selected regulatory chunks into a single regulatory context.
+    '''
+    return "\n\n".join(index["chunks"][row] for row in rows)
+
+def retrieve_contexts(index, sop_statements, sop_embeddings):
+    '''
+    Retrieves the regulatory context of every statement in a block.
+
+    Returns:
+    - A list of (regulatory context, best fused score) tuples, one per statement, in order.
+    '''
+    contexts = []
+    for offset, rows, scores in retrieve_top_chunks(index, sop_statements, sop_embeddings):
+        # Combine the selected chunks into a single regulatory context.
+        contexts.append((build_regulatory_context(index, rows), float(scores[0]) if len(scores) else 0.0))
+    return contexts
@@ -0,0 +1,159 @@
+import os
+import mmap
+import numpy as np
+from scipy import sparse
+from multiprocessing import get_context, shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from config import *
+from corpus_store import ChunkTexts
+from retrieval import retrieve_contexts
+
+# Retrieval index of a worker process, attached once by init_worker.
+worker_index = None
+# Shared memory blocks the worker's index arrays point into; kept open for the worker's lifetime.
+worker_blocks = []
+
+
+def share_array(array, blocks):
+    '''
+    Describes an array so worker processes can map it without a copy of their own.
+
+    - Memory-mapped corpus files (embeddings, chunk texts and offsets, ANN lists) are mapped again by path,
+      so all processes share the same page cache pages.
+    - Other arrays are copied once into a new shared memory block, which is added to blocks.
+
+    Returns:
+    - A picklable descriptor for attach_array.
+    '''
+    # Only a whole mapped file can be mapped again by path; views of it are copied.
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.flags.c_contiguous:
+        return ("file", array.filename, array.dtype.str, array.shape, array.offset)
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    blocks.append(block)
+    return ("shm", block.name, array.dtype.str, array.shape)
+
+def attach_array(descriptor):
+    '''
+    Maps an array described by share_array into this process.
+    '''
+    if descriptor[0] == "file":
+        _, path, dtype, shape, offset = descriptor
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+    _, name, dtype, shape = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    worker_blocks.append(block)
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    array.flags.writeable = False
+    return array
+
+def share_value(value, blocks):
+    '''
+    Describes one entry of the retrieval index: arrays, CSR matrices and chunk texts are shared
+    (see share_array), dictionaries holding arrays (the ANN index) are described entry by entry,
+    and everything else (sources, keyword vocabulary, TF-IDF vectorizer) is pickled as is.
+    '''
+    if isinstance(value, np.ndarray):
+        return ("array", share_array(value, blocks))
+    if sparse.isspmatrix_csr(value):
+        return ("csr", share_array(value.data, blocks), share_array(value.indices, blocks),
+                share_array(value.indptr, blocks), value.shape)
+    if isinstance(value, ChunkTexts):
+        return ("texts", share_array(value.blob, blocks), share_array(value.offsets, blocks))
+    if isinstance(value, dict) and any(isinstance(item, np.ndarray) for item in value.values()):
+        return ("dict", {key: share_value(item, blocks) for key, item in value.items()})
+    return ("object", value)
+
+def attach_value(descriptor):
+    '''
+    Rebuilds an index entry described by share_value on top of the shared arrays.
+    '''
+    kind = descriptor[0]
+    if kind == "array":
+        return attach_array(descriptor[1])
+    if kind == "csr":
+        _, data, indices, indptr, shape = descriptor
+        return sparse.csr_matrix((attach_array(data), attach_array(indices), attach_array(indptr)), shape=shape, copy=False)
+    if kind == "texts":
+        return ChunkTexts(attach_array(descriptor[1]), attach_array(descriptor[2]))
+    if kind == "dict":
+        return {key: attach_value(item) for key, item in descriptor[1].items()}
+    return descriptor[1]
+
+def init_worker(descriptors):
+    '''
+    Attaches the shared retrieval index in a new worker process. Workers use one BLAS thread
+    each, so a pool of N workers keeps N cores busy.
+    '''
+    global worker_index
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(1)
+    worker_index = {key: attach_value(descriptor) for key, descriptor in descriptors.items()}
+
+def score_shard(sop_statements, sop_embeddings):
+    '''
+    Scores one block of SOP statements against the worker's index (see retrieve_contexts).
+    '''
+    return retrieve_contexts(worker_index, sop_statements, sop_embeddings)
+
+
+class RetrievalPool:
+    '''
+    Process pool that scores blocks of SOP statements in parallel against one retrieval index.
+
+    - The index is placed in shared memory once, when the first block is submitted: the
+      memory-mapped embedding matrix, chunk texts, text offsets and ANN lists are mapped by
+      every worker from the corpus files, and the TF-IDF matrix, keyword postings and other
+      arrays are copied into shared memory blocks. No worker holds its own copy of the corpus.
+    - Every block is scored exactly as in a single process (retrieve_contexts), and results
+      are read in submission order, so the output is identical to single-process scoring.
+
+    Use as a context manager, or call close() to stop the workers and free the shared memory.
+    '''
+
+    def __init__(self, index, workers):
+        self.index = index
+        self.workers = workers
+        self.executor = None
+        self.blocks = []
+
+    def start(self):
+        '''
+        Shares the index and starts the worker processes.
+        '''
+        descriptors = {key: share_value(value, self.blocks) for key, value in self.index.items()}
+        # Spawned workers do not inherit the threads (event loop, torch) of the parent.
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("spawn"),
+                                            initializer=init_worker, initargs=(descriptors,))
+
+    def submit(self, sop_statements, sop_embeddings):
+        '''
+        Schedules one block of statements. Returns a future of its retrieve_contexts result.
+        '''
+        if self.executor is None:
+            self.start()
+        return self.executor.submit(score_shard, sop_statements, np.asarray(sop_embeddings))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_retrieval_pool(index, workers=RETRIEVAL_WORKERS):
+    '''
+    Returns a RetrievalPool with workers processes (None = all CPU cores), or None when
+    retrieval runs in a single process (workers of 1). Worker processes start on first use.
+    '''
+    workers = workers or os.cpu_count() or 1
+    return RetrievalPool(index, workers) if workers > 1 else None
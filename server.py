@@ -0,0 +1,285 @@
+import io
+import os
+import json
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from config import *
+from utils import get_embedding_model, extract_text_from_docx, print_startup_timings
+from report_generator import load_retrieval_index, split_sop_text, iter_tasks
+from parallel_api_query import stream_claude_on_tasks
+from claude_client import AsyncClaudeClient
+from embedding_cache import EmbeddingCache
+from corpus_store import MANIFEST_FILE
+from ann_index import ANN_META_FILE
+from metrics import metrics
+
+DOCX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+def corpus_signature():
+    '''
+    Returns the modification times of the files written last by an ingest run (corpus manifest,
+    TF-IDF model, ANN metadata). Any change means the retrieval index has to be reloaded.
+    '''
+    paths = [
+        os.path.join(CORPUS_DIR, MANIFEST_FILE),
+        os.path.join(TFIDF_DIR, "vectorizer.pkl"),
+        os.path.join(TFIDF_DIR, "chunk_matrix.npz"),
+        os.path.join(ANN_DIR, ANN_META_FILE)
+    ]
+    return tuple(os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in paths)
+
+def parse_statements(text=None, docx_bytes=None, statements=None):
+    '''
+    Turns a request payload into SOP statements: a list of statements is used as given,
+    DOCX bytes and plain text are split like an SOP document.
+
+    Raises:
+    - ValueError if the payload holds no statements.
+    '''
+    if statements is not None:
+        if not isinstance(statements, list) or not all(isinstance(statement, str) for statement in statements):
+            raise ValueError("statements must be a list of strings")
+    elif docx_bytes is not None:
+        statements = split_sop_text(extract_text_from_docx(io.BytesIO(docx_bytes)))
+    elif text is not None:
+        statements = split_sop_text(text)
+    else:
+        raise ValueError("Send SOP text, a DOCX file or a list of statements")
+    statements = [statement for statement in statements if statement.strip()]
+    if not statements:
+        raise ValueError("The SOP contains no statements")
+    return statements
+
+
+class RequestTasks:
+    '''
+    Task generator of one request whose steps and close() never overlap. Steps run on the
+    shared embedding workers, and a request that ends early closes the generator while a
+    worker may still be inside next(); close() waits for that step to finish.
+    '''
+
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            return next(self.tasks)
+
+    def close(self):
+        with self.lock:
+            self.tasks.close()
+
+
+class ComplianceService:
+    '''
+    Local HTTP service that checks SOPs against the regulatory corpus with everything kept warm.
+
+    - The embedding model and retrieval index are loaded once. The index is reloaded in the
+      background when an ingest run changes processed_docs; requests in flight finish on the
+      index they started with.
+    - All requests share one embedding cache and one bounded pool of SERVER_EMBEDDING_WORKERS
+      threads for embedding and retrieval, so concurrent requests queue instead of competing.
+    - All requests share one AsyncClaudeClient, so the API rate limits and adaptive
+      concurrency apply to the service as a whole.
+
+    Endpoints:
+    - POST /check: SOP as JSON ({"text": ...} or {"statements": [...]}), plain text, a DOCX body,
+      or a multipart form with a "file" (DOCX) or "text" field. Streams NDJSON: one line per
+      statement as soon as its result is ready, then a summary line.
+    - GET /health: index status.
+    - GET /metrics: metrics in the Prometheus text format.
+    '''
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=SERVER_EMBEDDING_WORKERS, thread_name_prefix="embedding")
+        self.model = None
+        self.index = None
+        self.signature = None
+        self.loaded_at = None
+        self.reloads = 0
+        self.embedding_cache = None
+        self.client = None
+
+    def load(self):
+        '''
+        Loads the embedding model, the embedding cache and the retrieval index.
+        '''
+        self.model = get_embedding_model()
+        self.embedding_cache = EmbeddingCache()
+        self.signature = corpus_signature()
+        self.index = load_retrieval_index()
+        self.loaded_at = time.time()
+        print(f"Loaded retrieval index with {len(self.index['chunks'])} chunks.")
+
+    async def reload_index(self, signature):
+        '''
+        Loads the retrieval index of a changed corpus off the event loop and swaps it in.
+        '''
+        self.signature = signature
+        try:
+            with metrics.stage("server.reload_index"):
+                index = await asyncio.to_thread(load_retrieval_index)
+        except Exception as e:
+            print(f"Reloading the retrieval index failed, keeping the current one: {e}")
+            return
+        self.index = index
+        self.loaded_at = time.time()
+        self.reloads += 1
+        print(f"Reloaded retrieval index with {len(index['chunks'])} chunks.")
+
+    async def watch_corpus(self):
+        '''
+        Reloads the retrieval index when processed_docs changes. A change is only picked up
+        once the files have stayed the same for one interval, so an ingest run that is still
+        writing the TF-IDF model or ANN index is not loaded halfway.
+        '''
+        pending = None
+        while True:
+            await asyncio.sleep(SERVER_RELOAD_INTERVAL)
+            signature = corpus_signature()
+            if signature == self.signature:
+                pending = None
+            elif signature != pending:
+                pending = signature
+            else:
+                pending = None
+                await self.reload_index(signature)
+
+    async def read_statements(self, request):
+        '''
+        Reads the SOP statements of a /check request.
+
+        Raises:
+        - web.HTTPBadRequest for payloads without statements or in an unknown format.
+        '''
+        payload = {}
+        try:
+            if request.content_type == "multipart/form-data":
+                async for part in await request.multipart():
+                    if part.name == "file":
+                        payload["docx_bytes"] = await part.read()
+                    elif part.name == "text":
+                        payload["text"] = await part.text()
+            elif request.content_type == "application/json":
+                body = await request.json()
+                if not isinstance(body, dict):
+                    raise ValueError("Expected a JSON object")
+                payload = {key: body[key] for key in ("text", "statements") if key in body}
+            elif request.content_type == DOCX_CONTENT_TYPE:
+                payload["docx_bytes"] = await request.read()
+            else:
+                payload["text"] = await request.text()
+            # DOCX parsing and sentence splitting are blocking.
+            return await asyncio.to_thread(parse_statements, **payload)
+        except web.HTTPException:
+            raise
+        except Exception as e:
+            raise web.HTTPBadRequest(text=json.dumps({"error": str(e)}), content_type="application/json")
+
+    async def check(self, request):
+        '''
+        Checks one SOP and streams the result of every statement as NDJSON as soon as it is ready.
+        '''
+        started = time.perf_counter()
+        statements = await self.read_statements(request)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+
+        results = asyncio.Queue()
+        done = object()
+        # The request keeps the index it started with, even if a reload swaps in a new one.
+        tasks = RequestTasks(iter_tasks(self.index, statements, batch_size=STREAM_BATCH_SIZE, model=self.model, cache=self.embedding_cache))
+
+        def on_result(task, result, found_dis):
+            results.put_nowait(dict(result, index=task[0], found_discrepancy=found_dis))
+
+        pipeline = asyncio.ensure_future(stream_claude_on_tasks(tasks, self.client, on_result, executor=self.executor))
+        pipeline.add_done_callback(lambda _: results.put_nowait(done))
+        flagged = 0
+        first_result = None
+        try:
+            while True:
+                record = await results.get()
+                if record is done:
+                    break
+                if first_result is None:
+                    first_result = time.perf_counter() - started
+                    metrics.observe("server_first_result_seconds", first_result)
+                flagged += record["found_discrepancy"]
+                await response.write((json.dumps(record) + "\n").encode("utf-8"))
+            summary = {"done": True, "statements": len(statements), "flagged": flagged,
+                       "seconds": round(time.perf_counter() - started, 3)}
+            try:
+                await pipeline
+            except Exception as e:
+                summary["error"] = f"{type(e).__name__}: {e}"
+            await response.write((json.dumps(summary) + "\n").encode("utf-8"))
+            await response.write_eof()
+            metrics.count("server_requests_total", status="error" if "error" in summary else "ok")
+        except ConnectionResetError:
+            # The client went away: stop retrieving and calling the API for it.
+            metrics.count("server_requests_total", status="disconnected")
+        finally:
+            if not pipeline.done():
+                pipeline.cancel()
+                await asyncio.gather(pipeline, return_exceptions=True)
+            # Close the task generator once the step a worker may still be running has finished;
+            # the wait happens on a worker, not on the event loop.
+            await asyncio.get_running_loop().run_in_executor(self.executor, tasks.close)
+            metrics.observe("server_request_seconds", time.perf_counter() - started)
+        return response
+
+    async def health(self, request):
+        return web.json_response({
+            "status": "ok",
+            "chunks": len(self.index["chunks"]),
+            "ann": self.index.get("ann") is not None,
+            "loaded_at": self.loaded_at,
+            "reloads": self.reloads
+        })
+
+    async def metrics_text(self, request):
+        return web.Response(text=metrics.prometheus_text(), content_type="text/plain")
+
+    async def background(self, app):
+        '''
+        Opens the shared API client and starts the corpus watcher for the lifetime of the app.
+        '''
+        async with AsyncClaudeClient() as client:
+            self.client = client
+            watcher = asyncio.ensure_future(self.watch_corpus())
+            yield
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+        self.embedding_cache.save()
+
+    def app(self):
+        app = web.Application(client_max_size=SERVER_MAX_UPLOAD_MB * 1024 * 1024)
+        app.router.add_post("/check", self.check)
+        app.router.add_get("/health", self.health)
+        app.router.add_get("/metrics", self.metrics_text)
+        app.cleanup_ctx.append(self.background)
+        return app
+
+def run_server():
+    '''
+    Loads the model and retrieval index, then serves checks until interrupted.
+    '''
+    service = ComplianceService()
+    service.load()
+    print_startup_timings()
+    if SERVER_UNIX_SOCKET:
+        print(f"Serving on unix:{SERVER_UNIX_SOCKET}")
+        web.run_app(service.app(), path=SERVER_UNIX_SOCKET, print=None)
+    else:
+        print(f"Serving on http://{SERVER_HOST}:{SERVER_PORT}")
+        web.run_app(service.app(), host=SERVER_HOST, port=SERVER_PORT, print=None)
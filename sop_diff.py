@@ -0,0 +1,117 @@
+import json
+import difflib
+import hashlib
+from call_claude_api import has_discrepancy
+
+# Revision status of every entry in a diff run's report.
+NEW = "new"  # statement not in the previous report
+CHANGED = "changed"  # statement that replaces edited statements of the previous report
+CARRIED_OVER = "carried_over"  # unchanged, moved or repeated statement; the previous result is reused
+RECHECKED = "rechecked"  # unchanged statement whose previous check failed with an API error
+
+
+def statement_hash(statement):
+    '''
+    Returns the content hash of an SOP statement. Whitespace differences do not count as edits.
+    '''
+    return hashlib.sha256(" ".join(statement.split()).encode("utf-8")).hexdigest()
+
+def load_previous_report(path):
+    '''
+    Reads the report of an earlier run: a JSON compliance report (REPORT_OUTPUT_PATH) or a
+    JSONL report (REPORT_JSONL_PATH), in statement order.
+
+    Returns:
+    - A list of (result, found_dis) tuples, one per statement. Results of JSON reports, which do
+      not store the flag, are flagged like API replies (skipped checks are never flagged).
+    '''
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            records = sorted((json.loads(line) for line in f if line.strip()), key=lambda record: record["index"])
+        else:
+            records = json.load(f)
+
+    previous = []
+    for record in records:
+        record.pop("index", None)
+        record.pop("revision", None)
+        found_dis = record.pop("found_discrepancy", None)
+        if found_dis is None:
+            found_dis = not record.get("skipped") and has_discrepancy(record["discrepancies_and_improvement"])
+        previous.append((record, found_dis))
+    return previous
+
+def align_statements(previous_statements, statements):
+    '''
+    Aligns the statements of a revised SOP with those of the previous report.
+
+    Process:
+    - Hashes every statement and aligns the two hash sequences with difflib, so identical runs of
+      statements are matched in order and edited runs show up as replacements.
+    - Statements left unmatched that still occur elsewhere in the previous report (moved or
+      repeated paragraphs) are matched to those occurrences.
+    - Remaining statements are changed if they replace edited statements, and new if they were inserted.
+
+    Returns:
+    - A tuple (matches, statuses, removed): for every statement, the position of its previous
+      result or None; its revision status (NEW, CHANGED or CARRIED_OVER); and the number of
+      previous statements that no longer occur.
+    '''
+    previous_hashes = [statement_hash(statement) for statement in previous_statements]
+    hashes = [statement_hash(statement) for statement in statements]
+    matches = [None] * len(statements)
+    replaced = set()
+    unmatched = set(range(len(previous_hashes)))
+
+    # autojunk would ignore frequent statements (e.g. repeated headings) in long SOPs.
+    matcher = difflib.SequenceMatcher(None, previous_hashes, hashes, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for offset in range(j2 - j1):
+                matches[j1 + offset] = i1 + offset
+                unmatched.discard(i1 + offset)
+        elif tag == "replace":
+            replaced.update(range(j1, j2))
+
+    # Match moved statements to an unused previous occurrence, and repeated statements to any
+    # occurrence: a statement's result only depends on its text.
+    occurrences = {}
+    for position, statement_key in enumerate(previous_hashes):
+        occurrences.setdefault(statement_key, []).append(position)
+    for idx, statement_key in enumerate(hashes):
+        if matches[idx] is not None or statement_key not in occurrences:
+            continue
+        positions = occurrences[statement_key]
+        matches[idx] = next((position for position in positions if position in unmatched), positions[0])
+        unmatched.discard(matches[idx])
+
+    statuses = [CARRIED_OVER if match is not None else CHANGED if idx in replaced else NEW
+                for idx, match in enumerate(matches)]
+    return matches, statuses, len(unmatched)
+
+def plan_revision(previous, statements):
+    '''
+    Decides which statements of a revised SOP need a new check.
+
+    Parameters:
+    - previous: (result, found_dis) tuples of the previous report, from load_previous_report.
+    - statements: Statements of the revised SOP.
+
+    Returns:
+    - A dictionary with the revision status of every statement ("statuses"), the carried-over
+      results by statement index ("carried", as (result, found_dis) tuples) and the number of
+      removed statements ("removed"). Carried-over results whose check failed with an API error
+      are not carried but rechecked.
+    '''
+    matches, statuses, removed = align_statements([result["sop_statement"] for result, _ in previous], statements)
+    carried = {}
+    for idx, match in enumerate(matches):
+        if match is None:
+            continue
+        result, found_dis = previous[match]
+        if result["discrepancies_and_improvement"].startswith("Error: "):
+            statuses[idx] = RECHECKED
+            continue
+        # The report shows the statement as it reads in the revised SOP.
+        carried[idx] = (dict(result, sop_statement=statements[idx], revision=CARRIED_OVER), found_dis)
+    return {"statuses": statuses, "carried": carried, "removed": removed}
@@ -0,0 +1,190 @@
+import re
+from itertools import chain
+from collections import Counter
+
+# Text processing shared by ingest, SOP parsing and retrieval scoring. Every text is tokenized
+# once with one compiled pattern; the tokens feed keyword counting, TF-IDF and chunking.
+
+# Runs of word characters. On lowercased text, keeping runs of two or more characters gives
+# exactly the tokens of scikit-learn's default TF-IDF pattern (\b\w\w+\b).
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Candidate sentence ends: terminal punctuation, optional closing quotes or brackets, whitespace.
+SENTENCE_END_PATTERN = re.compile(r"[.!?]+[\"'”’)\]]*\s+")
+# Characters that cannot be part of the word before a sentence end.
+NON_WORD_PATTERN = re.compile(r"[^\w.]")
+# Dotted initialisms such as "u.s" or "e.g" (checked without their final period).
+INITIALISM_PATTERN = re.compile(r"(?:[^\W\d_]\.)+[^\W\d_]")
+
+# Abbreviations (lowercase, without the final period) after which a period does not end a sentence.
+ABBREVIATIONS = frozenset([
+    "e.g", "i.e", "al", "cf", "vs", "viz", "approx",
+    "no", "nos", "vol", "vols", "p", "pp", "para", "paras", "sec", "secs", "fig", "figs", "tab",
+    "eq", "eqs", "ref", "refs", "rev", "std", "dept",
+    "inc", "ltd", "co", "corp", "mr", "mrs", "ms", "dr", "prof", "st", "jr", "sr",
+    "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec"
+])
+
+# English stopwords (the NLTK list), compiled once into a frozenset.
+STOPWORDS = frozenset("""
+i me my myself we our ours ourselves you your yours yourself yourselves he him his himself she her hers
+herself it its itself they them their theirs themselves what which who whom this that these those am is
+are was were be been being have has had having do does did doing a an the and but if or because as until
+while of at by for with about against between into through during before after above below to from up
+down in out on off over under again further then once here there when where why how all any both each
+few more most other some such no nor not only own same so than too very s t can will just don should now
+d ll m o re ve y ain aren couldn didn doesn hadn hasn haven isn ma mightn mustn needn shan shouldn wasn
+weren won wouldn
+""".split())
+
+
+def tokenize(text):
+    '''
+    Returns the lowercase word tokens of a text, in order.
+    '''
+    return TOKEN_PATTERN.findall(text.lower())
+
+def tokenize_batch(texts):
+    '''
+    Tokenizes many texts. Returns one token list per text.
+    '''
+    findall = TOKEN_PATTERN.findall
+    return [findall(text.lower()) for text in texts]
+
+def keyword_tokens(tokens):
+    '''
+    Keeps the alphabetic tokens that are not stopwords. Single letters (e.g. from "U.S.")
+    are dropped as well.
+    '''
+    return [token for token in tokens if len(token) > 1 and token.isalpha() and token not in STOPWORDS]
+
+def tfidf_tokens(tokens):
+    '''
+    Keeps the tokens the TF-IDF model counts: those of at least two characters.
+    '''
+    return [token for token in tokens if len(token) > 1]
+
+def pretokenized(tokens):
+    '''
+    TF-IDF analyzer for documents passed as token lists (see tfidf_tokens).
+    Defined at module level so fitted vectorizers can be pickled.
+    '''
+    return tokens
+
+def top_keywords(counts, top_n):
+    '''
+    Returns the top_n most frequent keywords of a Counter, ties in first-seen order.
+    '''
+    return [word for word, count in counts.most_common(top_n)]
+
+def extract_keywords(text, top_n=20):
+    '''
+    Returns the top_n most frequent keywords of a text (see keyword_tokens).
+    '''
+    return top_keywords(Counter(keyword_tokens(tokenize(text))), top_n)
+
+def extract_keywords_batch(texts, top_n=20):
+    '''
+    Extracts the keywords of many texts. Returns one keyword list per text.
+    '''
+    return [top_keywords(Counter(keyword_tokens(tokens)), top_n) for tokens in tokenize_batch(texts)]
+
+def is_sentence_end(text, start, end):
+    '''
+    Decides whether the punctuation text[start:end] (as matched by SENTENCE_END_PATTERN)
+    closes a sentence: it does unless it follows an abbreviation, an initial or an initialism
+    (e.g. "U.S."), or the next sentence would start with a lowercase letter.
+    '''
+    following = text[end:end + 1]
+    if following.islower():
+        return False
+    if "!" in text[start:end] or "?" in text[start:end]:
+        return True
+    # Punctuation detached from the previous word (e.g. "Appendix A . Next") always ends a sentence.
+    if start == 0 or text[start - 1].isspace():
+        return True
+    # The word right before the punctuation, e.g. "u.s" in "(U.S. ".
+    word = NON_WORD_PATTERN.split(text[max(0, start - 40):start].split()[-1])[-1].lower().rstrip(".")
+    return not (word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()) or INITIALISM_PATTERN.fullmatch(word))
+
+def split_sentences(text):
+    '''
+    Splits text into sentences at terminal punctuation followed by whitespace, skipping
+    abbreviations and initials. Line breaks inside a sentence (as in extracted PDF text) do not split it.
+
+    Returns:
+    - A list of stripped, non-empty sentences.
+    '''
+    sentences = []
+    start = 0
+    for match in SENTENCE_END_PATTERN.finditer(text):
+        if not is_sentence_end(text, match.start(), match.end()):
+            continue
+        sentence = text[start:match.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+    sentence = text[start:].strip()
+    if sentence:
+        sentences.append(sentence)
+    return sentences
+
+def split_sentences_batch(texts):
+    '''
+    Splits many texts into sentences. Returns one sentence list per text.
+    '''
+    return [split_sentences(text) for text in texts]
+
+def analyze_document(text, chunk_size, overlap, doc_top_n=20, chunk_top_n=10):
+    '''
+    Splits a document into sentences and overlapping chunks and extracts its keywords,
+    tokenizing every sentence once.
+
+    Process:
+    - Splits the text into sentences and tokenizes each sentence.
+    - Groups the sentences into chunks of chunk_size sentences overlapping by overlap sentences.
+    - Counts the keywords of the document and of every chunk, and the TF-IDF terms of every
+      chunk, from the sentence tokens, so overlapping chunks never tokenize the same sentence again.
+
+    Returns:
+    - A dictionary with the chunks (texts), the document keywords, one keyword list per chunk
+      and one TF-IDF term Counter per chunk (see tfidf_tokens).
+    '''
+    sentences = split_sentences(text)
+    sentence_tokens = tokenize_batch(sentences)
+    sentence_keywords = [keyword_tokens(tokens) for tokens in sentence_tokens]
+    sentence_terms = [tfidf_tokens(tokens) for tokens in sentence_tokens]
+
+    # Counting whole token lists is much faster than adding up Counters. The document tokens
+    # are counted in sentence order, so ties keep first-seen order.
+    doc_counts = Counter(chain.from_iterable(sentence_keywords))
+
+    chunks = []
+    chunk_keywords = []
+    chunk_terms = []
+    step = max(1, chunk_size - overlap)
+    # Slide through the sentence list using the specified chunk size and overlap.
+    for i in range(0, len(sentences), step):
+        chunks.append(" ".join(sentences[i:i + chunk_size]))
+        counts = Counter(chain.from_iterable(sentence_keywords[i:i + chunk_size]))
+        chunk_keywords.append(top_keywords(counts, chunk_top_n))
+        chunk_terms.append(Counter(chain.from_iterable(sentence_terms[i:i + chunk_size])))
+
+    return {
+        "chunks": chunks,
+        "keywords": top_keywords(doc_counts, doc_top_n),
+        "chunk_keywords": chunk_keywords,
+        "chunk_terms": chunk_terms
+    }
+
+def analyze_statements(statements, top_n=20):
+    '''
+    Tokenizes SOP statements once for retrieval scoring.
+
+    Returns:
+    - A tuple (TF-IDF token lists, keyword sets), one entry per statement.
+    '''
+    token_lists = tokenize_batch(statements)
+    tfidf = [tfidf_tokens(tokens) for tokens in token_lists]
+    keywords = [set(top_keywords(Counter(keyword_tokens(tokens)), top_n)) for tokens in token_lists]
+    return tfidf, keywords
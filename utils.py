@@ -1,21 +1,73 @@
 from config import *
 import glob
 import os
+import time
 import pickle
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import TfidfVectorizer
-import docx
+import hashlib
+from contextlib import contextmanager
+import numpy as np
+from text_engine import tokenize_batch, tfidf_tokens, pretokenized
+
+# scikit-learn and sentence-transformers take seconds to import, and scipy and python-docx a
+# noticeable fraction of one, so they are imported on first use only; runs that need none of
+# them start without the cost.
+
+# Seconds spent on one-time startup work (imports, model and index loading), by step.
+startup_timings = {}
+
+# Process-wide instances, created on first use.
+embedding_model = None
+
+
+@contextmanager
+def startup_step(name):
+    '''
+    Adds the time spent in the block to startup_timings[name].
+    '''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = startup_timings.get(name, 0.0) + time.perf_counter() - started
+
+def print_startup_timings():
+    '''
+    Prints the startup time breakdown collected with startup_step.
+    '''
+    if startup_timings:
+        steps = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in startup_timings.items())
+        print(f"Startup: {steps}")
+
+def get_embedding_model():
+    '''
+    Returns the process-wide SentenceTransformer model for EMBEDDING_BACKEND, loading it on first use.
+    '''
+    global embedding_model
+    if embedding_model is None:
+        with startup_step("embedding model"):
+            from embedding_backend import load_embedding_model
+            embedding_model = load_embedding_model()
+    return embedding_model
 
 def load_processed_data():
     '''
-    Loads all processed regulatory documents (pickle files) from the persistent directory.
+    Opens the processed regulatory corpus from the persistent directory.
+    The embedding matrix and chunk texts are memory-mapped, so loading does not copy them.
+    
+    Returns:
+    - The corpus dictionary from corpus_store.load_corpus, or None if nothing has been processed.
+    '''
+    from corpus_store import load_corpus
+    return load_corpus(CORPUS_DIR)
+
+def load_legacy_pickles():
+    '''
+    Loads regulatory documents processed by older versions, which stored one pickle file per PDF.
     
     Returns:
     - A list of data dictionaries for each processed document.
     '''
-    processed_files = glob.glob(os.path.join(PROCESSED_DIR, "*.pkl"))
+    processed_files = sorted(glob.glob(os.path.join(PROCESSED_DIR, "*.pkl")))
     data_list = []
     # Iterate over each pickle file and load its content.
     for file in processed_files:
@@ -24,67 +76,120 @@ def load_processed_data():
             data_list.append(data)
     return data_list
 
-def extract_keywords_from_text(text, top_n=20):
+def normalize_rows(matrix):
     '''
-    Extracts keywords from the given text.
-    
-    Process:
-    - Tokenizes the text into words.
-    - Removes stopwords and non-alphabetic tokens.
-    - Uses frequency analysis to select the top_n most frequent words.
-    
-    Returns:
-    - A set of keywords.
-    '''
-    # Tokenize and convert text to lowercase.
-    tokens = word_tokenize(text.lower())
-    stop_words = set(stopwords.words('english'))
-    # Filter tokens: only alphabetic and non-stopwords.
-    tokens = [t for t in tokens if t.isalpha() and t not in stop_words]
-    from collections import Counter
-    freq = Counter(tokens)
-    most_common = freq.most_common(top_n)
-    keywords = [word for word, count in most_common]
-    return set(keywords)
+    Returns a float32 copy of the matrix with every row scaled to unit length.
+    Rows with zero norm are left as zeros.
+    '''
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
 
 def extract_text_from_docx(docx_path):
     '''
-    Extracts and returns text from a DOCX file.
+    Extracts and returns text from a DOCX file, given as a path or a binary file object.
     '''
+    import docx
     doc = docx.Document(docx_path)
     full_text = []
     for para in doc.paragraphs:
         full_text.append(para.text)
     return "\n".join(full_text)
 
-def compute_jaccard(set1, set2):
+def fit_tfidf_model(corpus):
     '''
-    Computes the Jaccard similarity between two sets.
+    Fits one TF-IDF model over all regulatory chunks of a corpus from the term counts stored
+    at ingest time (see corpus_store), so no chunk is tokenized again. The model is the one
+    TfidfVectorizer fits on the chunk token lists; queries must be transformed with tfidf_input.
     
     Returns:
-    - The ratio of the intersection size to the union size of the two sets.
+    - A tuple (fitted TfidfVectorizer, sparse chunk matrix with L2-normalized rows).
     '''
-    if not set1 and not set2:
-        return 0
-    
-    # Calculate intersection and union.
-    intersection = set1.intersection(set2)
-    union = set1.union(set2)
-    return len(intersection) / len(union) if union else 0
+    from scipy import sparse
+    from sklearn.feature_extraction.text import TfidfVectorizer, TfidfTransformer
+    terms = corpus["term_vocab"]
+    counts = sparse.csr_matrix(
+        (np.asarray(corpus["chunk_term_counts"], dtype=np.float64), np.asarray(corpus["chunk_term_ids"]),
+         np.asarray(corpus["chunk_term_offsets"])),
+        shape=(len(corpus["chunks"]), len(terms))
+    )
+    # TfidfVectorizer numbers its vocabulary alphabetically; the columns follow the same order.
+    order = sorted(range(len(terms)), key=terms.__getitem__)
+    transformer = TfidfTransformer()
+    matrix = transformer.fit_transform(counts[:, order]).tocsr()
+    vectorizer = TfidfVectorizer(analyzer=pretokenized, vocabulary=[terms[i] for i in order])
+    vectorizer.idf_ = transformer.idf_
+    return vectorizer, matrix
+
+def tfidf_input(texts, token_lists=None):
+    '''
+    Returns the TF-IDF token lists of texts, as expected by models fitted with fit_tfidf_model.
+    Already computed token lists may be passed as token_lists.
+    '''
+    if token_lists is None:
+        token_lists = [tfidf_tokens(tokens) for tokens in tokenize_batch(texts)]
+    return token_lists
+
+def save_tfidf_model(vectorizer, matrix, sources, doc_ranges, fingerprint=None, tfidf_dir=TFIDF_DIR):
+    '''
+    Saves a corpus TF-IDF model: the fitted vectorizer (with its vocabulary and IDF weights),
+    the sparse chunk matrix, the row range of every source document in that matrix, and the
+    fingerprint of the corpus it was fitted on (see ann_index.corpus_fingerprint).
+    The fingerprint file is written last, so an interrupted save is never used.
+    '''
+    from scipy import sparse
+    os.makedirs(tfidf_dir, exist_ok=True)
+    fingerprint_path = os.path.join(tfidf_dir, "fingerprint.txt")
+    if os.path.exists(fingerprint_path):
+        os.remove(fingerprint_path)
+    with open(os.path.join(tfidf_dir, "vectorizer.pkl"), "wb") as f:
+        pickle.dump({"vectorizer": vectorizer, "sources": list(sources), "doc_ranges": [tuple(r) for r in doc_ranges]}, f)
+    sparse.save_npz(os.path.join(tfidf_dir, "chunk_matrix.npz"), matrix)
+    with open(fingerprint_path, "w") as f:
+        f.write(fingerprint or "")
 
-def compute_tfidf_similarity_batch(reference_text, texts):
+def tfidf_model_fingerprint(tfidf_dir=TFIDF_DIR):
     '''
-    Computes TF-IDF cosine similarity between a reference text and a list of texts.
+    Returns the corpus fingerprint saved with the TF-IDF model, or None for models saved
+    without one (older versions, interrupted saves).
+    '''
+    fingerprint_path = os.path.join(tfidf_dir, "fingerprint.txt")
+    if not os.path.exists(fingerprint_path):
+        return None
+    with open(fingerprint_path) as f:
+        return f.read().strip() or None
+
+def has_tfidf_model(tfidf_dir=TFIDF_DIR, fingerprint=None):
+    '''
+    Returns True if a corpus TF-IDF model has been saved, without loading it. If a corpus
+    fingerprint is given, the model must also have been fitted on that corpus.
+    '''
+    if not all(os.path.exists(os.path.join(tfidf_dir, name)) for name in ("vectorizer.pkl", "chunk_matrix.npz")):
+        return False
+    return fingerprint is None or tfidf_model_fingerprint(tfidf_dir) == fingerprint
+
+def load_tfidf_model(tfidf_dir=TFIDF_DIR):
+    '''
+    Loads the corpus TF-IDF model saved by save_tfidf_model.
     
     Returns:
-    - A list of similarity scores.
+    - A dictionary with the vectorizer, the sparse chunk matrix, the sources and their row ranges
+      and the corpus fingerprint, or None if no model has been saved.
     '''
-    # Create a TfidfVectorizer instance and compute TF-IDF vectors.
-    vectorizer = TfidfVectorizer()
-    tfidf = vectorizer.fit_transform([reference_text] + texts)
-    # Compute cosine similarity between the reference text and each text.
-    sim_matrix = cosine_similarity(tfidf[0:1], tfidf[1:])
-    return sim_matrix[0]
+    if not has_tfidf_model(tfidf_dir):
+        return None
+    vectorizer_path = os.path.join(tfidf_dir, "vectorizer.pkl")
+    matrix_path = os.path.join(tfidf_dir, "chunk_matrix.npz")
+    # Unpickling the vectorizer imports scikit-learn.
+    with startup_step("tfidf model"), open(vectorizer_path, "rb") as f:
+        model = pickle.load(f)
+    from scipy import sparse
+    model["matrix"] = sparse.load_npz(matrix_path).tocsr()
+    model["fingerprint"] = tfidf_model_fingerprint(tfidf_dir)
+    return model
 
 def combine_short_sentences(sentences, min_words=MIN_SOP_WORDS, max_words=MAX_SOP_WORDS):
     '''
@@ -103,4 +208,14 @@ def combine_short_sentences(sentences, min_words=MIN_SOP_WORDS, max_words=MAX_SO
             combined[-1] += " " + sentence.strip()
         else:
             combined.append(sentence.strip())
-    return combined
\ No newline at end of file
+    return combined
+
+def file_content_hash(path):
+    '''
+    Returns the SHA-256 hex digest of a file's content.
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()